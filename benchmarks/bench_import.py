@@ -0,0 +1,54 @@
+"""
+Benchmark of the time taken to load the plugin, as Quantiphyse does at start-up
+
+Each measurement is made in a new Python process so modules imported by earlier
+runs are not reused. The time to resolve all of the classes in the manifest,
+as happens when the ASL widgets are first used, is shown for comparison.
+
+Usage: python benchmarks/bench_import.py [--number 5]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import subprocess
+import sys
+
+# Modules which are expensive to import and should not be loaded with the plugin
+HEAVY_MODULES = ["oxasl", "fsl.data.image", "scipy", "pandas", "pyqtgraph"]
+
+SCRIPT = """
+import json, sys, time
+start = time.time()
+import quantiphyse_basil
+if %(resolve)s:
+    for key, items in quantiphyse_basil.QP_MANIFEST.items():
+        for item in items:
+            if hasattr(item, "resolve"):
+                item.resolve()
+elapsed = time.time() - start
+print(json.dumps({"time" : elapsed, "modules" : [mod for mod in %(heavy)r if mod in sys.modules]}))
+"""
+
+def measure(resolve):
+    """
+    :return: Tuple of (import time in seconds, list of heavy modules imported)
+    """
+    script = SCRIPT % {"resolve" : resolve, "heavy" : HEAVY_MODULES}
+    output = subprocess.check_output([sys.executable, "-c", script])
+    result = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+    return result["time"], result["modules"]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=5, help="Number of timed imports of each type")
+    args = parser.parse_args()
+
+    print("%-24s %12s  %s" % ("Import", "Time (s)", "Heavy modules loaded"))
+    for label, resolve in (("Plugin load", False), ("All classes resolved", True)):
+        runs = [measure(resolve) for _ in range(args.number)]
+        best = min(elapsed for elapsed, _ in runs)
+        print("%-24s %12.4f  %s" % (label, best, ", ".join(runs[0][1]) or "none"))
+
+if __name__ == "__main__":
+    main()
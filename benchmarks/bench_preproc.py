@@ -0,0 +1,60 @@
+"""
+Benchmark of fused ASL preprocessing against the step-by-step oxasl operations
+
+Usage: python benchmarks/bench_preproc.py [--shape 64 64 24] [--tis 6] [--repeats 8]
+"""
+from __future__ import print_function
+
+import argparse
+import timeit
+
+import numpy as np
+
+from oxasl import AslImage
+
+from quantiphyse_basil.preproc import PreprocPlan, apply_ops
+
+OPS = [
+    ("diff", [("diff", None)]),
+    ("diff+mean", [("diff", None), ("mean", None)]),
+    ("diff+reorder+mean", [("diff", None), ("reorder", "rt"), ("mean", None)]),
+    ("pwi", [("pwi", None)]),
+]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--shape", type=int, nargs=3, default=[64, 64, 24], help="Spatial dimensions")
+    parser.add_argument("--tis", type=int, default=6, help="Number of TIs")
+    parser.add_argument("--repeats", type=int, default=8, help="Number of repeats at each TI")
+    parser.add_argument("--number", type=int, default=5, help="Number of timed runs of each method")
+    args = parser.parse_args()
+
+    metadata = {
+        "iaf" : "tc",
+        "ibf" : "rpt",
+        "tis" : [1.0 + 0.25*idx for idx in range(args.tis)],
+    }
+    nvols = 2 * args.tis * args.repeats
+    data = np.random.normal(size=list(args.shape) + [nvols]).astype(np.float32)
+    print("Data shape %s (%.1f Mb)" % (data.shape, data.nbytes / 1e6))
+    print("%-20s %12s %12s %12s %8s" % ("Operations", "Step (s)", "Compile (s)", "Fused (s)", "Speedup"))
+
+    for label, ops in OPS:
+        def _stepwise():
+            return apply_ops(AslImage(data, name="data", **metadata), ops).data
+
+        plan = PreprocPlan(metadata, nvols, ops, name="data")
+        def _fused():
+            return plan.apply(data)
+
+        if not np.allclose(_stepwise(), _fused(), atol=1e-5):
+            raise RuntimeError("Fused output differs from step-by-step output for %s" % label)
+
+        step = min(timeit.repeat(_stepwise, number=1, repeat=args.number))
+        fused = min(timeit.repeat(_fused, number=1, repeat=args.number))
+        compile_time = min(timeit.repeat(lambda: PreprocPlan(metadata, nvols, ops, name="data"),
+                                         number=1, repeat=args.number))
+        print("%-20s %12.4f %12.4f %12.4f %7.1fx" % (label, step, compile_time, fused, step / fused))
+
+if __name__ == "__main__":
+    main()
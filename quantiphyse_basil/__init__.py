@@ -1,27 +1,96 @@
 """
 ASL Quantiphyse plugin
 
+Widget, process and test classes are only imported when they are first used,
+so loading the plugin does not slow down Quantiphyse start-up by importing
+oxasl, fslpy, pandas, etc.
+
 Author: Martin Craig <martin.craig@eng.ox.ac.uk>
 Copyright (c) 2016-2017 University of Oxford, Martin Craig
 """
 import os
-
-from .widgets import AslPreprocWidget, AslBasilWidget, AslCalibWidget, AslMultiphaseWidget
-from .oxasl_widgets import OxaslWidget
-from .aslimage_widget import AslImageWidget
-from .process import AslDataProcess, AslPreprocProcess, BasilProcess, AslMultiphaseProcess, OxaslProcess
-from .tests import AslPreprocWidgetTest, MultiphaseProcessTest, OxaslProcessTest, OxaslWidgetTest
+import importlib
 
 # Workaround ugly warning about wx
 import logging
 logging.getLogger("fsl.utils.platform").setLevel(logging.CRITICAL)
 
+class _LazyClass(object):
+    """
+    Stand-in for a plugin class which imports it when it is first used
+
+    Calling the proxy creates an instance of the class, and any other attribute
+    is taken from the class, so it can be used in place of the class in the
+    manifest. Attributes which are needed to select a plugin (e.g. ``PROCESS_NAME``)
+    can be given so they are available without importing the class
+    """
+
+    def __init__(self, module, name, **attrs):
+        self._module = module
+        self._cls = None
+        self.__name__ = name
+        self.__dict__.update(attrs)
+
+    def resolve(self):
+        """
+        :return: The class, importing its module if necessary
+        """
+        if self._cls is None:
+            module = importlib.import_module(self._module, __name__)
+            self._cls = getattr(module, self.__name__)
+        return self._cls
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name in ("_module", "_cls"):
+            raise AttributeError(name)
+        return getattr(self.resolve(), name)
+
+    def __dir__(self):
+        return dir(self.resolve())
+
+    def __instancecheck__(self, instance):
+        return isinstance(instance, self.resolve())
+
+    def __subclasscheck__(self, subclass):
+        return issubclass(subclass, self.resolve())
+
+    def __repr__(self):
+        return "<lazy class %s%s.%s>" % (__name__, self._module, self.__name__)
+
+def _widget(name):
+    module = ".oxasl_widgets" if name == "OxaslWidget" else ".widgets"
+    return _LazyClass(module, name)
+
+def _process(name, process_name):
+    return _LazyClass(".process", name, PROCESS_NAME=process_name)
+
+def _test(name):
+    return _LazyClass(".tests", name)
+
+AslPreprocWidget = _widget("AslPreprocWidget")
+AslBasilWidget = _widget("AslBasilWidget")
+AslCalibWidget = _widget("AslCalibWidget")
+AslMultiphaseWidget = _widget("AslMultiphaseWidget")
+OxaslWidget = _widget("OxaslWidget")
+AslImageWidget = _LazyClass(".aslimage_widget", "AslImageWidget")
+
+AslDataProcess = _process("AslDataProcess", "AslData")
+AslPreprocProcess = _process("AslPreprocProcess", "AslPreproc")
+BasilProcess = _process("BasilProcess", "Basil")
+AslMultiphaseProcess = _process("AslMultiphaseProcess", "AslMultiphase")
+OxaslProcess = _process("OxaslProcess", "Oxasl")
+OxaslCohortProcess = _process("OxaslCohortProcess", "OxaslCohort")
+
 QP_MANIFEST = {
     "widgets" : [AslPreprocWidget, AslMultiphaseWidget, OxaslWidget],
-    "processes" : [AslPreprocProcess, AslMultiphaseProcess, OxaslProcess],
+    "processes" : [AslPreprocProcess, AslMultiphaseProcess, OxaslProcess, OxaslCohortProcess],
     "fabber-dirs" : [os.path.dirname(__file__),],
     "qwidgets" : [AslImageWidget],
     "module-dirs" : ["deps",],
-    "widget-tests" : [AslPreprocWidgetTest, OxaslWidgetTest],
-    "process-tests" : [OxaslProcessTest, MultiphaseProcessTest,],
+    "widget-tests" : [_test("AslPreprocWidgetTest"), _test("AslCalibWidgetTest"), _test("OxaslWidgetTest")],
+    "process-tests" : [_test("AslPreprocProcessTest"), _test("AslCalibProcessTest"), _test("BasilProcessTest"), _test("OxaslProcessTest"), _test("OxaslCohortProcessTest"), _test("MultiphaseProcessTest"),],
+    "unit-tests" : [_test("CacheTest"), _test("SignalFitTest"), _test("MetadataValidationTest"), _test("BackgroundExecutorTest"), _test("ProfilingTest"), _test("TransferTest"), _test("ManifestTest"),],
 }
@@ -7,22 +7,21 @@ Copyright (c) 2013-2018 University of Oxford
 """
 
 from __future__ import division, unicode_literals, absolute_import
-import itertools
-import traceback
 
 import numpy as np
-import scipy
 
 try:
     from PySide import QtGui, QtCore, QtGui as QtWidgets
 except ImportError:
     from PySide2 import QtGui, QtCore, QtWidgets
 
+from quantiphyse.data import NumpyData
 from quantiphyse.gui.widgets import OverlayCombo, ChoiceOption, NumericOption, OrderList, OrderListButtons, WarningBox
 import quantiphyse.gui.options as opt
 from quantiphyse.utils import LogSource, QpException
 
-from .process import  qpdata_to_aslimage, fslimage_to_qpdata
+from .background import BackgroundExecutor
+from .sigfit import signal_source, cached_mean_signal, fit_signal, rank_orders, MAX_SIGNAL_VOXELS
 
 from ._version import __version__
 
@@ -135,6 +134,50 @@ def get_order_string(md):
     _, order, _ = data_order(md.get("iaf", None), md.get("ibf", None), md.get("order", None))
     return order
 
+def autodetect_order(md, data, source):
+    """
+    Rank possible data orderings by how well they fit the mean ASL signal
+
+    Every permutation of the current ordering is tried. Where the number of
+    repeats is given explicitly, the number implied by the data size is also
+    tried, and for multiphase and vessel encoded data so is every number of
+    phases/encodings consistent with the data size.
+
+    :param md: Metadata dictionary
+    :param data: QpData containing the ASL data. Only its size is used, the voxel
+                 data comes from ``source``
+    :param source: Representative signal source from ``signal_source``
+    :return: List of (cost, order string, metadata dictionary) sorted by increasing cost
+    """
+    iaf = md.get("iaf", "tc")
+    ntis = len(md.get("tis", md.get("plds", [1])))
+    nlabel = get_num_label_vols(md)
+    nvols = data.nvols
+    auto_rpts = get_auto_repeats(md, data)[0]
+    variants = [{"t" : ntis, "r" : md.get("nrpts", auto_rpts), "l" : nlabel}]
+    if md.get("nrpts", auto_rpts) != auto_rpts:
+        variants.append({"t" : ntis, "r" : auto_rpts, "l" : nlabel})
+    if iaf in ("mp", "ve"):
+        for num_label in range(2, nvols // ntis + 1):
+            if num_label != nlabel and nvols % (ntis * num_label) == 0:
+                variants.append({"t" : ntis, "r" : nvols // (ntis * num_label), "l" : num_label})
+
+    ranked = []
+    signal = cached_mean_signal(*source, max_voxels=MAX_SIGNAL_VOXELS)
+    for cost, order, num in rank_orders(signal, get_order_string(md), variants):
+        trial_md = dict(md)
+        trial_md.pop("ibf", None)
+        trial_md["order"] = order
+        if num["l"] != nlabel:
+            trial_md["nphases" if iaf == "mp" else "nenc"] = num["l"]
+        if num["r"] != md.get("nrpts", auto_rpts):
+            if num["r"] == get_auto_repeats(trial_md, data)[0]:
+                trial_md.pop("nrpts", None)
+            else:
+                trial_md["nrpts"] = num["r"]
+        ranked.append((cost, order, trial_md))
+    return ranked
+
 class DataStructure(QtGui.QWidget, AslMetadataView):
     """
     Visual preview of the structure of an ASL data set
@@ -220,6 +263,28 @@ class DataStructure(QtGui.QWidget, AslMetadataView):
                     p.drawText(ox, oy, 2*w-1, height, QtCore.Qt.AlignHCenter, label)
                     self._draw_groups(p, groups[1:], ox, oy+height, 2*w, height)
 
+def fit_preview(source, order, num):
+    """
+    Fit the signal expected from a data ordering to the representative signal of ASL data
+
+    :param source: Representative signal source from ``signal_source``
+    :return: Tuple of (representative signal, fitted signal, cost)
+    """
+    signal = cached_mean_signal(*source, max_voxels=MAX_SIGNAL_VOXELS)
+    fitted_signal, cost = fit_signal(signal, order, num)
+    return signal, fitted_signal, cost
+
+def make_pwi(data, md):
+    """
+    Generate a perfusion weighted image from ASL data
+
+    :return: QpData containing the perfusion weighted image
+    """
+    from .process import qpdata_to_aslimage, fslimage_to_qpdata
+    aslimage, _ = qpdata_to_aslimage(data, metadata=md)
+    pwi = aslimage.perf_weighted()
+    return fslimage_to_qpdata(pwi, name=data.name + "_pwi")
+
 class SignalPreview(QtGui.QWidget):
     """
     Visual preview of the signal expected from an ASL data set
@@ -237,6 +302,7 @@ class SignalPreview(QtGui.QWidget):
         self.fitted_signal = None
         self.cost = None
         self.setFixedHeight(50)
+        self._executor = BackgroundExecutor(self)
 
     @property
     def md(self):
@@ -266,9 +332,12 @@ class SignalPreview(QtGui.QWidget):
                 "r" : self._md.get("nrpts", get_auto_repeats(self._md, self._data)[0]),
                 "l" : get_num_label_vols(self._md)
             }
-            self._get_mean_signal()
-            self._get_fitted_signal()
-            self.repaint()
+            self._executor.submit("fit", fit_preview, (signal_source(self._data), self._order, dict(self._num)),
+                                  callback=self._fit_done)
+
+    def _fit_done(self, result):
+        self.mean_signal, self.fitted_signal, self.cost = result
+        self.repaint()
 
     def paintEvent(self, _):
         """
@@ -280,18 +349,10 @@ class SignalPreview(QtGui.QWidget):
         p = QtGui.QPainter(self)
         p.drawLine(0, h-1, 0, 0)
         p.drawLine(0, h-1, w-1, h-1)
-        if self._data is not None:
+        if self._data is not None and self.mean_signal is not None:
             self._draw_signal(self.fitted_signal, p, ox, oy, w*self.HFACTOR, h*self.VFACTOR, col=QtCore.Qt.red)
             self._draw_signal(self.mean_signal, p, ox, oy, w*self.HFACTOR, h*self.VFACTOR, col=QtCore.Qt.green)
 
-    def _get_mean_signal(self):
-        if self._data is not None:
-            rawdata = self._data.raw()
-            voxel_range = np.nanmax(rawdata, axis=-1) - np.nanmin(rawdata, axis=-1)
-            good_signal = np.percentile(voxel_range, 99)
-            good_signals = rawdata[voxel_range >= good_signal]
-            self.mean_signal = np.mean(good_signals, axis=0)
-
     def _draw_signal(self, sig, p, ox, oy, w, h, col):
         sigmin, sigmax = np.min(sig), np.max(sig)
         sigrange = sigmax - sigmin
@@ -309,30 +370,6 @@ class SignalPreview(QtGui.QWidget):
             path.lineTo(x, y)
         p.drawPath(path)
 
-    def _get_fitted_signal(self):
-        sigmin, sigmax = np.min(self.mean_signal), np.max(self.mean_signal)
-        sigrange = sigmax - sigmin
-        if sigrange == 0:
-            sigrange = 1
-        initial = sigrange * np.arange(self._num["t"])[::-1] + sigmin
-        result = scipy.optimize.least_squares(self._sigdiff, initial)
-        self.fitted_signal = self._tdep_to_signal(result.x)
-        self.cost = result.cost
-
-    def _tdep_to_signal(self, tdep):
-        vals = []
-        for char in self._order[::-1]:
-            vals.append(range(self._num[char]))
-        t_idx = self._order[::-1].index('t')
-        return np.array([tdep[items[t_idx]] for items in itertools.product(*vals)])
-
-    def _sigdiff(self, tdep):
-        signal = self._tdep_to_signal(tdep)
-        if len(signal) >= len(self.mean_signal):
-            return self.mean_signal - signal[:len(self.mean_signal)]
-        else:
-            return self.mean_signal - (list(signal) + [0,] * (len(self.mean_signal) - len(signal)))
-
 class SignalView(QtCore.QObject, AslMetadataView):
     """
     Shows a preview of the actual mean ASL signal and the predicted signal
@@ -459,6 +496,8 @@ class BlockFormat(QtCore.QObject, AslMetadataView):
         grid.addLayout(hbox, ypos, 1)
         self.detect_btn = QtGui.QPushButton("Auto detect")
         grid.addWidget(self.detect_btn, ypos, 2)
+        self.ranked_orders = []
+        self._executor = BackgroundExecutor(self)
 
         self.choice.sig_changed.connect(self._changed)
         self.order_edit.editingFinished.connect(self._changed)
@@ -474,6 +513,9 @@ class BlockFormat(QtCore.QObject, AslMetadataView):
         order = get_order_string(self.md)
         self.order_edit.setText(order)
         self.order_edit.setVisible(ibf == "custom")
+
+        # Any autodetection in progress is for out of date metadata
+        self._executor.cancel("autodetect")
         self.detect_btn.setEnabled(self.data is not None)
 
     def _changed(self):
@@ -488,20 +530,23 @@ class BlockFormat(QtCore.QObject, AslMetadataView):
         self.sig_md_changed.emit(self)
 
     def _autodetect(self):
-        fitter = SignalPreview()
-        fitter.data = self.data
-        order = get_order_string(self.md)
-        trial_md = dict(self.md)
-        trial_md.pop("ibf", None)
-        best, best_order = 1e9, order
-        for trial in itertools.permutations(order):
-            trial = "".join(trial)
-            trial_md["order"] = trial
-            fitter.md = trial_md
-            #self.debug("autodetect: %s, %f" % (trial, fitter.cost))
-            if fitter.cost < best:
-                best = fitter.cost
-                best_order = trial
+        self.detect_btn.setEnabled(False)
+        self._executor.submit("autodetect", autodetect_order, (dict(self.md), self.data, signal_source(self.data)),
+                              callback=self._autodetect_done, errback=self._autodetect_failed)
+
+    def _autodetect_failed(self, _exc):
+        self.detect_btn.setEnabled(self.data is not None)
+
+    def _autodetect_done(self, ranked_orders):
+        self.detect_btn.setEnabled(self.data is not None)
+        self.ranked_orders = ranked_orders
+        _cost, best_order, best_md = self.ranked_orders[0]
+        for key in ("nphases", "nenc", "nrpts"):
+            if key in best_md:
+                self.md[key] = best_md[key]
+            elif key == "nrpts":
+                # Number of repeats is inferred from the data size
+                self.md.pop(key, None)
         if best_order.endswith("rt"):
             self.md["ibf"] = "tis"
             self.md.pop("order", None)
@@ -526,13 +571,28 @@ class LabelType(ChoiceOption, AslMetadataView):
         self.pwi_btn.setToolTip("Generate a perfusion-weighted image by performing label-control subtraction and averaging")
         self.pwi_btn.clicked.connect(self._pwi)
         grid.addWidget(self.pwi_btn, ypos, 2)
+        self._executor = BackgroundExecutor(self)
         AslMetadataView.__init__(self)
         self.sig_changed.connect(self._changed)
     
     def _update(self):
         iaf = self.md.get("iaf", "tc")
         self.combo.setCurrentIndex(self._indexes.index(iaf))
-        self.pwi_btn.setEnabled(iaf in ("tc", "ct"))
+        self.pwi_btn.setEnabled(self._pwi_available())
+
+    def _pwi_available(self):
+        """
+        :return: True if a PWI can be generated, i.e. the data is label-control
+                 pairs and the metadata is consistent with it
+        """
+        if self.data is None or self.md.get("iaf", "tc") not in ("tc", "ct"):
+            return False
+        from .process import validate_asl_metadata
+        try:
+            validate_asl_metadata(self.md, self.data.nvols)
+            return True
+        except ValueError:
+            return False
 
     def _changed(self):
         iaf = self._indexes[self.combo.currentIndex()]
@@ -558,15 +618,20 @@ class LabelType(ChoiceOption, AslMetadataView):
         self.sig_md_changed.emit(self)
 
     def _pwi(self):
-        try:
-            aslimage, _ = qpdata_to_aslimage(self.data, metadata=self.md)
-            pwi = aslimage.perf_weighted()
-            qpd = fslimage_to_qpdata(pwi, name=self.data.name + "_pwi")
-            self.ivm.add(qpd, name=qpd.name, make_current=True)
-        except:
-            # FIXME ignore but button should not be enabled if 
-            # metadata is inconsistent!
-            traceback.print_exc()
+        self.pwi_btn.setEnabled(False)
+        # The background job works on its own reference to the voxel data
+        data = NumpyData(self.data.raw(), grid=self.data.grid, name=self.data.name)
+        self._executor.submit("pwi", make_pwi, (data, dict(self.md)),
+                              callback=self._pwi_done, errback=self._pwi_failed)
+
+    def _pwi_done(self, qpd):
+        self.pwi_btn.setEnabled(self._pwi_available())
+        self.ivm.add(qpd, name=qpd.name, make_current=True)
+
+    def _pwi_failed(self, _exc):
+        # The button is only enabled for consistent metadata so this is
+        # unexpected. The error is logged by the executor
+        self.pwi_btn.setEnabled(self._pwi_available())
 
 class Labelling(ChoiceOption, AslMetadataView):
     """
@@ -817,8 +882,16 @@ class AslImageWidget(QtGui.QWidget, LogSource):
         self.data = None
         self.default_md = kwargs.get("default_metadata", DEFAULT_METADATA)
         self.md = dict(self.default_md)
-        self.aslimage = None
+        self.structure = {}
         self.valid = True
+        self._aslimage = None
+
+        # Metadata changes are applied once per event loop iteration (or after a delay
+        # in ms if ``update_delay`` is given) however many views emit changes
+        self.update_delay = kwargs.get("update_delay", 0)
+        self.updates_requested = 0
+        self.updates_avoided = 0
+        self._update_pending = False
         
         vbox = QtGui.QVBoxLayout()
         self.setLayout(vbox)
@@ -898,21 +971,41 @@ class AslImageWidget(QtGui.QWidget, LogSource):
                     self.md["ibf"] = "tis"
             for view in self.views:
                 view.set_data(self.data, self.md)
-            self._validate_metadata()
-            self.sig_changed.emit()
+            if self._update_pending:
+                # Views changed the metadata for the new data - apply it now
+                self.flush_updates()
+            else:
+                self._validate_metadata()
+                self.sig_changed.emit()
 
     def _metadata_changed(self, sender):
         """
         Called when a view has changed the metadata
+
+        Validation and updating of the views is deferred so that a burst of
+        changes results in only one update
         """
         self.debug("Metadata changed %s", sender)
         if self.data is not None:
             self.debug("Current metadata: %s", self.md)
         self.debug("New metadata: %s", sender.md)
         self.md = sender.md
-        self._validate_metadata()
-        self._save_metadata()
-        self.sig_changed.emit()
+        self.updates_requested += 1
+        if self._update_pending:
+            self.updates_avoided += 1
+        else:
+            self._update_pending = True
+            QtCore.QTimer.singleShot(self.update_delay, self.flush_updates)
+
+    def flush_updates(self):
+        """
+        Apply any pending metadata change immediately
+        """
+        if self._update_pending:
+            self._update_pending = False
+            self._validate_metadata()
+            self._save_metadata()
+            self.sig_changed.emit()
 
     def _save_metadata(self):
         """
@@ -938,24 +1031,42 @@ class AslImageWidget(QtGui.QWidget, LogSource):
         finally:
             self.updating_ui = False
 
+    @property
+    def aslimage(self):
+        """
+        oxasl.AslImage for the current data and metadata, or None if the metadata is not valid
+
+        This is only created when it is first needed, since it wraps the full voxel data
+        """
+        self.flush_updates()
+        if self._aslimage is None and self.valid and self.md and self.data is not None:
+            from .process import qpdata_to_aslimage
+            self._aslimage, _ = qpdata_to_aslimage(self.data, metadata=dict(self.md))
+        return self._aslimage
+
     def _validate_metadata(self):
         """
         Validate data against specified TIs, etc
+
+        Only the number of volumes in the data is needed for this
         """
+        self._aslimage = None
+        self.structure = {}
         try:
             if self.md and self.data is not None:
                 self.debug("Validating metadata: %s", str(self.md))
-                self.aslimage, _ = qpdata_to_aslimage(self.data, metadata=self.md)
+                from .process import validate_asl_metadata
+                self.structure = validate_asl_metadata(self.md, self.data.nvols)
             self.warn_label.clear()
             self.valid = True
         except ValueError as e:
             self.debug("Failed: %s", str(e))
-            self.aslimage = None
             self.warn_label.warn(str(e))
             self.valid = False
 
     def get_options(self):
         """ Get batch options """
+        self.flush_updates()
         options = {}
         if self.data is not None:
             options["data"] = self.data.name
@@ -0,0 +1,126 @@
+"""
+QP-BASIL - Background execution of expensive GUI computations
+
+Jobs are run on a thread pool so the GUI stays responsive. Each job has a
+key and submitting a new job with the same key supersedes the previous one:
+if it has not started it is not run, and if it has its result is discarded.
+Results are passed to callbacks on the GUI thread.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+import sys
+import logging
+import threading
+
+try:
+    from PySide import QtCore
+except ImportError:
+    from PySide2 import QtCore
+
+LOG = logging.getLogger(__name__)
+
+class _JobSignals(QtCore.QObject):
+    """
+    Signals for a job - QRunnable is not a QObject so cannot emit signals itself
+    """
+    sig_done = QtCore.Signal(object, int, object, object)
+
+class _Job(QtCore.QRunnable):
+    """
+    Runnable which calls a function unless it has been superseded
+    """
+
+    def __init__(self, executor, key, generation, fn, args, kwargs):
+        QtCore.QRunnable.__init__(self)
+        self.executor = executor
+        self.key = key
+        self.generation = generation
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = _JobSignals()
+
+    def run(self):
+        result, exc = None, None
+        if self.executor.is_current(self.key, self.generation):
+            try:
+                result = self.fn(*self.args, **self.kwargs)
+            except:
+                LOG.exception("Background job %s failed", self.key)
+                exc = sys.exc_info()[1]
+        # Always signal completion so the executor can release the job
+        self.signals.sig_done.emit(self.key, self.generation, result, exc)
+
+class BackgroundExecutor(QtCore.QObject):
+    """
+    Runs functions in background threads and passes the results to callbacks
+    """
+
+    def __init__(self, parent=None, pool=None):
+        """
+        :param parent: Parent QObject
+        :param pool: QThreadPool to use. If not specified the global thread pool is used
+        """
+        QtCore.QObject.__init__(self, parent)
+        self._pool = pool if pool is not None else QtCore.QThreadPool.globalInstance()
+        self._lock = threading.Lock()
+        self._generations = {}
+        self._callbacks = {}
+        self._jobs = {}
+
+    def submit(self, key, fn, args=(), kwargs=None, callback=None, errback=None):
+        """
+        Run a function in the background, superseding any previous job with the same key
+
+        :param key: Job key
+        :param fn: Function to run
+        :param args: Positional arguments for ``fn``
+        :param kwargs: Keyword arguments for ``fn``
+        :param callback: Called on the GUI thread with the return value of ``fn``
+        :param errback: Called on the GUI thread with the exception if ``fn`` fails
+        """
+        with self._lock:
+            generation = self._generations.get(key, 0) + 1
+            self._generations[key] = generation
+        job = _Job(self, key, generation, fn, args, kwargs or {})
+        job.setAutoDelete(False)
+        job.signals.sig_done.connect(self._done)
+        self._callbacks[key] = (generation, callback, errback)
+        # Keep a reference to the job until it has finished, even if it is superseded
+        self._jobs[(key, generation)] = job
+        self._pool.start(job)
+
+    def cancel(self, key):
+        """
+        Cancel any job with the given key. It will not be run if it has not
+        already started, and its result will not be passed to the callback
+        """
+        with self._lock:
+            if key in self._generations:
+                self._generations[key] += 1
+        self._callbacks.pop(key, None)
+
+    def is_current(self, key, generation):
+        """
+        :return: True if the job with the given key and generation has not been superseded
+        """
+        with self._lock:
+            return self._generations.get(key, 0) == generation
+
+    def is_running(self, key):
+        """
+        :return: True if a job with the given key is waiting or running
+        """
+        return key in self._callbacks
+
+    def _done(self, key, generation, result, exc):
+        self._jobs.pop((key, generation), None)
+        current = self._callbacks.get(key, None)
+        if current is None or current[0] != generation or not self.is_current(key, generation):
+            return
+        _, callback, errback = self._callbacks.pop(key)
+        if exc is None:
+            if callback is not None:
+                callback(result)
+        elif errback is not None:
+            errback(exc)
@@ -0,0 +1,503 @@
+"""
+QP-BASIL - Caching of derived image data
+
+Processes are often re-run on the same session data with different options,
+so data derived from QpData objects (e.g. resampled calibration images, T1
+maps and PV estimates) is cached here rather than being recomputed each time.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+import os
+import glob
+import time
+import hashlib
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+# Number of voxel values hashed by a sampled fingerprint
+FINGERPRINT_SAMPLES = 4096
+
+def default_max_bytes(fraction=0.1, limit=2*1024*1024*1024):
+    """
+    Get a default size for an in-memory cache
+
+    :param fraction: Fraction of physical memory to use, where this can be determined
+    :param limit: Upper limit on the size in bytes
+    :return: Cache size in bytes
+    """
+    try:
+        physmem = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        return int(min(limit, physmem * fraction))
+    except (AttributeError, ValueError, OSError):
+        # sysconf not available, e.g. on Windows
+        return int(limit / 4)
+
+def _hash_array(digest, arr):
+    digest.update(str((arr.shape, arr.dtype.str)).encode("utf-8"))
+    if arr.ndim == 0 or arr.flags.c_contiguous:
+        digest.update(np.ascontiguousarray(arr).reshape(-1).view(np.uint8))
+    else:
+        # Hash one sub-array at a time so non-contiguous data (e.g. memory
+        # mapped from a NIFTI file) is not copied all at once
+        for subarr in arr:
+            digest.update(np.ascontiguousarray(subarr).reshape(-1).view(np.uint8))
+
+def data_fingerprint(arr, samples=None):
+    """
+    Get a fingerprint of the contents of an array
+
+    By default this reads all of the data so any in-place modification of the
+    array changes the fingerprint.
+
+    :param samples: If specified, only hash a regular sample of at most this many
+                    values. This is cheap for large arrays but only detects in-place
+                    modifications which change a sampled value
+    :return: Hex digest string
+    """
+    digest = hashlib.sha1()
+    if samples and arr.size > samples:
+        step = int(np.ceil(float(arr.size) / samples))
+        digest.update(str((arr.shape, arr.dtype.str, step)).encode("utf-8"))
+        _hash_array(digest, np.ascontiguousarray(arr.flat[::step]))
+    else:
+        _hash_array(digest, arr)
+    return digest.hexdigest()
+
+def content_hash(*items):
+    """
+    Get a hash of the full contents of a set of items
+
+    This is suitable for keying results which are expensive to compute and
+    stored persistently. Items may be Numpy arrays, fsl.data.image.Image
+    objects (including oxasl.AslImage), dictionaries, sequences or any other
+    object with a stable string representation.
+
+    :return: Hex digest string
+    """
+    digest = hashlib.sha1()
+    def _update(item):
+        if isinstance(item, np.ndarray):
+            _hash_array(digest, item)
+        elif hasattr(item, "voxToWorldMat"):
+            digest.update(str(item.name).encode("utf-8"))
+            _update(np.asarray(item.data))
+            _update(np.asarray(item.voxToWorldMat))
+        elif isinstance(item, dict):
+            for key in sorted(item.keys(), key=str):
+                _update(str(key))
+                _update(item[key])
+        elif isinstance(item, (list, tuple)):
+            digest.update(str(len(item)).encode("utf-8"))
+            for subitem in item:
+                _update(subitem)
+        else:
+            digest.update(repr(item).encode("utf-8"))
+    for item in items:
+        _update(item)
+    return digest.hexdigest()
+
+def data_key(qpd, samples=None):
+    """
+    Get a key identifying a QpData object and its current contents
+
+    The key changes if the object is replaced, if its voxel array is replaced
+    or if the array is modified in place. By default this hashes all of the
+    voxel data, so calculating it costs a full read of the array. With
+    ``samples`` it is cheap but only detects in-place modifications which
+    change a sampled value.
+
+    :param qpd: QpData object
+    :param samples: If specified, fingerprint the contents from a sample of
+                    this many values - see ``data_fingerprint``
+    :return: Hashable key
+    """
+    raw = qpd.raw()
+    return (id(qpd), raw.__array_interface__["data"][0], data_fingerprint(raw, samples))
+
+def grid_key(grid):
+    """
+    :return: Hashable key identifying a DataGrid
+    """
+    return (tuple(grid.shape), np.asarray(grid.affine, dtype=np.float64).tobytes())
+
+class ResampleCache(object):
+    """
+    Bounded LRU cache of QpData resampled onto different grids
+
+    Cached arrays are read-only so they can be shared between callers. Entries
+    are keyed on the source data contents and the source and target grids, so
+    modifying or replacing the source data invalidates them. Entries for a
+    QpData object are dropped when the object is garbage collected.
+
+    Each lookup hashes all of the source data (see ``data_key``), which is a
+    single sequential read of the source array. A cache hit therefore still
+    reads the source, but avoids the interpolation and the allocation of
+    the resampled array, which are the main costs of resampling. A sampled
+    fingerprint is not used because a stale resampled image would silently
+    change processing results.
+    """
+
+    def __init__(self, max_bytes=None):
+        """
+        :param max_bytes: Maximum total size of cached data. If not specified a
+                          default based on the amount of physical memory is used
+        """
+        if max_bytes is None:
+            max_bytes = default_max_bytes()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._refs = {}
+        self._lock = threading.RLock()
+
+    @property
+    def nbytes(self):
+        """ Total size of cached data in bytes """
+        return self._nbytes
+
+    def resample(self, qpd, grid):
+        """
+        Get the data from a QpData object resampled onto a grid
+
+        :param qpd: QpData object
+        :param grid: DataGrid to resample onto
+        :return: Tuple of (read-only Numpy array, True if this was a cache hit)
+        """
+        key = (data_key(qpd), grid_key(qpd.grid), grid_key(grid))
+        with self._lock:
+            data = self._entries.pop(key, None)
+            if data is not None:
+                self._entries[key] = data
+                self.hits += 1
+                return data, True
+            self.misses += 1
+
+        data = qpd.resample(grid).raw()
+        data.flags.writeable = False
+        with self._lock:
+            if key not in self._entries and data.nbytes <= self.max_bytes:
+                self._entries[key] = data
+                self._nbytes += data.nbytes
+                self._watch(qpd)
+                self._evict()
+        return data, False
+
+    def invalidate(self, qpd=None):
+        """
+        Remove cached data
+
+        :param qpd: If specified, remove only data derived from this QpData object
+        """
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if qpd is None or key[0][0] == id(qpd):
+                    self._remove(key)
+            if qpd is None:
+                self._refs = {}
+            else:
+                self._refs.pop(id(qpd), None)
+
+    def stats(self):
+        """
+        :return: Dictionary of cache statistics
+        """
+        return {
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "evictions" : self.evictions,
+            "entries" : len(self._entries),
+            "nbytes" : self._nbytes,
+            "max_bytes" : self.max_bytes,
+        }
+
+    def _watch(self, qpd):
+        qpd_id = id(qpd)
+        if qpd_id not in self._refs:
+            def _collected(_ref, qpd_id=qpd_id):
+                with self._lock:
+                    for key in list(self._entries.keys()):
+                        if key[0][0] == qpd_id:
+                            self._remove(key)
+                    self._refs.pop(qpd_id, None)
+            self._refs[qpd_id] = weakref.ref(qpd, _collected)
+
+    def _remove(self, key):
+        data = self._entries.pop(key)
+        self._nbytes -= data.nbytes
+
+    def _evict(self):
+        while self._nbytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+# Shared cache used by the QpData <-> oxasl conversion functions
+RESAMPLE_CACHE = ResampleCache()
+
+class Checkpoint(object):
+    """
+    On-disk checkpoint of a multi-step process
+
+    Stores the index of the last completed step and a set of arrays in
+    compact binary (``.npz``) format so that a run with identical inputs can be
+    resumed after a failure or cancellation. Checkpoints are identified by a key,
+    normally a ``content_hash`` of the inputs and options.
+    """
+
+    def __init__(self, key, dirname=None):
+        """
+        :param key: Key identifying the run, used as the directory name
+        :param dirname: Parent directory for checkpoints. Defaults to ``qp_checkpoints``
+                        in the system temporary directory
+        """
+        if dirname is None:
+            dirname = os.path.join(tempfile.gettempdir(), "qp_checkpoints")
+        self.key = key
+        self.dirname = os.path.join(dirname, key)
+        self.fname = os.path.join(self.dirname, "checkpoint.npz")
+
+    def save(self, step, **arrays):
+        """
+        Save a checkpoint, replacing any existing one
+
+        :param step: Number of steps completed
+        :param arrays: Named arrays to save
+        """
+        if not os.path.isdir(self.dirname):
+            os.makedirs(self.dirname)
+        tmpname = os.path.join(self.dirname, "checkpoint_tmp.npz")
+        with open(tmpname, "wb") as tmpfile:
+            np.savez(tmpfile, _step=np.array(step), **arrays)
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+        os.rename(tmpname, self.fname)
+
+    def load(self):
+        """
+        Load the checkpoint
+
+        :return: Tuple of (number of steps completed, dictionary of arrays) or None
+                 if there is no usable checkpoint
+        """
+        if not os.path.isfile(self.fname):
+            return None
+        try:
+            with np.load(self.fname) as npz:
+                arrays = dict((name, npz[name]) for name in npz.files if name != "_step")
+                return int(npz["_step"]), arrays
+        except (IOError, OSError, ValueError, KeyError):
+            # Corrupt or incomplete checkpoint - ignore it
+            return None
+
+    def clear(self):
+        """
+        Remove the checkpoint
+        """
+        shutil.rmtree(self.dirname, ignore_errors=True)
+
+    @classmethod
+    def expire(cls, dirname, max_age):
+        """
+        Remove checkpoints which have not been saved for a given time
+
+        Checkpoints are normally removed when the run completes, but a run which
+        fails and is never repeated leaves its checkpoint behind
+
+        :param dirname: Parent directory for checkpoints
+        :param max_age: Maximum age in seconds
+        :return: Number of checkpoints removed
+        """
+        removed = 0
+        cutoff = time.time() - max_age
+        for subdir in glob.glob(os.path.join(dirname, "*")):
+            try:
+                if os.path.isdir(subdir) and os.path.getmtime(subdir) < cutoff:
+                    shutil.rmtree(subdir, ignore_errors=True)
+                    removed += 1
+            except OSError:
+                # Removed by another process
+                pass
+        return removed
+
+def _dir_size(dirname):
+    total = 0
+    for dirpath, _, fnames in os.walk(dirname):
+        for fname in fnames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, fname))
+            except OSError:
+                pass
+    return total
+
+_result_cache_pins = {}
+_result_cache_lock = threading.RLock()
+
+class ResultCache(object):
+    """
+    Size-bounded on-disk cache of process output directories
+
+    Entries are keyed by a ``content_hash`` of the process inputs and options
+    and each is stored as a copy of the output directory, or the directory
+    itself if it was created with ``workdir``. When the total size exceeds
+    the limit the least recently used entries are removed.
+
+    Entries which are in use (e.g. memory mapped) can be pinned so they are not
+    removed. Pins are shared by all ``ResultCache`` objects on the same directory
+    in this process, but do not apply to other processes sharing the directory.
+    """
+
+    def __init__(self, dirname, max_bytes=10*1024*1024*1024):
+        """
+        :param dirname: Directory in which to store cached output
+        :param max_bytes: Maximum total size of cached output
+        """
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+        self._lock = _result_cache_lock
+        with self._lock:
+            self._pins = _result_cache_pins.setdefault(os.path.abspath(dirname), {})
+
+    def path(self, key):
+        """
+        :return: Directory for the entry with the given key (which may not exist)
+        """
+        return os.path.join(self.dirname, key)
+
+    def get(self, key):
+        """
+        Look up an entry, marking it as recently used
+
+        :return: Directory containing the cached output, or None if not cached
+        """
+        path = self.path(key)
+        if not os.path.isdir(path):
+            return None
+        self._touch(path)
+        return path
+
+    def _touch(self, path):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def workdir(self):
+        """
+        Create a working directory in the cache directory
+
+        This is not a cache entry, but it can be made into one by ``put`` with
+        ``move=True`` without copying any data
+
+        :return: Path to new directory
+        """
+        if not os.path.isdir(self.dirname):
+            os.makedirs(self.dirname)
+        return tempfile.mkdtemp(prefix=".work_", dir=self.dirname)
+
+    def put(self, key, srcdir, move=False, pin=False):
+        """
+        Store an output directory
+
+        :param key: Entry key
+        :param srcdir: Output directory
+        :param move: If True, move the directory into the cache rather than copying it.
+                     This is only done if it can be renamed (e.g. it was created by
+                     ``workdir``), otherwise the directory is not stored
+        :param pin: If True, pin the entry (see ``pin``)
+        :return: Directory containing the cached output, or None if it could not be stored
+        """
+        size = _dir_size(srcdir)
+        if size > self.max_bytes:
+            return None
+
+        with self._lock:
+            path = self.path(key)
+            if not os.path.isdir(path):
+                if not os.path.isdir(self.dirname):
+                    os.makedirs(self.dirname)
+                try:
+                    if move:
+                        os.rename(srcdir, path)
+                    else:
+                        # Copy to a temporary name first so a partial copy is never used
+                        tmppath = tempfile.mkdtemp(prefix=".tmp_", dir=self.dirname)
+                        try:
+                            shutil.rmtree(tmppath)
+                            shutil.copytree(srcdir, tmppath)
+                            os.rename(tmppath, path)
+                        except (IOError, OSError):
+                            shutil.rmtree(tmppath, ignore_errors=True)
+                            raise
+                except (IOError, OSError):
+                    return None
+            else:
+                self._touch(path)
+            if pin:
+                self._pins[key] = self._pins.get(key, 0) + 1
+            self._evict(keep=key)
+        return path
+
+    def pin(self, key):
+        """
+        Look up an entry and prevent it from being removed until it is unpinned
+
+        Entries may be pinned more than once and are removed only when they have
+        been unpinned the same number of times
+
+        :return: Directory containing the cached output, or None if not cached
+        """
+        with self._lock:
+            path = self.get(key)
+            if path is not None:
+                self._pins[key] = self._pins.get(key, 0) + 1
+            return path
+
+    def unpin(self, key):
+        """
+        Allow a pinned entry to be removed
+        """
+        with self._lock:
+            count = self._pins.pop(key, 0) - 1
+            if count > 0:
+                self._pins[key] = count
+            self._evict()
+
+    def entries(self):
+        """
+        :return: List of (key, size in bytes, last used time) for cached entries, least recently used first
+        """
+        if not os.path.isdir(self.dirname):
+            return []
+        entries = []
+        for key in os.listdir(self.dirname):
+            path = self.path(key)
+            if key.startswith(".") or not os.path.isdir(path):
+                continue
+            entries.append((key, _dir_size(path), os.path.getmtime(path)))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def clear(self):
+        """
+        Remove all cached entries which are not pinned
+        """
+        with self._lock:
+            for key, _, _ in self.entries():
+                if key not in self._pins:
+                    shutil.rmtree(self.path(key), ignore_errors=True)
+
+    def _evict(self, keep=None):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if key != keep and key not in self._pins:
+                shutil.rmtree(self.path(key), ignore_errors=True)
+                total -= size
@@ -0,0 +1,246 @@
+"""
+QP-BASIL - Incremental calibration of perfusion data
+
+Calibration divides perfusion data by an estimate of M0 and by the inversion
+efficiency, and multiplies by a constant to give physical units. Variance data
+is scaled by the square of the same factor. Estimating
+M0 can be expensive (e.g. edge correction of a voxelwise M0 map, or fitting
+within a reference region), so the M0 estimate returned by oxasl is cached
+keyed on the calibration data and the options it was calculated with.
+
+Corrections which only multiply M0 by a constant (calibration gain, short TR
+correction and partition coefficient) are applied to the cached estimate
+rather than being included in its options. Changing these, the inversion
+efficiency or the multiplier, or calibrating other data with the same M0,
+then only requires the calibrated data to be rescaled.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+from __future__ import division
+
+import math
+import numbers
+import threading
+from collections import OrderedDict
+
+import six
+import numpy as np
+
+from .cache import content_hash
+
+# Number of M0 estimates which are cached
+M0_CACHE_SIZE = 4
+
+_m0_cache = OrderedDict()
+_m0_cache_lock = threading.Lock()
+
+def estimate_m0(calib_img, options, log=None):
+    """
+    Estimate M0 using oxasl
+
+    :param calib_img: fsl.data.image.Image containing calibration data
+    :param options: Dictionary of oxasl calibration options
+    :param log: Stream for log output
+    :return: Voxelwise M0 as a Numpy array, or a single M0 value
+    """
+    from oxasl import Workspace, calib
+    if log is None:
+        log = six.StringIO()
+    wsp = Workspace(log=log, **options)
+    wsp.calib = calib_img
+    calib.init(wsp)
+    calib.calculate_m0(wsp)
+    m0 = wsp.calibration.m0
+    if hasattr(m0, "data"):
+        return np.array(m0.data, dtype=np.float64)
+    return float(m0)
+
+def _option(options, key, default):
+    value = options.get(key, None)
+    if value is None:
+        return default
+    return value
+
+def m0_factors(options):
+    """
+    Separate calibration options which only scale the M0 estimate
+
+    This follows the M0 calculation in ``oxasl.calib``. For voxelwise calibration
+    M0 is the calibration data (edge corrected if required) multiplied by the gain
+    and short TR correction and divided by the partition coefficient. For reference
+    region calibration with a fixed reference T1 it is the mean signal in the
+    reference region multiplied by the gain and T1 and T2 corrections and divided
+    by the reference partition coefficient. Other methods are not separated.
+
+    :param options: Dictionary of oxasl calibration options
+    :return: Tuple of (options for the base M0 estimate, factor to multiply it by)
+    """
+    base_options = dict(options)
+    factor = 1.0
+    method = options.get("calib_method", None)
+    if method in ("voxel", "voxelwise"):
+        gain = _option(base_options, "calib_gain", 1.0)
+        pct = _option(base_options, "pct", 0.9)
+        tr, t1 = options.get("tr", None), options.get("t1", None)
+        for key in ("calib_gain", "tr", "t1"):
+            base_options.pop(key, None)
+        base_options["pct"] = 1.0
+        # Not used by the oxasl M0 estimate, which takes the tissue T1 from ``t1``
+        base_options.pop("t1t", None)
+        if pct == 0:
+            raise ValueError("Partition coefficient must not be zero")
+
+        shorttr = 1.0
+        if tr is not None and tr < 5 and t1 is not None:
+            shorttr = 1 / (1 - math.exp(-tr / t1))
+        factor = gain * shorttr / pct
+    elif method in ("refregion", "single"):
+        factor = _option(base_options, "calib_gain", 1.0)
+        base_options.pop("calib_gain", None)
+
+        # The reference partition coefficient defaults to a value for the tissue type
+        pcr = options.get("pcr", None)
+        if isinstance(pcr, numbers.Number):
+            if pcr == 0:
+                raise ValueError("Partition coefficient must not be zero")
+            factor /= pcr
+            base_options["pcr"] = 1.0
+
+        # The T1 correction can only be separated if the reference T1 is a fixed
+        # value rather than an image. An infinite TR gives a base correction of 1
+        t1r = options.get("t1r", None)
+        if isinstance(t1r, numbers.Number):
+            tr, taq = _option(options, "tr", 3.2), _option(options, "taq", 0)
+            factor /= 1 - math.exp(-(tr - taq) / t1r)
+            base_options["tr"] = float("inf")
+    return base_options, factor
+
+def cached_m0(calib_img, options, log=None):
+    """
+    Estimate M0, caching the result
+
+    The cache is keyed on the contents of the calibration image and of any images
+    in the options (e.g. masks), and on the other options
+
+    :return: Voxelwise M0 as a read-only Numpy array, or a single M0 value
+    """
+    key = content_hash(calib_img, options)
+    with _m0_cache_lock:
+        m0 = _m0_cache.pop(key, None)
+        if m0 is not None:
+            _m0_cache[key] = m0
+            if log is not None:
+                log.write(" - Using previously calculated M0\n")
+            return m0
+
+    m0 = estimate_m0(calib_img, options, log)
+    if isinstance(m0, np.ndarray):
+        m0.flags.writeable = False
+    with _m0_cache_lock:
+        _m0_cache[key] = m0
+        while len(_m0_cache) > M0_CACHE_SIZE:
+            _m0_cache.popitem(last=False)
+    return m0
+
+def calibration_scale(m0, multiplier=1.0, alpha=1.0):
+    """
+    Get the scale which converts perfusion data into calibrated units
+
+    :param m0: Voxelwise M0 array or single M0 value
+    :param multiplier: Constant to convert output to physical units
+    :param alpha: Inversion efficiency
+    :return: Voxelwise array or single value. Where voxelwise M0 is not positive
+             the scale is zero
+    """
+    const = multiplier / alpha
+    if isinstance(m0, np.ndarray):
+        scale = np.zeros(m0.shape, dtype=np.float64)
+        valid = m0 > 0
+        scale[valid] = const / m0[valid]
+        return scale
+    return const / m0
+
+def apply_scale(data, scale):
+    """
+    Calibrate perfusion data
+
+    :param data: Numpy array of perfusion data. A 4D array is calibrated volume by volume
+    :param scale: Scale from ``calibration_scale``
+    :return: New array of calibrated data
+    """
+    if isinstance(scale, np.ndarray) and data.ndim > scale.ndim:
+        scale = scale.reshape(scale.shape + (1,) * (data.ndim - scale.ndim))
+    return np.multiply(data, scale, dtype=np.float64)
+
+def calibrate_many(arrays, scale, multipliers=None, variances=None):
+    """
+    Calibrate a number of perfusion data sets with the same scale
+
+    Data sets with the same shape as a voxelwise scale are stacked and calibrated
+    with a single multiplication, so the scale is only read once however many
+    data sets there are.
+
+    Variance data is calibrated with the square of the scale and multiplier. This
+    is computed once and shared by all variance data sets
+
+    :param arrays: Sequence of Numpy arrays
+    :param scale: Scale from ``calibration_scale``, usually with a multiplier of 1
+    :param multipliers: Sequence of constants to multiply each calibrated data set by.
+                        If not specified, 1 is used for all data sets
+    :param variances: Sequence of flags which are True for data sets which are variances.
+                      If not specified, no data sets are variances
+    :return: List of new arrays of calibrated data
+    """
+    if multipliers is None:
+        multipliers = [1.0] * len(arrays)
+    if variances is None:
+        variances = [False] * len(arrays)
+    outputs = [None] * len(arrays)
+
+    for var in (False, True):
+        group = [idx for idx in range(len(arrays)) if bool(variances[idx]) == var]
+        if not group:
+            continue
+        if var:
+            _calibrate_group(arrays, group, np.square(scale), [multipliers[idx]**2 for idx in group], outputs)
+        else:
+            _calibrate_group(arrays, group, scale, [multipliers[idx] for idx in group], outputs)
+    return outputs
+
+def _calibrate_group(arrays, group, scale, consts, outputs):
+    shape = np.shape(scale)
+    stacked = [pos for pos, idx in enumerate(group) if shape and arrays[idx].shape == shape]
+    if len(stacked) > 1:
+        data = np.stack([arrays[group[pos]] for pos in stacked])
+        stack_consts = np.array([consts[pos] for pos in stacked], dtype=np.float64)
+        calibrated = np.multiply(data, scale[np.newaxis, ...] * stack_consts.reshape((-1,) + (1,) * len(shape)),
+                                 dtype=np.float64)
+        for stack_idx, pos in enumerate(stacked):
+            outputs[group[pos]] = calibrated[stack_idx]
+
+    for pos, idx in enumerate(group):
+        if outputs[idx] is None:
+            outputs[idx] = apply_scale(arrays[idx], scale * consts[pos])
+
+def calibrate_data(calib_img, m0_options, arrays, multipliers=None, variances=None, alpha=1.0):
+    """
+    Calibrate a number of perfusion data sets using a common M0 estimate
+
+    This does not access Quantiphyse data so may be run in a background thread
+
+    :param calib_img: fsl.data.image.Image containing calibration data
+    :param m0_options: Dictionary of oxasl calibration options
+    :param arrays: Sequence of Numpy arrays, see ``calibrate_many``
+    :param multipliers: Sequence of constants to multiply each calibrated data set by
+    :param variances: Sequence of flags which are True for data sets which are variances
+    :param alpha: Inversion efficiency
+    :return: Tuple of list of new arrays of calibrated data, log output
+    """
+    log = six.StringIO()
+    base_options, factor = m0_factors(m0_options)
+    m0 = cached_m0(calib_img, base_options, log=log)
+    if factor != 1:
+        log.write(" - M0 correction factor (gain, TR and partition coefficient): %f\n" % factor)
+        m0 = m0 * factor
+    scale = calibration_scale(m0, alpha=alpha)
+    return calibrate_many(arrays, scale, multipliers, variances), log.getvalue()
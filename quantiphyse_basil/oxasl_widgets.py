@@ -18,7 +18,6 @@ from quantiphyse.gui.widgets import QpWidget, TitleWidget, Citation, RunWidget,
 from quantiphyse.utils import get_plugins
 
 from .aslimage_widget import AslImageWidget
-from .veasl_widgets import VeslocsWidget, EncodingWidget, PriorsWidget, ClasslistWidget, veslocs_default
 
 from ._version import __version__, __license__
 
@@ -344,6 +343,9 @@ class VeaslOptions(OxaslOptionWidget):
         OxaslOptionWidget.__init__(self, ivm)
 
     def _init_ui(self):
+        # These use pyqtgraph so are only imported when VE data is being processed
+        from .veasl_widgets import VeslocsWidget, EncodingWidget, PriorsWidget, ClasslistWidget, veslocs_default
+
         nfpc = self.optbox.add("Sources per class", NumericOption(intonly=True, default=2, slider=False), key="nfpc")
         nfpc.sig_changed.connect(self._nfpc_changed)
 
@@ -385,10 +387,14 @@ class VeaslOptions(OxaslOptionWidget):
         self.vessels.initial = veslocs_default
   
     def _data_changed(self):
-        if self._data_widget.md["iaf"] == "ve":
-            data = self._data_widget.data
-            if data is not None:
-                self.encoding.nenc = self._data_widget.md.get("nenc", 8)
+        self.set_asldata_metadata(self._data_widget.md)
+
+    def set_asldata_metadata(self, md):
+        """
+        Set the number of encodings from the metadata of vessel encoded data
+        """
+        if md.get("iaf", None) == "ve" and self._data_widget.data is not None:
+            self.encoding.nenc = md.get("nenc", 8)
 
     def _method_changed(self):
         mcmc = self.optbox.option("method").value == "MCMC"
@@ -549,12 +555,13 @@ class OxaslWidget(QpWidget):
         self.preproc.sig_enable_tab.connect(self._enable_tab)
         self.tabs.addTab(self.preproc, "Corrections")
 
-        # Only add these if appropriate
-        self._optional_tabs = {
-            "veasl" :  VeaslOptions(self.ivm, self.asldata),
-            "enable" : EnableOptions(self.ivm),
-            "deblur" : DeblurOptions(),
+        # Only add these if appropriate. They are not created until they are first needed
+        self._optional_tab_factories = {
+            "veasl" :  lambda: VeaslOptions(self.ivm, self.asldata),
+            "enable" : lambda: EnableOptions(self.ivm),
+            "deblur" : DeblurOptions,
         }
+        self._optional_tabs = {}
 
         self.structural = StructuralData(self.ivm)
         self.tabs.addTab(self.structural, "Structural data")
@@ -587,11 +594,27 @@ class OxaslWidget(QpWidget):
             tab.set_asldata_metadata(self.asldata.md)
 
     def _enable_tab(self, name, enable):
-        widget = self._optional_tabs[name]
+        widget = self._optional_tabs.get(name, None)
+        if widget is None:
+            if not enable:
+                return
+            widget = self._create_tab(name)
         self.tabs.removeTab(self.tabs.indexOf(widget))
         if enable:
             self.tabs.insertTab(self.tabs.indexOf(self.preproc)+1, widget, name.title())
 
+    def _create_tab(self, name):
+        """
+        Create an optional tab when it is first enabled, and bring it up to date
+        with the current data and white paper mode
+        """
+        widget = self._optional_tab_factories[name]()
+        self._optional_tabs[name] = widget
+        if self.asldata.md:
+            widget.set_asldata_metadata(self.asldata.md)
+        widget.set_wp_mode(self.analysis.optbox.option("wp").value)
+        return widget
+
     def _enabled_tabs(self):
         tabs = [self.preproc, self.structural, self.calibration, self.analysis, self.output]
         for tab in self._optional_tabs.values():
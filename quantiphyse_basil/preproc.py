@@ -0,0 +1,214 @@
+"""
+QP-BASIL - Preprocessing operations on ASL data
+
+Preprocessing (label-control subtraction, reordering and averaging) is applied
+independently to each voxel, so as well as processing the whole data set at
+once it can be streamed through in chunks of slices. This bounds the memory
+required by the chunk size rather than the number of volumes in the data.
+
+The operations are also linear in the volume data, so any sequence of them
+can be compiled into a single matrix (or index array) mapping input volumes
+to output volumes - see ``PreprocPlan``. The plan is derived by applying the
+oxasl operations to an identity 'probe' image, so it always matches the
+ordering and averaging semantics of oxasl itself.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+import tempfile
+
+import numpy as np
+
+from .transfer import mapped_data
+
+# Default size of a chunk of input data when streaming, in bytes
+DEFAULT_CHUNK_BYTES = 256*1024*1024
+
+# Maximum number of volumes for which a PreprocPlan will be compiled. The
+# probe image used to compile it has size proportional to the square of this
+MAX_PLAN_VOLS = 2048
+
+def preproc_ops(options):
+    """
+    Get the sequence of preprocessing operations requested in process options
+
+    :param options: Process options. Recognized options are removed
+    :return: Sequence of (operation name, argument) tuples
+    """
+    ops = []
+    if options.pop("diff", False):
+        ops.append(("diff", None))
+
+    new_order = options.pop("reorder", None)
+    if new_order is not None:
+        ops.append(("reorder", new_order))
+
+    mean, pwi = options.pop("mean", False), options.pop("pwi", False)
+    if mean:
+        ops.append(("mean", None))
+    elif pwi:
+        ops.append(("pwi", None))
+    return ops
+
+def apply_ops(aslimage, ops):
+    """
+    Apply preprocessing operations to an oxasl.AslImage
+
+    :param aslimage: oxasl.AslImage
+    :param ops: Sequence of (operation name, argument) tuples
+    :return: Preprocessed oxasl.AslImage, or fsl.data.image.Image for a perfusion weighted image
+    """
+    for op, arg in ops:
+        if op == "diff":
+            aslimage = aslimage.diff()
+        elif op == "reorder":
+            aslimage = aslimage.reorder(arg)
+        elif op == "mean":
+            aslimage = aslimage.mean_across_repeats()
+        elif op == "pwi":
+            aslimage = aslimage.perf_weighted()
+        else:
+            raise ValueError("Unknown preprocessing operation: %s" % op)
+    return aslimage
+
+class PreprocPlan(object):
+    """
+    Sequence of preprocessing operations compiled into a single linear map between volumes
+
+    Output volume ``j`` is ``sum_i weights[j, i] * input volume i``. Where every
+    output volume is just a copy of an input volume (e.g. reordering) the plan
+    is stored as an index array. Where each output volume is a difference of two
+    input volumes (label-control subtraction) it is stored as two index arrays.
+    Otherwise each output volume is stored as the indices and weights of the
+    input volumes it uses, so a non-finite input value only affects the outputs
+    which use it, as with the oxasl operations.
+
+    The output has the same data type as oxasl would produce, i.e. the input data
+    type if the operations only reorder the data, and double precision otherwise.
+    """
+
+    def __init__(self, metadata, nvols, ops, name="asldata"):
+        """
+        :param metadata: ``AslData`` metadata for the input data
+        :param nvols: Number of input volumes
+        :param ops: Sequence of (operation name, argument) tuples
+        :param name: Name of input data
+        """
+        from oxasl import AslImage
+        probe = AslImage(np.eye(nvols).reshape((nvols, 1, 1, nvols)), name=name, **metadata)
+        self.template = apply_ops(probe, ops)
+        self.nvols = nvols
+        self.weights = np.asarray(self.template.data).reshape((nvols, -1)).T
+        self.out_shape = tuple(self.template.shape[3:])
+        self.index, self.pos, self.neg, self.terms = None, None, None, None
+
+        nonzero = self.weights != 0
+        counts = np.count_nonzero(nonzero, axis=1)
+        if np.all(counts == 1) and np.all(self.weights[nonzero] == 1):
+            self.index = np.argmax(self.weights, axis=1)
+        elif np.all(counts == 2) and np.all(np.sort(self.weights, axis=1)[:, [0, -1]] == [-1, 1]):
+            self.pos = np.argmax(self.weights, axis=1)
+            self.neg = np.argmin(self.weights, axis=1)
+        else:
+            self.terms = [(np.flatnonzero(row), row[row != 0]) for row in self.weights]
+
+        # Check whether the operations preserve the input data type using a single voxel
+        dtype_probe = AslImage(np.zeros((1, 1, 1, nvols), dtype=np.float32), name=name, **metadata)
+        self.preserve_dtype = np.asarray(apply_ops(dtype_probe, ops).data).dtype == np.float32
+
+    @classmethod
+    def compile(cls, metadata, nvols, ops, name="asldata"):
+        """
+        Compile a plan if possible
+
+        :return: PreprocPlan or None if there are no operations or too many volumes
+        """
+        if not ops or nvols > MAX_PLAN_VOLS:
+            return None
+        return cls(metadata, nvols, ops, name)
+
+    @property
+    def name(self):
+        """ Name of the output data """
+        return self.template.name
+
+    def apply(self, data):
+        """
+        Apply the plan to ASL data in a single vectorised pass
+
+        :param data: Array whose last dimension is volumes
+        :return: Output array with the same spatial dimensions
+        """
+        if data.ndim == 3:
+            data = data[..., np.newaxis]
+        spatial = data.shape[:-1]
+        dtype = data.dtype if self.preserve_dtype else np.float64
+        if self.index is not None:
+            out = np.take(data, self.index, axis=-1).astype(dtype, copy=False)
+        elif self.pos is not None:
+            out = np.subtract(np.take(data, self.pos, axis=-1), np.take(data, self.neg, axis=-1), dtype=dtype)
+        else:
+            out = np.empty(spatial + (len(self.terms),), dtype=dtype)
+            for vol, (index, weights) in enumerate(self.terms):
+                out[..., vol] = np.dot(np.take(data, index, axis=-1), weights)
+        return out.reshape(spatial + self.out_shape)
+
+def output_array(shape, dtype, dirname=None):
+    """
+    Create an output array backed by an anonymous temporary file
+
+    The file is deleted when it is closed, i.e. when the array is no longer
+    referenced, so no cleanup is required.
+
+    :param shape: Array shape
+    :param dtype: Array data type
+    :param dirname: Directory for the temporary file, if not the system default
+    :return: Numpy memmap array
+    """
+    return np.memmap(tempfile.TemporaryFile(dir=dirname), dtype=dtype, mode="w+", shape=shape)
+
+def chunk_slices(shape, itemsize, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    :return: Number of slices in a chunk of at most ``chunk_bytes`` (always at least 1)
+    """
+    slice_bytes = int(np.prod(shape[:2] + shape[3:])) * itemsize
+    return int(max(1, min(shape[2], chunk_bytes // max(1, slice_bytes))))
+
+def stream_preproc(qpd, metadata, ops, chunk_bytes=DEFAULT_CHUNK_BYTES, dirname=None, plan=None):
+    """
+    Apply preprocessing operations to ASL data one chunk of slices at a time
+
+    The input data is memory mapped where possible and the output is written to
+    a memory mapped temporary file, so the memory used is bounded by the chunk size.
+
+    :param qpd: QpData containing ASL data
+    :param metadata: ``AslData`` metadata for the data
+    :param ops: Sequence of (operation name, argument) tuples
+    :param chunk_bytes: Maximum size of each chunk of input data
+    :param dirname: Directory for the output file, if not the system default
+    :param plan: Optional ``PreprocPlan`` compiled from ``ops``. If given it is
+                 used to process each chunk rather than the oxasl operations
+    :return: Tuple of (output data array, result of applying ``ops`` to the first chunk
+             or the plan's template). The second item can be used to obtain the output
+             name and metadata
+    """
+    from oxasl import AslImage
+    src = mapped_data(qpd)
+    if src.ndim == 3:
+        src = src[..., np.newaxis]
+    nslices = chunk_slices(src.shape, src.dtype.itemsize, chunk_bytes)
+    out, template = None, None
+    for start in range(0, src.shape[2], nslices):
+        chunk = src[:, :, start:start+nslices, ...]
+        if plan is not None:
+            template = plan.template
+            result = plan.apply(chunk)
+        else:
+            result = apply_ops(AslImage(np.array(chunk), name=qpd.name, xform=qpd.grid.affine, **metadata), ops)
+            if template is None:
+                template = result
+            result = result.data
+        if out is None:
+            out = output_array(src.shape[:3] + tuple(template.shape[3:]), result.dtype, dirname)
+        out[:, :, start:start+nslices, ...] = result.reshape(out[:, :, start:start+nslices, ...].shape)
+    out.flush()
+    return out, template
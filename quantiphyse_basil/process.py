@@ -28,44 +28,244 @@ import tempfile
 import shutil
 import os
 import glob
+import time
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
 
 import six
-import pandas as pd
+import numpy as np
 
-from quantiphyse.data import DataGrid, NumpyData, QpData, load
+from quantiphyse.data import DataGrid, NumpyData, ImageVolumeManagement
 from quantiphyse.data.extras import MatrixExtra, DataFrameExtra
 from quantiphyse.utils import get_plugins, QpException, load_matrix
 from quantiphyse.utils.batch import Script
 from quantiphyse.processes import Process
 from quantiphyse.utils.cmdline import OutputStreamMonitor, LogProcess
 
+from .cache import RESAMPLE_CACHE, Checkpoint, ResultCache, content_hash, default_max_bytes
+from .calibration import calibrate_data
+from .preproc import PreprocPlan, preproc_ops, apply_ops, stream_preproc, DEFAULT_CHUNK_BYTES
+from .profiling import StepProfiler, StageMonitor, io_bytes as profile_io_bytes
+from .transfer import SharedImage, SharedImageData, SharedDir, mapped_data, data_nbytes, nifti_descriptors
 from .multiphase_template import BIASCORR_MC_YAML, BASIC_YAML, DELETE_TEMP
 
 METADATA_ATTRS = ["iaf", "ibf", "order", "tis", "plds", "rpts", "taus", "tau", "bolus", "casl", "nphases", "nenc", "slicedt", "sliceband"]
 
-def qpdata_to_fslimage(qpd, grid=None):
+def borrow_array(arr, copy=False, io_stats=None):
+    """
+    Get an array for use in an fslpy/oxasl image derived from QpData
+
+    By default the returned array is a read-only view which shares memory with
+    ``arr``. This gives copy-on-write semantics - derived objects which only read
+    the data cost nothing, and anything which tries to modify it in place fails
+    rather than silently changing the source data. Code which needs to write to the
+    data should request a copy.
+
+    :param arr: Numpy array
+    :param copy: If True, always return an independent writeable copy
+    :param io_stats: Optional dictionary in which borrowed/copied bytes are counted
+    :return: Tuple of (array, copied) where ``copied`` is True if new memory was allocated
+    """
+    if copy:
+        ret = np.array(arr)
+    else:
+        ret = arr.view()
+        ret.flags.writeable = False
+    record_io(io_stats, ret.nbytes, copy)
+    return ret, copy
+
+def record_io(io_stats, nbytes, copied):
+    """
+    Record borrowed or copied image data in an IO statistics dictionary
+
+    :param io_stats: Dictionary to update, or None to do nothing
+    :param nbytes: Number of bytes of data involved
+    :param copied: True if the data was copied, False if it was shared
+    """
+    if io_stats is not None:
+        key = "copied" if copied else "borrowed"
+        io_stats[key] = io_stats.get(key, 0) + nbytes
+        io_stats[key + "_count"] = io_stats.get(key + "_count", 0) + 1
+
+def io_summary(io_stats):
+    """
+    :return: Human readable summary of an IO statistics dictionary
+    """
+    return "Image data shared: %.1f Mb in %i items, copied: %.1f Mb in %i items, resample cache: %s" % (
+        float(io_stats.get("borrowed", 0)) / 1e6, io_stats.get("borrowed_count", 0),
+        float(io_stats.get("copied", 0)) / 1e6, io_stats.get("copied_count", 0),
+        RESAMPLE_CACHE.stats(),
+    )
+
+def _grid_data(qpd, grid, copy, io_stats):
+    """
+    Get the voxel data for QpData on a grid, avoiding copies where possible
+
+    Data loaded from an uncompressed NIFTI file is memory mapped from the file
+    (see ``mapped_data``) so only the parts of it which are used are read into
+    memory. Resampled data comes from ``RESAMPLE_CACHE`` so repeated runs on the
+    same data do not resample it again.
+
+    :return: Tuple of (array, affine, copied)
+    """
+    if grid is None or qpd.grid.matches(grid):
+        data, copied = borrow_array(mapped_data(qpd), copy, io_stats)
+        return data, qpd.grid.affine, copied
+    else:
+        data, hit = RESAMPLE_CACHE.resample(qpd, grid)
+        record_io(io_stats, data.nbytes, not hit)
+        if copy:
+            data, _ = borrow_array(data, copy, io_stats)
+        return data, grid.affine, copy or not hit
+
+def _check_shared(img, data, copied, io_stats):
+    """
+    Check whether an fslpy image is still sharing the array it was created from
+
+    fslpy may copy the data, e.g. to convert it to a NIFTI-compatible data type,
+    so we record this as a copy.
+    """
+    if not copied and not np.may_share_memory(img.data, data):
+        record_io(io_stats, data.nbytes, True)
+
+def qpdata_to_fslimage(qpd, grid=None, copy=False, io_stats=None):
     """ 
     Convert QpData to fsl.data.image.Image
+
+    The image shares the voxel data of the QpData object where possible - see
+    ``borrow_array``. A copy is always made when resampling to a different grid.
+
+    :param qpd: QpData object
+    :param grid: Optional DataGrid to resample onto
+    :param copy: If True, the image will have an independent writeable copy of the data
+    :param io_stats: Optional dictionary in which borrowed/copied bytes are counted
     """
     from fsl.data.image import Image
-    if grid is None:
-        return Image(qpd.raw(), name=qpd.name, xform=qpd.grid.affine)
-    else:
-        return Image(qpd.resample(grid), name=qpd.name, xform=grid.affine)
-        
-def fslimage_to_qpdata(img, name=None):
-    """ Convert fsl.data.image.Image to QpData """
-    if not name: name = img.name
-    return NumpyData(img.data, grid=DataGrid(img.shape[:3], img.voxToWorldMat), name=name)
+    data, affine, copied = _grid_data(qpd, grid, copy, io_stats)
+    img = Image(data, name=qpd.name, xform=affine)
+    _check_shared(img, data, copied, io_stats)
+    return img
 
-def qpdata_to_aslimage(qpd, options=None, metadata=None, grid=None):
+def fslimage_to_qpdata(img, name=None, io_stats=None):
     """ 
-    Convert QpData to oxasl.AslImage using stored metadata where available 
+    Convert fsl.data.image.Image to QpData
+
+    The image data is not copied unless it is a read-only array borrowed from
+    another QpData object, in which case the copy is made here so the new
+    QpData object is independent of its source.
+    """
+    if not name: name = img.name
+    data = img.data
+    if not data.flags.writeable:
+        data = np.array(data)
+        record_io(io_stats, data.nbytes, True)
+    return NumpyData(data, grid=DataGrid(img.shape[:3], img.voxToWorldMat), name=name)
+
+def _as_list(val, dtype):
+    if isinstance(val, six.string_types):
+        return [dtype(item) for item in val.split(",")]
+    elif isinstance(val, (int, float, np.number)):
+        return [dtype(val),]
+    return list(val)
+
+def validate_asl_metadata(md, nvols):
     """
+    Check ASL metadata is consistent with the number of volumes in the data
+
+    This follows the checks made when creating an oxasl.AslImage, including the
+    parsing of comma-separated strings, but only uses the number of volumes, so
+    it is cheap enough to do on every metadata change
 
+    :param md: Metadata dictionary
+    :param nvols: Number of volumes in the data
+    :return: Dictionary describing the data structure: ``iaf``, ``order``, ``ntc``
+             (number of labelling images), ``ntes``, ``ntis`` and ``rpts``
+    :raise ValueError: If the metadata is insufficient or inconsistent
+    """
+    from oxasl.image import data_order
+    tes = md.get("tes", None)
+    ntes = 1 if tes is None else len(_as_list(tes, float))
+    if ntes > 1:
+        iaf, order, _ = data_order(md.get("iaf", None), md.get("ibf", None), md.get("order", None), True)
+    else:
+        iaf, order, _ = data_order(md.get("iaf", None), md.get("ibf", None), md.get("order", None))
+    iaf = iaf.lower()
+
+    if iaf in ("tc", "ct"):
+        ntc = 2
+    elif iaf == "mp":
+        phases, nphases = md.get("phases", None), md.get("nphases", None)
+        if phases is None and nphases is None:
+            raise ValueError("Multiphase data specified but number of phases not given")
+        elif phases is not None:
+            # As in oxasl, this compares with the phases as given, before any string is split
+            if nphases is not None and nphases != len(phases):
+                raise ValueError("Number of phases is not consistent with length of phases list")
+            ntc = len(_as_list(phases, float))
+        else:
+            ntc = int(nphases)
+    elif iaf in ("ve", "vediff"):
+        nenc = md.get("nenc", md.get("ntc", None))
+        if nenc is None:
+            raise ValueError("Vessel encoded data specified but number of encoding cycles not given")
+        elif iaf == "ve":
+            ntc = int(nenc)
+        elif nenc % 2 == 0:
+            ntc = int(nenc) // 2
+        else:
+            raise ValueError("Subtracted vessel encoded data must have had an even number of encoding cycles")
+    else:
+        ntc = 1
+
+    tis, plds = md.get("tis", None), md.get("plds", None)
+    if tis is not None and plds is not None:
+        raise ValueError("Cannot specify PLDs and TIs at the same time")
+    ntis = md.get("ntis", None)
+    if md.get("nplds", None) is not None:
+        ntis = md["nplds"]
+    if plds is not None:
+        tis = plds
+    if tis is not None:
+        ntis = len(_as_list(tis, float))
+    elif ntis is None:
+        raise ValueError("Number of TIs/PLDs not specified")
+    ntis = int(ntis)
+
+    nvols_norpts = ntc * ntis * ntes
+    rpts = md.get("rpts", md.get("nrpts", None))
+    if rpts is None:
+        if nvols_norpts == 0 or nvols % nvols_norpts != 0:
+            raise ValueError("Data contains %i volumes, inconsistent with %i TIs and %i labelling images at %i TEs" % (nvols, ntis, ntc, ntes))
+        rpts = [nvols // nvols_norpts] * ntis
+    else:
+        rpts = _as_list(rpts, int)
+        if len(rpts) == 1:
+            rpts *= ntis
+        elif len(rpts) != ntis:
+            raise ValueError("%i TIs specified, inconsistent with %i variable repeats" % (ntis, len(rpts)))
+        if sum(rpts) * ntc * ntes != nvols:
+            raise ValueError("Data contains %i volumes, inconsistent with %i labelling images at %i TEs and total of %i repeats" % (nvols, ntc, ntes, sum(rpts)))
+
+    taus = md.get("bolus", md.get("taus", md.get("tau", None)))
+    if taus is not None:
+        taus = _as_list(taus, float)
+        if len(taus) not in (1, ntis):
+            raise ValueError("%i bolus durations specified, inconsistent with %i TIs/PLDs" % (len(taus), ntis))
+
+    return {"iaf" : iaf, "order" : order, "ntc" : ntc, "ntes" : ntes, "ntis" : ntis, "rpts" : rpts}
+
+def qpdata_to_aslmetadata(qpd, options=None, metadata=None):
+    """
+    Get the ASL metadata for QpData using stored metadata where available
+
+    :param options: If provided, metadata options are removed from this dictionary
+                    and override the existing metadata
+    :return: Metadata dictionary
+    """
     # If metadata is not provided, get the existing metadata
     if metadata is None:
-        metadata = qpd.metadata.get("AslData", {})
+        metadata = dict(qpd.metadata.get("AslData", {}))
     
     # If options are provided, use them to override existing metadata
     if options:
@@ -75,13 +275,23 @@ def qpdata_to_aslimage(qpd, options=None, metadata=None, grid=None):
                 metadata[opt] = val
             else:
                 metadata.pop(opt, None)
+    return metadata
+
+def qpdata_to_aslimage(qpd, options=None, metadata=None, grid=None, copy=False, io_stats=None):
+    """ 
+    Convert QpData to oxasl.AslImage using stored metadata where available 
+
+    As with ``qpdata_to_fslimage`` the voxel data is shared with the QpData
+    object where possible, or memory mapped if it was loaded from an uncompressed
+    NIFTI file, so creating the AslImage does not load the whole 4D data set.
+    """
+    metadata = qpdata_to_aslmetadata(qpd, options, metadata)
 
     # Create AslImage object, this will fail if metadat is insufficient or inconsistent
     from oxasl import AslImage
-    if grid is None:
-        aslimage = AslImage(qpd.raw(), name=qpd.name, xform=qpd.grid.affine, **metadata)
-    else:
-        aslimage = AslImage(qpd.resample(grid), name=qpd.name, xform=grid.affine, **metadata)
+    data, affine, copied = _grid_data(qpd, grid, copy, io_stats)
+    aslimage = AslImage(data, name=qpd.name, xform=affine, **metadata)
+    _check_shared(aslimage, data, copied, io_stats)
                     
     return aslimage, metadata
 
@@ -102,16 +312,16 @@ def aslimage_to_metadata(aslimage):
                 metadata[opt] = val
     return metadata
 
-def aslimage_to_qpdata(aslimage):
+def aslimage_to_qpdata(aslimage, io_stats=None):
     """ 
     Convert oxasl.AslImage to QpData storing additional information as metadata 
     """
-    qpd = fslimage_to_qpdata(aslimage)
+    qpd = fslimage_to_qpdata(aslimage, io_stats=io_stats)
     metadata = aslimage_to_metadata(aslimage)
     qpd.metadata["AslData"] = metadata
     return qpd
 
-def workspace_from_options(options, images, grid, ivm):
+def workspace_from_options(options, images, grid, ivm, io_stats=None):
     """ 
     Create an oxasl.Workspace object from process options 
     """
@@ -123,7 +333,7 @@ def workspace_from_options(options, images, grid, ivm):
             data_name = options[key]
             data = ivm.data.get(data_name, None)
             if data is not None:
-                setattr(wsp, key, qpdata_to_fslimage(data, grid=grid))
+                setattr(wsp, key, qpdata_to_fslimage(data, grid=grid, io_stats=io_stats))
             else:
                 raise QpException("Data not found: %s" % data_name)
 
@@ -134,6 +344,126 @@ def workspace_from_options(options, images, grid, ivm):
 
     return wsp
 
+# Default location of Basil checkpoints, and the age in seconds after
+# which checkpoints of runs which were never resumed are removed
+BASIL_CHECKPOINT_DIR = os.path.join(tempfile.gettempdir(), "qp_basil_checkpoints")
+BASIL_CHECKPOINT_MAX_AGE = 7*24*60*60
+
+# Default location and size in Mb of the oxasl output cache
+OXASL_CACHE_DIR = os.path.join(tempfile.gettempdir(), "qp_oxasl_cache")
+OXASL_CACHE_MB = 10000
+
+# Location of memoised output from individual oxasl pipeline stages
+OXASL_STAGE_CACHE_DIR = os.path.join(tempfile.gettempdir(), "qp_oxasl_stages")
+
+# oxasl options which are only used after model fitting (calibration and output).
+# Runs which differ only in these options can reuse memoised model fitting steps
+OXASL_LATE_OPTIONS = set([
+    "calib", "cref", "calib_method", "tr", "te", "calib_gain", "calib_alpha", "t1t", "pct",
+    "tissref", "refmask", "t1r", "t2r", "pcr", "t2b",
+    "output_native", "output_struc", "output_mni", "output_var",
+    "save_mask", "save_calib", "save_corrected", "save_reg", "save_struc", "save_basil",
+    "save_report", "savedir", "debug",
+])
+
+# Stages of the oxasl pipeline, as (regular expression matching start of stage in log, description)
+OXASL_STAGES = [
+    ("Pre-processing", "Pre-processing"),
+    #("Registering", "Initial ASL->Structural registration"),
+    (".*initial fit", "Initial model fitting"),
+    (".*fit on full", "Model fitting to full data"),    
+    #("segmentation", "Segmenting structural image"),
+    #("BBR registration", "Final ASL->Structural registration"),
+]
+
+def status_name(status):
+    """
+    :return: Name of a Process status code for profiling records
+    """
+    return {
+        Process.SUCCEEDED : "SUCCEEDED",
+        Process.FAILED : "FAILED",
+        Process.CANCELLED : "CANCELLED",
+    }.get(status, str(status))
+
+def save_profile(process, profiler, name, fname=None):
+    """
+    Add a process profile to the IVM as a DataFrameExtra and optionally save it as JSON
+
+    :param process: Process being profiled
+    :param profiler: StepProfiler
+    :param name: Name of the extra
+    :param fname: Optional JSON file name
+    """
+    process.ivm.add_extra(name, DataFrameExtra(name, profiler.dataframe()))
+    if fname:
+        try:
+            profiler.save_json(fname, process=process.PROCESS_NAME)
+        except (IOError, OSError) as exc:
+            process.warn("Failed to save profile: %s" % str(exc))
+
+def bounding_box(mask):
+    """
+    :param mask: 3D mask array with at least one non-zero voxel
+    :return: Tuple of slices for the three spatial axes which contain all non-zero voxels
+    """
+    return tuple(slice(int(np.min(coords)), int(np.max(coords)) + 1) for coords in np.nonzero(mask))
+
+def cropped_grid(grid, box):
+    """
+    :param grid: DataGrid
+    :param box: Tuple of slices for the three spatial axes, e.g. from ``bounding_box``
+    :return: DataGrid for the sub-volume of ``grid`` within ``box``
+    """
+    affine = np.array(grid.affine, dtype=np.float64)
+    affine[:3, 3] += np.dot(affine[:3, :3], [axis.start for axis in box])
+    return DataGrid([axis.stop - axis.start for axis in box], affine)
+
+def partition_mask(mask, num_partitions):
+    """
+    Split a mask into partitions of contiguous voxels
+
+    Each partition contains a similar number of voxels, taken in order, so it
+    covers a contiguous range of slices along the first axis and the data it
+    needs can be cropped to a small bounding box.
+
+    :param mask: 3D mask array
+    :param num_partitions: Number of partitions
+    :return: List of (3D integer mask array, bounding box from ``bounding_box``).
+             Empty partitions are not returned
+    """
+    voxels = np.flatnonzero(mask)
+    partitions = []
+    if len(voxels) == 0:
+        return partitions
+    for part_voxels in np.array_split(voxels, min(num_partitions, len(voxels))):
+        part = np.zeros(mask.shape, dtype=np.int8)
+        part.flat[part_voxels] = 1
+        partitions.append((part, bounding_box(part)))
+    return partitions
+
+def merge_partitions(partitions, masks, boxes, grid):
+    """
+    Merge voxelwise data from partitioned runs into full volumes
+
+    :param partitions: Sequence of dictionaries of name: QpData output by each partition,
+                       on the grid cropped to the partition's bounding box
+    :param masks: Sequence of full size partition masks
+    :param boxes: Sequence of partition bounding boxes
+    :param grid: DataGrid of the full volumes
+    :return: Dictionary of name: NumpyData
+    """
+    merged = {}
+    for outputs, mask, box in zip(partitions, masks, boxes):
+        voxels = mask[box] > 0
+        for name, qpd in outputs.items():
+            data = qpd.raw()
+            if name not in merged:
+                shape = tuple(grid.shape) + data.shape[3:]
+                merged[name] = NumpyData(np.zeros(shape, dtype=data.dtype), grid=grid, name=name, roi=qpd.roi)
+            merged[name].raw()[box][voxels] = data[voxels]
+    return merged
+
 class AslProcess(Process):
     """ 
     Base class for processes which use ASL data 
@@ -144,17 +474,38 @@ class AslProcess(Process):
         self.struc = None
         self.asldata = None
         self.grid = None
+        self.io_stats = {}
 
     def get_asldata(self, options):
         """ 
         Get the main data set and construct an AslData instance from it 
+
+        The AslData instance borrows the voxel data from the QpData object
+        so no copy is made. ``io_stats`` is reset and records any copies
+        made during the run.
         """
+        self.io_stats = {}
         self.data = self.get_data(options)
-        self.asldata, self.struc = qpdata_to_aslimage(self.data, options)
+        self.asldata, self.struc = qpdata_to_aslimage(self.data, options, io_stats=self.io_stats)
         # Set the metadata on the data
         self.data.metadata["AslData"] = self.struc
         self.grid = self.data.grid
 
+    def get_aslmetadata(self, options):
+        """
+        Get the main data set and its ASL metadata without constructing an AslData instance
+
+        The metadata is checked against the number of volumes in the data, so this
+        does not need the voxel data to be loaded.
+        """
+        self.io_stats = {}
+        self.data = self.get_data(options)
+        self.struc = qpdata_to_aslmetadata(self.data, options)
+        validate_asl_metadata(self.struc, self.data.nvols)
+        self.data.metadata["AslData"] = self.struc
+        self.grid = self.data.grid
+        self.asldata = None
+
 class AslDataProcess(AslProcess):
     """
     Process which merely records the structure of an ASL dataset
@@ -174,29 +525,44 @@ class AslPreprocProcess(AslProcess):
     def run(self, options):
         """ 
         Run preprocessing steps and add the output to the IVM
+
+        By default the data is processed in chunks of slices if it is too large
+        to comfortably hold several copies in memory. The ``stream`` option
+        can be used to force or prevent this, and ``chunk-size`` gives the
+        maximum size of a chunk of input data in Mb.
         """
         from oxasl import AslImage
 
-        self.get_asldata(options)
-
-        if options.pop("diff", False):
-            self.asldata = self.asldata.diff()
-
-        new_order = options.pop("reorder", None)
-        if new_order is not None:
-            self.asldata = self.asldata.reorder(new_order)
-
-        if options.pop("mean", False):
-            self.asldata = self.asldata.mean_across_repeats()
-        elif options.pop("pwi", False):
-            self.asldata = self.asldata.perf_weighted()
-
-        if isinstance(self.asldata, AslImage):
-            qpd = aslimage_to_qpdata(self.asldata)
+        self.get_aslmetadata(options)
+        ops = preproc_ops(options)
+        stream = options.pop("stream", None)
+        chunk_bytes = int(options.pop("chunk-size", DEFAULT_CHUNK_BYTES / 1e6) * 1e6)
+        if stream is None:
+            stream = data_nbytes(self.data) > default_max_bytes(fraction=0.25)
+
+        plan = PreprocPlan.compile(self.struc, self.data.nvols, ops, name=self.data.name)
+        if stream and ops:
+            self.debug("Streaming preprocessing in chunks of %i bytes", chunk_bytes)
+            data, template = stream_preproc(self.data, self.struc, ops, chunk_bytes, plan=plan)
+        elif plan is not None:
+            self.debug("Fused preprocessing")
+            rawdata, _, _ = _grid_data(self.data, None, False, self.io_stats)
+            data, template = plan.apply(rawdata), plan.template
+        else:
+            self.asldata, _ = qpdata_to_aslimage(self.data, metadata=self.struc, io_stats=self.io_stats)
+            data, template = None, apply_ops(self.asldata, ops)
+
+        if data is not None:
+            qpd = NumpyData(data, grid=self.grid, name=template.name)
+            if isinstance(template, AslImage):
+                qpd.metadata["AslData"] = aslimage_to_metadata(template)
+        elif isinstance(template, AslImage):
+            qpd = aslimage_to_qpdata(template, io_stats=self.io_stats)
         else:
-            qpd = fslimage_to_qpdata(self.asldata)
+            qpd = fslimage_to_qpdata(template, io_stats=self.io_stats)
 
-        output_name = options.pop("output-name", self.asldata.name + "_preproc")
+        output_name = options.pop("output-name", template.name + "_preproc")
+        self.debug(io_summary(self.io_stats))
         self.ivm.add(qpd, name=output_name, make_current=True)
 
 class BasilProcess(AslProcess):
@@ -227,12 +593,37 @@ class BasilProcess(AslProcess):
 
         self.steps = []
         self.step_num = 0
+        self.checkpoint = None
+        self.num_partitions = 1
+        self._partitions = None
+        self.profiler = None
+        self._profile_file = None
         super(BasilProcess, self).__init__(ivm, **kwargs)
 
     def run(self, options):
-        """ Run the process """
+        """ 
+        Run the process
+
+        If the ``checkpoint`` option is True, the MVN is saved to disk (in ``checkpoint-dir``)
+        after each step. If a previous run with identical inputs and options did not complete,
+        the process resumes after the last step which did. Checkpoints which have not
+        been used for a week are removed.
+
+        The ``partitions`` option splits the ROI into this number of partitions which
+        are fitted concurrently in separate Fabber processes. This is only done for
+        non-spatial steps, where voxels are independent.
+
+        A profile of each step is added to the IVM as the ``basil_profile`` extra
+        and can also be saved as JSON to the file given by the ``profile`` option.
+        """
         from oxasl import basil
  
+        use_checkpoint = options.pop("checkpoint", False)
+        checkpoint_dir = options.pop("checkpoint-dir", None) or BASIL_CHECKPOINT_DIR
+        self.num_partitions = max(1, int(options.pop("partitions", 1)))
+        self._profile_file = options.pop("profile", None)
+        self.profiler = StepProfiler()
+        self.profiler.start("Setup")
         self.get_asldata(options)
         self.asldata = self.asldata.diff().reorder("rt")
         self.ivm.add(self.asldata.data, grid=self.grid, name=self.asldata.name)
@@ -243,23 +634,62 @@ class BasilProcess(AslProcess):
         self.debug("Basil options: ")
         self.debug(options)
 
-        wsp = workspace_from_options(options, images=["t1im", "pwm", "pgm"], grid=self.grid, ivm=self.ivm)
+        wsp = workspace_from_options(options, images=["t1im", "pwm", "pgm"], grid=self.grid, ivm=self.ivm, io_stats=self.io_stats)
         wsp.asldata = self.asldata
-        wsp.mask = qpdata_to_fslimage(roi)
+        wsp.mask = qpdata_to_fslimage(roi, io_stats=self.io_stats)
+        self.debug(io_summary(self.io_stats))
+        self.profiler.voxels = np.count_nonzero(roi.raw())
+        self.profiler.stop(voxels=np.prod(self.grid.shape), io_extra=profile_io_bytes(self.io_stats))
 
         self.steps = basil.basil_steps(wsp, self.asldata)
         self.log(wsp.log.getvalue())
         self.step_num = 0
+        self.checkpoint = None
+        if use_checkpoint:
+            self._resume(checkpoint_dir)
         self.status = Process.RUNNING
         self._next_step()
 
     def cancel(self):
         """ Cancel the underlying fabber process """
         self.fabber.cancel()
+        if self._partitions is not None:
+            for fabber in self._partitions["processes"]:
+                fabber.cancel()
 
     def output_data_items(self):
         """ :return: list of data items output by the process """
         return self.OUTPUT_RENAME.values()
+
+    def _resume(self, checkpoint_dir):
+        """
+        Set up the checkpoint for this run and resume from it if one exists
+        """
+        Checkpoint.expire(checkpoint_dir, BASIL_CHECKPOINT_MAX_AGE)
+        key = content_hash(self.asldata, self.grid.affine, self.struc, [step.options for step in self.steps])
+        self.checkpoint = Checkpoint(key, checkpoint_dir)
+        saved = self.checkpoint.load()
+        if saved is None:
+            return
+
+        step_num, arrays = saved
+        mvn = arrays.get("mvn", None)
+        if 0 < step_num < len(self.steps) and mvn is not None and tuple(mvn.shape[:3]) == tuple(self.grid.shape):
+            self.ivm.add(NumpyData(mvn, grid=self.grid, name="finalMVN"))
+            self.step_num = step_num
+            self.log("Resuming from checkpoint after step %i\n\n" % step_num)
+        else:
+            self.warn("Ignoring incompatible Basil checkpoint")
+            self.checkpoint.clear()
+
+    def _save_checkpoint(self):
+        if self.checkpoint is None or "finalMVN" not in self.ivm.data:
+            return
+        try:
+            self.checkpoint.save(self.step_num, mvn=self.ivm.data["finalMVN"].raw())
+            self.debug("Basil: saved checkpoint after step %i" % self.step_num)
+        except (IOError, OSError) as exc:
+            self.warn("Failed to save Basil checkpoint: %s" % str(exc))
         
     def _next_step(self):
         if self.status != self.RUNNING:
@@ -276,6 +706,10 @@ class BasilProcess(AslProcess):
             self.status = Process.SUCCEEDED
             self.steps = []
             self.step_num = 0
+            if self.checkpoint is not None:
+                self.checkpoint.clear()
+                self.checkpoint = None
+            save_profile(self, self.profiler, "basil_profile", self._profile_file)
             if "finalMVN" in self.ivm.data:
                 self.ivm.delete("finalMVN")
             self.sig_finished.emit(self.status, self.get_log(), self.exception)
@@ -285,6 +719,7 @@ class BasilProcess(AslProcess):
     def _start_fabber(self, step):
         from fsl.data.image import Image
         self.sig_step.emit(step.desc)
+        self.profiler.start(step.desc, io_stats=self.io_stats)
 
         options = dict(step.options)
         options["model-group"] = "asl"
@@ -317,20 +752,103 @@ class BasilProcess(AslProcess):
             self.debug("%s=%s (%s)" % (k, str(options[k]), type(options[k])))
 
         self.log(step.desc + "\n\n")
-        self.fabber.execute(options)
+        if self.num_partitions > 1 and options.get("method", "vb") != "spatialvb":
+            self._start_partitions(options)
+        else:
+            self.fabber.execute(options)
+
+    def _start_partitions(self, options):
+        """
+        Run a Fabber step with the ROI split into partitions
+
+        Each partition is run by a separate FabberProcess with its own data manager
+        containing the inputs it needs, cropped to the partition's bounding box, so
+        the outputs can be merged when all are done
+        """
+        roi = self.ivm.data[options["roi"]]
+        partitions = partition_mask(roi.raw(), self.num_partitions)
+        masks = [mask for mask, _ in partitions]
+        boxes = [box for _, box in partitions]
+        inputs = [val for val in options.values() if isinstance(val, six.string_types) and val in self.ivm.data]
+        self.debug("Basil: running step in %i partitions" % len(masks))
+
+        processes, added = [], []
+        for idx, (mask, box) in enumerate(partitions):
+            grid = cropped_grid(roi.grid, box)
+            ivm = ImageVolumeManagement()
+            for name in inputs:
+                qpd = self.ivm.data[name]
+                if not qpd.grid.matches(roi.grid):
+                    qpd = qpd.resample(roi.grid)
+                data = np.ascontiguousarray(qpd.raw()[box])
+                ivm.add(NumpyData(data, grid=grid, name=name, roi=qpd.roi), name=name)
+            ivm.add(NumpyData(mask[box], grid=grid, name=options["roi"], roi=True), name=options["roi"])
+            added.append(dict(ivm.data))
+            fabber = type(self.fabber)(ivm)
+            fabber.sig_finished.connect(lambda status, log, exc, idx=idx: self._partition_finished(idx, status, log, exc))
+            fabber.sig_progress.connect(lambda complete, idx=idx: self._partition_progress(idx, complete))
+            processes.append(fabber)
+
+        self._partitions = {
+            "processes" : processes,
+            "ivms" : [fabber.ivm for fabber in processes],
+            "masks" : masks,
+            "boxes" : boxes,
+            "grid" : roi.grid,
+            "inputs" : added,
+            "status" : [None] * len(masks),
+            "progress" : [0.0] * len(masks),
+            "logs" : [""] * len(masks),
+        }
+        for fabber in processes:
+            fabber.execute(dict(options))
+
+    def _partition_finished(self, idx, status, log, exception):
+        parts = self._partitions
+        if parts is None or self.status != self.RUNNING:
+            return
+
+        parts["status"][idx] = status
+        parts["logs"][idx] = log
+        if status != Process.SUCCEEDED:
+            self.debug("Basil: Fabber failed in partition %i" % idx)
+            self._partitions = None
+            for other, other_status in zip(parts["processes"], parts["status"]):
+                if other_status is None:
+                    other.cancel()
+            self._fabber_finished(status, log, exception)
+        elif all(part_status == Process.SUCCEEDED for part_status in parts["status"]):
+            self._partitions = None
+            # Inputs may be replaced by outputs with the same name (e.g. finalMVN when
+            # continuing from a previous step) so compare the data objects, not names
+            outputs = [dict((name, qpd) for name, qpd in ivm.data.items() if qpd is not inputs.get(name, None))
+                       for ivm, inputs in zip(parts["ivms"], parts["inputs"])]
+            for name, qpd in merge_partitions(outputs, parts["masks"], parts["boxes"], parts["grid"]).items():
+                self.ivm.add(qpd, name=name, make_current=False)
+            self._fabber_finished(status, "\n".join(parts["logs"]), None)
+
+    def _partition_progress(self, idx, complete):
+        parts = self._partitions
+        if parts is not None:
+            parts["progress"][idx] = complete
+            self._fabber_progress(sum(parts["progress"]) / len(parts["progress"]))
 
     def _fabber_finished(self, status, log, exception):
         if self.status != self.RUNNING:
             return
 
         self.log(log + "\n\n")
+        self.profiler.stop(status_name(status))
         if status == Process.SUCCEEDED:
             self.debug("Basil: completed step %i" % self.step_num)
+            if self.step_num < len(self.steps):
+                self._save_checkpoint()
             self._next_step()
         else:
             self.debug("Basil: Fabber failed on step %i" % self.step_num)
             self.log("CANCELLED\n")
             self.status = status
+            save_profile(self, self.profiler, "basil_profile", self._profile_file)
             self.sig_finished.emit(self.status, self.get_log(), exception)
             
     def _fabber_progress(self, complete):
@@ -387,69 +905,339 @@ class AslCalibProcess(Process):
     PROCESS_NAME = "AslCalib"
 
     def run(self, options):
-        """ Run the process """
-        from oxasl import Workspace, calib
-        from fsl.data.image import Image
+        """
+        Run the process
+
+        ``data`` may be the name of a single data set, a list of names, or a dictionary
+        of name to calibration options for that data set (``multiplier``, ``var``). Multiple
+        data sets are calibrated together using the same M0 estimate, and output
+        to data named with the suffix given by ``output-suffix`` (default ``_calib``).
+        Data sets which are variances (``var`` is True) are scaled by the square of
+        the calibration scale, which is calculated once for all of them.
+
+        The M0 estimate is cached, so re-running with a different inversion efficiency,
+        multiplier, gain, TR or partition coefficient, or on different data with the same
+        M0 options, only rescales the data
+        """
+        inputs = self.get_inputs(options)
+        try:
+            output = calibrate_data(**inputs["calibrate"])
+        except ValueError as exc:
+            raise QpException(str(exc))
+        self.set_output(inputs, output)
 
-        data = self.get_data(options)
-        img = Image(data.raw(), name=data.name)
+    def get_inputs(self, options):
+        """
+        Get the inputs to the calibration from the IVM
+
+        This must be called on the GUI thread. The ``calibrate`` entry of the
+        returned dictionary contains the keyword arguments for ``calibrate_data``
+        which may then be run in a background thread
+
+        :return: Dictionary of calibration inputs
+        """
+        io_stats = {}
+        items = self._get_items(options)
+        data = items[0][0]
 
         roi = self.get_roi(options, data.grid)
-        options["mask"] = Image(roi.raw(), name=roi.name)
+        options["mask"] = qpdata_to_fslimage(roi, grid=data.grid, io_stats=io_stats)
 
         calib_name = options.pop("calib-data")
         if calib_name not in self.ivm.data:
             raise QpException("Calibration data not found: %s" % calib_name)
         else:
-            calib_img = Image(self.ivm.data[calib_name].resample(data.grid).raw(), name=calib_name)
+            calib_img = qpdata_to_fslimage(self.ivm.data[calib_name], grid=data.grid, io_stats=io_stats)
 
         ref_roi_name = options.pop("ref-roi", None)
         if ref_roi_name is not None:
             if ref_roi_name not in self.ivm.rois:
                 raise QpException("Reference ROI not found: %s" % calib_name)
             else:
-                options["ref_mask"] = Image(self.ivm.rois[ref_roi_name].resample(data.grid).raw(), name=ref_roi_name)
+                options["ref_mask"] = qpdata_to_fslimage(self.ivm.rois[ref_roi_name], grid=data.grid, io_stats=io_stats)
         
         options["calib_method"] = options.pop("method", None)
-        output_name = options.pop("output-name", data.name + "_calib")
+        if "gain" in options:
+            options["calib_gain"] = options.pop("gain")
+        if "edgecorr" in options:
+            options["calib_edgecorr"] = options.pop("edgecorr")
+        multiplier = options.pop("multiplier", 1.0)
+        alpha = options.pop("alpha", 1.0)
+        var = options.pop("var", False)
+        if len(items) == 1:
+            output_names = [options.pop("output-name", data.name + "_calib")]
+        else:
+            suffix = options.pop("output-suffix", "_calib")
+            output_names = [qpd.name + suffix for qpd, _ in items]
+
+        arrays = []
+        for qpd, _ in items:
+            arr, _, _ = _grid_data(qpd, data.grid, False, io_stats)
+            arrays.append(arr)
+
+        return {
+            "calibrate" : {
+                "calib_img" : calib_img,
+                "m0_options" : options,
+                "arrays" : arrays,
+                "multipliers" : [item_opts.get("multiplier", multiplier) for _, item_opts in items],
+                "variances" : [item_opts.get("var", var) for _, item_opts in items],
+                "alpha" : alpha,
+            },
+            "output-names" : output_names,
+            "grid" : data.grid,
+            "io-stats" : io_stats,
+        }
+
+    def set_output(self, inputs, output):
+        """
+        Add calibrated data to the IVM. This must be called on the GUI thread
 
-        logbuf = six.StringIO()
-        wsp = Workspace(log=logbuf, **options)
-        wsp.calib = calib_img
-        ## FIXME variance mode
-        calibrated = calib.calibrate(wsp, img)
-        self.log(logbuf.getvalue())
-        self.ivm.add(name=output_name, data=calibrated.data, grid=data.grid, make_current=True)
+        :param inputs: Inputs from ``get_inputs``
+        :param output: Return value of ``calibrate_data``
+        """
+        calibrated, log = output
+        self.log(log)
+        self.debug(io_summary(inputs["io-stats"]))
+        for idx, output_name in enumerate(inputs["output-names"]):
+            self.ivm.add(name=output_name, data=calibrated[idx], grid=inputs["grid"], make_current=(idx == 0))
 
-def qp_oxasl(worker_id, queue, fsldir, fsldevdir, asldata, options):
+    def _get_items(self, options):
+        """
+        :return: List of (QpData, options) for the data sets to calibrate
+        """
+        names = options.get("data", None)
+        if names is None or isinstance(names, six.string_types):
+            return [(self.get_data(options), {})]
+
+        options.pop("data")
+        if not isinstance(names, dict):
+            names = dict((name, {}) for name in names)
+        if not names:
+            raise QpException("No data to calibrate")
+        items = []
+        for name in names:
+            if name not in self.ivm.data:
+                raise QpException("Data not found: %s" % name)
+            items.append((self.ivm.data[name], dict(names[name] or {})))
+        return items
+
+class _TeeStream(object):
+    """
+    Stream which passes output on to another stream and also records it
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buf = six.StringIO()
+
+    def write(self, text):
+        self.buf.write(text)
+        if self.stream is not None:
+            self.stream.write(text)
+
+    def flush(self):
+        if self.stream is not None and hasattr(self.stream, "flush"):
+            self.stream.flush()
+
+    def getvalue(self):
+        return self.buf.getvalue()
+
+class MemoStep(object):
+    """
+    Wrapper for a Basil model fitting step which memoises its output
+
+    Image outputs are saved as NIFTI files and other outputs as JSON. Outputs
+    which cannot be saved this way are not memoised. Output written to the log
+    streams by the step is also saved and is written again when the memoised
+    output is reused. Files in the output directory are written by oxasl
+    from the step output, so they are the same whether or not it was reused.
+    """
+
+    def __init__(self, step, memo, key):
+        """
+        :param step: oxasl.basil.Step instance
+        :param memo: ResultCache storing memoised output
+        :param key: Key identifying the step and everything it depends on
+        """
+        self.step = step
+        self.memo = memo
+        self.key = key
+
+    def __getattr__(self, name):
+        if name == "step":
+            raise AttributeError(name)
+        return getattr(self.step, name)
+
+    def run(self, prev_output, log=sys.stdout, fsllog=None, **kwargs):
+        cached = self.memo.get(self.key)
+        if cached is not None:
+            try:
+                output, logs = self._load(cached)
+                log.write("(reusing previous output) ")
+                log.write(logs["log"])
+                if fsllog is not None:
+                    fsllog.write(logs["fsllog"])
+                return output
+            except (IOError, OSError, ValueError) as exc:
+                log.write("WARNING: Failed to load previous output: %s\n" % str(exc))
+
+        log_tee, fsllog_tee = _TeeStream(log), _TeeStream(fsllog)
+        output = self.step.run(prev_output, log=log_tee, fsllog=fsllog_tee if fsllog is not None else None, **kwargs)
+        try:
+            self._save(output, {"log" : log_tee.getvalue(), "fsllog" : fsllog_tee.getvalue()})
+        except (IOError, OSError, TypeError, ValueError) as exc:
+            log.write("WARNING: Failed to save output for reuse: %s\n" % str(exc))
+        return output
+
+    def _load(self, dirname):
+        from fsl.data.image import Image
+        import json
+        with open(os.path.join(dirname, "_values.json")) as jsonfile:
+            output = json.load(jsonfile)
+        with open(os.path.join(dirname, "_logs.json")) as jsonfile:
+            logs = json.load(jsonfile)
+        for fname in glob.glob(os.path.join(dirname, "*.nii*")):
+            # Load the data now as the memo entry may be evicted later
+            name = os.path.basename(fname).split(".", 1)[0]
+            img = Image(fname)
+            output[name] = Image(np.array(img.data), header=img.header, name=name)
+        return output, logs
+
+    def _save(self, output, logs):
+        from fsl.data.image import Image
+        import json
+        values = {}
+        tempdir = tempfile.mkdtemp("qp_oxasl_step")
+        try:
+            for key, value in output.items():
+                if isinstance(value, Image):
+                    value.save(os.path.join(tempdir, key))
+                else:
+                    values[key] = value
+            with open(os.path.join(tempdir, "_values.json"), "w") as jsonfile:
+                json.dump(values, jsonfile)
+            with open(os.path.join(tempdir, "_logs.json"), "w") as jsonfile:
+                json.dump(logs, jsonfile)
+            self.memo.put(self.key, tempdir)
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+def memo_basil_steps(basil_steps, memo, fit_key):
+    """
+    Wrap ``oxasl.basil.basil_steps`` (or ``basil_steps_multite``) so each model
+    fitting step is memoised
+
+    Steps are keyed on the data, mask and options passed to the fitting, including
+    the data after any corrections, and the options which control fitting. Runs which
+    differ only in calibration or output options therefore reuse the fitting steps.
+    Each step's key includes the key of the step before it, whose output it
+    is initialised from.
+
+    :param basil_steps: Original function returning the steps
+    :param memo: ResultCache storing memoised output
+    :param fit_key: Key identifying the oxasl options which affect fitting
+    """
+    def _steps(wsp, asldata, mask=None, **kwargs):
+        steps = basil_steps(wsp, asldata, mask, **kwargs)
+        key = content_hash(fit_key, asldata, aslimage_to_metadata(asldata), mask, kwargs)
+        memo_steps = []
+        for idx, step in enumerate(steps):
+            key = content_hash(key, idx, step.desc, step.options)
+            memo_steps.append(MemoStep(step, memo, key))
+        return memo_steps
+    return _steps
+
+# Workspace attribute holding a (ResultCache, fitting options key) tuple if model
+# fitting steps in an oxasl run are to be memoised
+MEMO_ATTR = "_qp_stage_memo"
+
+_memo_install_lock = threading.Lock()
+
+# Functions in ``oxasl.basil`` which return model fitting steps. Not all
+# versions of oxasl have all of them
+BASIL_STEPS_FUNCTIONS = ["basil_steps", "basil_steps_multite"]
+
+def _workspace_basil_steps(basil_steps):
+    """
+    Replacement for ``oxasl.basil.basil_steps`` (or ``basil_steps_multite``) which
+    memoises the steps only for runs whose workspace has the ``MEMO_ATTR`` attribute set
+
+    These functions are called from within oxasl so they have to be replaced in the
+    ``oxasl.basil`` module, but selecting the behaviour using the workspace means that
+    other runs, e.g. in other threads, are not affected.
+    """
+    def _steps(wsp, asldata, mask=None, **kwargs):
+        stage_memo = getattr(wsp, MEMO_ATTR, None)
+        if stage_memo is None:
+            return basil_steps(wsp, asldata, mask, **kwargs)
+        memo, fit_key = stage_memo
+        return memo_basil_steps(basil_steps, memo, fit_key)(wsp, asldata, mask, **kwargs)
+    _steps.memo_original = basil_steps
+    return _steps
+
+def qp_oxasl(worker_id, queue, fsldir, fsldevdir, asldata, options, output_paths=(), stage_memo=None, scratch_dir=None):
     """
     Worker function for asynchronous oxasl run
 
-    Note that images are passed as QpData because it's pickleable
-    but need to be converted to fsl.data.image.Image
+    Note that images are passed as ``SharedImage`` descriptors so the
+    voxel data is not pickled. They are converted to fsl.data.image.Image
+    objects on a memory map of the data.
+
+    Output images are saved uncompressed, and ``SharedImage`` descriptors for
+    those under ``output_paths`` are returned so the parent process can map
+    them directly rather than decompressing NIFTI files. Any output which cannot
+    be mapped directly (e.g. compressed or scaled images) is decompressed into
+    ``scratch_dir`` so it is not added to the output directory. Profile records
+    for each stage of the pipeline are also returned.
+
+    If ``stage_memo`` is given as (directory, size in bytes, fitting options key)
+    model fitting steps are memoised there - see ``memo_basil_steps``
     """
     try:
-        from oxasl import Workspace
+        from oxasl import Workspace, basil
         from oxasl.oxford_asl import oxasl
         options["fabber_dirs"] = get_plugins("fabber-dirs")
 
-        if "FSLOUTPUTTYPE" not in os.environ:
-            os.environ["FSLOUTPUTTYPE"] = "NIFTI_GZ"
         if fsldir:
             os.environ["FSLDIR"] = fsldir
         if fsldevdir:
             os.environ["FSLDEVDIR"] = fsldevdir
 
         for key, value in options.items():
-            if isinstance(value, QpData):
-                options[key] = qpdata_to_fslimage(value)
-        options["asldata"], _ = qpdata_to_aslimage(asldata)
+            if isinstance(value, SharedImage):
+                options[key] = value.to_fslimage()
+        options["asldata"] = asldata.to_aslimage()
 
-        output_monitor = OutputStreamMonitor(queue)
+        output_monitor = StageMonitor(OutputStreamMonitor(queue), OXASL_STAGES)
         wsp = Workspace(log=output_monitor, **options)
-        oxasl(wsp)
+        if stage_memo is not None:
+            memo_dir, memo_bytes, fit_key = stage_memo
+            with _memo_install_lock:
+                for name in BASIL_STEPS_FUNCTIONS:
+                    steps_fn = getattr(basil, name, None)
+                    if steps_fn is not None and not hasattr(steps_fn, "memo_original"):
+                        setattr(basil, name, _workspace_basil_steps(steps_fn))
+            wsp.set_item(MEMO_ATTR, (ResultCache(memo_dir, memo_bytes), fit_key), save=False)
+
+        # Output only goes to a temporary directory so there is no point in
+        # compressing it. The worker may be run in the GUI process, so the
+        # user's setting is restored afterwards
+        fsloutputtype = os.environ.get("FSLOUTPUTTYPE", None)
+        os.environ["FSLOUTPUTTYPE"] = "NIFTI"
+        try:
+            oxasl(wsp)
+        finally:
+            if fsloutputtype is None:
+                del os.environ["FSLOUTPUTTYPE"]
+            else:
+                os.environ["FSLOUTPUTTYPE"] = fsloutputtype
+        profile = output_monitor.finish()
 
-        return worker_id, True, {}
+        return worker_id, True, {
+            "images" : nifti_descriptors(options["savedir"], output_paths, scratch_dir),
+            "profile" : profile,
+        }
     except:
         traceback.print_exc()
         return worker_id, False, sys.exc_info()[1]
@@ -466,68 +1254,142 @@ class OxaslProcess(LogProcess):
         "wmseg", "gmseg", "csfseg", "refmask"
     ]
 
+    # Subdirectories of the output workspace which are always loaded, and
+    # the suffix added to the names of data loaded from them
+    DEFAULT_OUTPUT = [
+        ("output", ""),
+        ("corrected", "_corr"),
+        ("structural", "_struc"),
+        ("calibration", "_calib"),
+        ("basil", "_fitting"),
+        ("reg", "_reg"),
+    ]
+
     def __init__(self, ivm, **kwargs):
         LogProcess.__init__(self, ivm, worker_fn=qp_oxasl, **kwargs)
         self._expected_output = {}
         self._tempdir = None
+        self._transferdir = None
+        self._scratchdir = None
         self._output_data_items = []
+        self._output_images = {}
+        self._lazy_load = True
+        self._load_threads = 1
+        self._lazy_data = False
+        self._shared_dir = None
+        self.profiler = None
+        self._profile_file = None
+        self._asl_metadata = {}
+        self._cache = None
+        self._cache_key = None
+        self._cached = False
 
     def _get_asldata(self, options):
         data = self.get_data(options)
         asldata, md = qpdata_to_aslimage(data, options)
         data.metadata["AslData"] = md
+        self._asl_metadata = aslimage_to_metadata(asldata)
         return data
 
     def run(self, options):
         """
         Run oxasl pipeline asynchronously
+
+        A profile of each pipeline stage is added to the IVM as the ``oxasl_profile``
+        extra and can also be saved as JSON to the file given by the ``profile`` option.
+
+        If the ``cache`` option is True, output is cached on disk (in ``cache-dir``,
+        up to ``cache-size`` Mb) keyed by the input data, metadata and oxasl options.
+        If the same inputs are run again the cached output is loaded immediately.
+
+        If the ``stage-cache`` option is True (by default, the same as ``cache``) model
+        fitting steps are cached (in ``stage-cache-dir``, up to ``cache-size`` Mb)
+        so runs which differ only in calibration or output options reuse them. This
+        does not require the output cache to be enabled.
         """
+        self._profile_file = options.pop("profile", None)
+        self.profiler = StepProfiler()
+        self.profiler.start("Input transfer")
         self.data = self._get_asldata(options)
 
-        # Create a temporary directory to store working data - this makes it
-        # easy to retrieve afterwards and reduces memory usage. Note that
-        # this is deleted in the `finished` method which is guaranteed to
-        # be called.
-        self._tempdir = tempfile.mkdtemp("qp_oxasl")
-
         # Set up basic options
         self._reportdir = options.pop("report", None)
         self._expected_output = options.pop("output", {})
         self._output_prefix = options.pop("output-prefix", "")
-
-        oxasl_options = {
-            "debug" : self.debug_enabled(),
-            "savedir" : self._tempdir,
-            "save_report" : self._reportdir is not None,
-        }
-        if "roi" in options:
-            oxasl_options["mask"] = self.get_roi(options, self.data.grid)
-
-        # For options which are images set the value to the actual QpData object
+        self._lazy_load = options.pop("lazy-load", True)
+        self._load_threads = options.pop("load-threads", max(1, min(8, multiprocessing.cpu_count())))
+        self._lazy_data = False
+        self._cached = False
+        use_cache = options.pop("cache", False)
+        use_stage_cache = options.pop("stage-cache", use_cache)
+        cache_dir = options.pop("cache-dir", None) or OXASL_CACHE_DIR
+        stage_dir = options.pop("stage-cache-dir", None) or OXASL_STAGE_CACHE_DIR
+        cache_size = options.pop("cache-size", OXASL_CACHE_MB)
+        self.profiler.voxels = np.prod(self.data.grid.shape)
+
+        # Get the ROI and other input images first so invalid options are reported
+        # before any temporary files are created
         #
         # FIXME this is not great... We are assuming we know what 
         # options are actually images. Could the widgets themselves tell us?
+        images = {}
+        if "roi" in options:
+            images["mask"] = self.get_roi(options, self.data.grid)
+            self.profiler.voxels = np.count_nonzero(images["mask"].raw())
         for key in list(options.keys()):
             if key in self.IMAGE_OPTIONS:
                 data_name = options.pop(key)
                 if data_name:
-                    oxasl_options[key] = self.ivm.data[data_name]
+                    images[key] = self.ivm.data[data_name]
+
+        self._cache, self._cache_key = None, None
+        if use_cache and not self.debug_enabled():
+            self._cache = ResultCache(cache_dir, int(cache_size * 1e6))
+        if not use_stage_cache or self.debug_enabled():
+            stage_dir = None
+
+        # Create a temporary directory to store working data - this makes it
+        # easy to retrieve afterwards and reduces memory usage. Note that
+        # this is deleted in the `finished` method which is guaranteed to
+        # be called once the run has started. If output is cached the directory
+        # is created in the cache so it can be moved into it without copying
+        if self._cache is not None:
+            self._tempdir = self._cache.workdir()
+        else:
+            self._tempdir = tempfile.mkdtemp("qp_oxasl")
+
+        # Image data is passed to the worker in memory mapped files in a separate
+        # directory rather than being pickled. This is also deleted in `finished`
+        self._transferdir = tempfile.mkdtemp("qp_oxasl_input")
+
+        # Output images which cannot be mapped directly are decompressed into a
+        # separate directory so they are not included in cached output
+        self._scratchdir = tempfile.mkdtemp("qp_oxasl_scratch")
+        self.io_stats = {}
+        try:
+            self._start(options, images, stage_dir, cache_size)
+        except:
+            self._remove_workdirs()
+            raise
+
+    def _start(self, options, images, stage_dir, cache_size):
+        """
+        Transfer the input data and start the oxasl run in the background
+        """
+        oxasl_options = {
+            "debug" : self.debug_enabled(),
+            "savedir" : self._tempdir,
+            "save_report" : self._reportdir is not None,
+        }
 
-        # Copy all other options are remove them from the dictionary
+        # Copy all non-image options and remove them from the dictionary
         # to avoid any warnings about unused options
         for key in list(options.keys()):
             value = options.pop(key)
             if value is not None:
                 oxasl_options[key] = value
                 
-        self.expected_steps = [
-            ("Pre-processing", "Pre-processing"),
-            #("Registering", "Initial ASL->Structural registration"),
-            (".*initial fit", "Initial model fitting"),
-            (".*fit on full", "Model fitting to full data"),    
-            #("segmentation", "Segmenting structural image"),
-            #("BBR registration", "Final ASL->Structural registration"),
-        ]
+        self.expected_steps = list(OXASL_STAGES)
         self.current_step = 0
         # Pass FSLDIR and FSLDEVDIR to the process as it will not necessarily
         # inherit the environment and these might be configured by the user
@@ -537,24 +1399,121 @@ class OxaslProcess(LogProcess):
         if "FSLDEVDIR" in os.environ:
             fsldevdir = os.environ["FSLDEVDIR"]
         self._output_data_items = []
-        self.start_bg([fsldir, fsldevdir, self.data, oxasl_options])
+        self._output_images = {}
+        output_paths = list(self._expected_output.values()) + [path for path, _ in self.DEFAULT_OUTPUT]
+
+        # Keys are calculated from the data itself so cached output can be found
+        # before any data is transferred
+        stage_memo = None
+        if stage_dir is not None:
+            stage_memo = (stage_dir, int(cache_size * 1e6), self._fit_key(oxasl_options, images))
+        cached = None
+        if self._cache is not None:
+            self._cache_key = self._result_key(oxasl_options, images)
+            # Pin the entry as lazily loaded output is mapped from it
+            cached = self._cache.pin(self._cache_key)
+
+        if cached is None:
+            # For options which are images set the value to a descriptor for the shared data
+            for key, qpd in images.items():
+                oxasl_options[key] = self._share(qpd)
+            asldata = self._share(self.data)
+        self.debug("Image data transferred to worker: %.1f Mb", float(self.io_stats.get("transferred", 0)) / 1e6)
+        self.profiler.stop(voxels=np.prod(self.data.grid.shape), io_extra=profile_io_bytes(self.io_stats))
+
+        if cached is not None:
+            self.log("Loading cached output for identical inputs and options\n")
+            shutil.rmtree(self._tempdir)
+            self._tempdir = cached
+            self._cached = True
+            # Completed synchronously - ``execute`` calls ``finished`` to load the output
+            self._worker_output = []
+            self.status = Process.SUCCEEDED
+            return
+
+        self.start_bg([fsldir, fsldevdir, asldata, oxasl_options, output_paths, stage_memo, self._scratchdir])
+
+    def _remove_workdirs(self):
+        """
+        Remove the temporary output, scratch and input transfer directories
+        """
+        if self._tempdir:
+            if self.debug_enabled():
+                self.warn("Debug mode enabled - temporary output is in %s" % self._tempdir)
+            elif not self._lazy_data:
+                # Lazily loaded data is mapped from the output files, which are
+                # removed when the data is deleted (see ``SharedDir``)
+                shutil.rmtree(self._tempdir, ignore_errors=True)
+            self._tempdir = None
+        if self._scratchdir:
+            if not self._lazy_data:
+                shutil.rmtree(self._scratchdir, ignore_errors=True)
+            self._scratchdir = None
+        if self._transferdir:
+            shutil.rmtree(self._transferdir, ignore_errors=True)
+            self._transferdir = None
+
+    def _result_key(self, oxasl_options, images):
+        """
+        :param oxasl_options: Non-image oxasl options
+        :param images: Dictionary of option name to QpData for image options
+        :return: Key identifying the output from running oxasl with the given inputs
+        """
+        import oxasl
+        options = dict(oxasl_options)
+        options.pop("savedir", None)
+        for key, qpd in images.items():
+            options[key] = (qpd.raw(), qpd.grid.affine, qpd.metadata.get("AslData", {}))
+        return content_hash(getattr(oxasl, "__version__", ""), self.data.raw(), self.data.grid.affine,
+                            self._asl_metadata, options)
+
+    def _fit_key(self, oxasl_options, images):
+        """
+        :param oxasl_options: Non-image oxasl options
+        :param images: Dictionary of option name to QpData for image options
+        :return: Key identifying the oxasl options which can affect model fitting.
+                 Input data is not included as model fitting steps are keyed on the
+                 data they actually fit
+        """
+        import oxasl
+        options = {}
+        for key, value in oxasl_options.items():
+            if key not in OXASL_LATE_OPTIONS:
+                options[key] = value
+        for key, qpd in images.items():
+            if key not in OXASL_LATE_OPTIONS:
+                options[key] = (qpd.raw(), qpd.grid.affine)
+        return content_hash(getattr(oxasl, "__version__", ""), options)
+
+    def _share(self, qpd):
+        """
+        Get a descriptor for QpData which can be sent to the worker without pickling the data
+        """
+        return SharedImage.from_qpdata(qpd, self._transferdir, io_stats=self.io_stats)
 
     def finished(self, worker_output):
+        if self._tempdir is None:
+            # Output has already been loaded or the working directories removed
+            return
+
         try:
             self.debug("OXASL finished\n")
             self.debug("Expected output: %s", self._expected_output)
+            if worker_output and isinstance(worker_output[0], dict):
+                self._output_images = worker_output[0].get("images", {})
+                self.profiler.add(worker_output[0].get("profile", []), voxels=self.profiler.voxels)
 
-            # Load expected output
-            for name, path in self._expected_output.items():
-                self._load_expected_output(self._tempdir, path, name)
+            self.profiler.start("Output loading", io_stats=self.io_stats)
+            if self._cache is not None and not self._cached and self._output_images:
+                self._store_output()
 
-            # Load 'default' output
-            self._load_default_output(os.path.join(self._tempdir, "output"))
-            self._load_default_output(os.path.join(self._tempdir, "corrected"), suffix="_corr")
-            self._load_default_output(os.path.join(self._tempdir, "structural"), suffix="_struc")
-            self._load_default_output(os.path.join(self._tempdir, "calibration"), suffix="_calib")
-            self._load_default_output(os.path.join(self._tempdir, "basil"), suffix="_fitting")
-            self._load_default_output(os.path.join(self._tempdir, "reg"), suffix="_reg")
+            # Index expected and 'default' output, then load it
+            index = []
+            for name, path in self._expected_output.items():
+                self._index_expected_output(self._tempdir, path, name, index)
+            for path, suffix in self.DEFAULT_OUTPUT:
+                self._index_default_output(os.path.join(self._tempdir, path), index, suffix=suffix)
+            self._load_index(index)
 
             # Copy report and open if required
             if self._reportdir:
@@ -573,29 +1532,55 @@ class OxaslProcess(LogProcess):
                     webbrowser.open(indexurl, new=0, autoraise=True)
                 else:
                     self.warn("HTML report was requested but sphinx was not available")
+            self.profiler.stop()
+            save_profile(self, self.profiler, "oxasl_profile", self._profile_file)
         finally:
-            if self._tempdir:
-                if not self.debug_enabled():
-                    shutil.rmtree(self._tempdir)
-                else:
-                    self.warn("Debug mode enabled - temporary output is in %s" % self._tempdir)
-                self.tempdir = None
+            if self._cached:
+                # Output was loaded from the cache which manages its own files. Lazily
+                # loaded data keeps the entry pinned until it is deleted
+                if not self._lazy_data:
+                    self._cache.unpin(self._cache_key)
+                self._tempdir = None
+            self._remove_workdirs()
+            self._shared_dir = None
 
     def output_data_items(self):
         return self._output_data_items
 
-    def _load_expected_output(self, outdir, path, name):
+    def _store_output(self):
+        """
+        Move the output directory into the result cache and pin it while output is loaded from it
+        """
+        path = self._cache.put(self._cache_key, self._tempdir, move=True, pin=True)
+        if path is None:
+            self.warn("Failed to cache oxasl output")
+            return
+
+        for shared in self._output_images.values():
+            if shared.fname.startswith(self._tempdir + os.sep):
+                shared.fname = os.path.join(path, os.path.relpath(shared.fname, self._tempdir))
+        if os.path.isdir(self._tempdir):
+            # Entry already existed, e.g. from a concurrent run
+            shutil.rmtree(self._tempdir, ignore_errors=True)
+        self._tempdir = path
+        self._cached = True
+
+    def _index_expected_output(self, outdir, path, name, index):
         path = os.path.join(outdir, path + ".*")
         self.debug("Looking for item: %s", path)
         matches = glob.glob(path)
         for fname in matches:
             self.debug("Found: %s", fname)
             # FIXME could be roi?
-            self._load(fname, name)
+            index.append((fname, name, False))
 
-    def _load_default_output(self, outdir, suffix=""):
+    def _index_default_output(self, outdir, index, suffix=""):
         """ 
-        Recursively load output images into the IVM. 
+        Recursively find output files to load into the IVM
+
+        :param outdir: Output directory to search
+        :param index: List to which tuples of (file name, data name, is ROI) are added
+        :param suffix: Suffix to add to data names
         """
         self.debug("output from: %s", outdir)
         files = glob.glob(os.path.join(outdir, "*"))
@@ -603,34 +1588,246 @@ class OxaslProcess(LogProcess):
             self.debug("found %s", fname)
             name = os.path.basename(fname).split(".", 1)[0]
             if os.path.isdir(fname):
-                self._load_default_output(fname, suffix + "_" + name)
+                self._index_default_output(fname, index, suffix + "_" + name)
+            else:
+                index.append((fname, name + suffix, "mask" in name))
+
+    def _load_index(self, index):
+        """
+        Load indexed output files into the IVM
+
+        Non-image output is loaded immediately. In lazy mode images are added as
+        placeholders which map the output file when the data is first accessed.
+        Otherwise images are read in parallel using a thread pool.
+        """
+        images = []
+        for fname, name, is_roi in index:
+            extension = self._extension(fname)
+            if extension in ('nii', 'nii.gz'):
+                images.append((fname, name, is_roi))
             else:
-                is_roi = "mask" in name
-                self.debug("trying to load %s", fname)
-                self._load(fname, name + suffix, is_roi)
+                self._load(fname, name, extension)
+
+        self.debug("Loading %i images (lazy=%s)", len(images), self._lazy_load)
+        shared = []
+        for fname, name, is_roi in images:
+            try:
+                shared.append((self._shared_output(fname), name, is_roi))
+            except:
+                self.warn("Failed to load: %s", fname)
+                traceback.print_exc()
+
+        if self._lazy_load:
+            for desc, name, is_roi in shared:
+                self._add_output(SharedImageData(desc, name=self._output_prefix + name, roi=is_roi,
+                                                 owner=self._output_owner()))
+                self._lazy_data = True
+        elif shared:
+            pool = ThreadPool(min(self._load_threads, len(shared)))
+            try:
+                # Remember this is from temporary files so need to copy the actual data
+                arrays = pool.map(lambda item: np.array(item[0].array()), shared)
+            finally:
+                pool.close()
+            self.io_stats["loaded"] = self.io_stats.get("loaded", 0) + sum(data.nbytes for data in arrays)
+            for (desc, name, is_roi), data in zip(shared, arrays):
+                qpdata = NumpyData(data, grid=DataGrid(desc.shape[:3], desc.affine), name=self._output_prefix + name, roi=is_roi)
+                self._add_output(qpdata)
+
+    def _output_owner(self):
+        """
+        :return: ``SharedDir`` which keeps the output directory until lazily loaded data is deleted
+        """
+        if self._shared_dir is None:
+            tempdir, scratchdir = self._tempdir, self._scratchdir
+            if self._cached:
+                cache, key = self._cache, self._cache_key
+                release_output = lambda: cache.unpin(key)
+            elif self.debug_enabled():
+                release_output = lambda: None
+            else:
+                release_output = lambda: shutil.rmtree(tempdir, ignore_errors=True)
+
+            def _release():
+                release_output()
+                if scratchdir:
+                    shutil.rmtree(scratchdir, ignore_errors=True)
+            self._shared_dir = SharedDir(self._tempdir, _release)
+        return self._shared_dir
+
+    def _extension(self, fname):
+        parts = os.path.basename(fname).split(".", 1)
+        if len(parts) > 1: 
+            return parts[1]
+        else:
+            return ""
 
-    def _load(self, fname, name, is_roi=False):
+    def _shared_output(self, fname):
+        """
+        Get a descriptor for an output image, using the one returned by the worker if available
+        """
+        relpath = os.path.relpath(fname, self._tempdir).replace(os.sep, "/").split(".", 1)[0]
+        shared = self._output_images.get(relpath, None)
+        if shared is None:
+            shared = SharedImage.from_nifti(fname, dirname=self._scratchdir)
+        return shared
+
+    def _add_output(self, qpdata):
+        self._output_data_items.append(qpdata.name)
+        self.ivm.add(qpdata)
+
+    def _load(self, fname, name, extension):
         try:
-            extension = ""
-            parts = fname.split(".", 1)
-            if len(parts) > 1: 
-                extension = parts[1]
             self.debug("Loading: %s (%s)", fname, extension)
             if extension == 'mat':
                 mat, _rows, _cols = load_matrix(fname)
                 extra = MatrixExtra(name, mat)
                 self.ivm.add_extra(name, extra)
             elif extension == 'csv':
+                import pandas as pd
                 df = pd.read_csv(fname)
                 extra = DataFrameExtra(name, df)
                 self.ivm.add_extra(name, extra)
-            elif extension in ('nii', 'nii.gz'):
-                self.debug("Nifti data")
-                qpdata = load(fname)
-                # Remember this is from a temporary file so need to copy the actual data
-                qpdata = NumpyData(qpdata.raw(), grid=qpdata.grid, name=self._output_prefix + name, roi=is_roi)
-                self._output_data_items.append(name)
-                self.ivm.add(qpdata)
         except:
             self.warn("Failed to load: %s", fname)
             traceback.print_exc()
+
+class OxaslCohortProcess(Process):
+    """
+    Process which runs oxasl on a cohort of subjects with the same options
+
+    Each subject is run by a separate OxaslProcess, with at most ``max-concurrent``
+    running at once. Output for each subject is loaded with the subject ID as a prefix
+    """
+    PROCESS_NAME = "OxaslCohort"
+
+    # Columns of the per-subject status table
+    STATUS_COLUMNS = ["subject", "status", "wall_time", "outputs", "error"]
+
+    def __init__(self, ivm, **kwargs):
+        Process.__init__(self, ivm, **kwargs)
+        self._pending = []
+        self._running = {}
+        self._progress = {}
+        self._status = {}
+        self._start_times = {}
+        self._output_data_items = []
+        self._max_concurrent = 1
+        self._status_name = "oxasl_cohort_status"
+
+    def run(self, options):
+        """
+        Start running oxasl on each subject
+
+        ``subjects`` is either a mapping from subject ID to the options specific to that
+        subject (e.g. ``data``, ``calib``, ``struc``) or a list of such options each
+        containing an ``id``. All other options are passed to every subject.
+        """
+        subjects = options.pop("subjects", None)
+        if not subjects:
+            raise QpException("No subjects given")
+        if not isinstance(subjects, dict):
+            subjects = dict((subj.pop("id"), subj) for subj in [dict(subj) for subj in subjects])
+        self._max_concurrent = max(1, int(options.pop("max-concurrent", multiprocessing.cpu_count())))
+        self._status_name = options.pop("status-name", "oxasl_cohort_status")
+
+        common_prefix = options.pop("output-prefix", "")
+        reportdir = options.pop("report", None)
+        self._pending = []
+        for subj_id in sorted(subjects.keys(), key=str):
+            subj_options = dict(options)
+            subj_options.update(subjects[subj_id])
+            subj_options["output-prefix"] = "%s%s_" % (common_prefix, subj_id)
+            if reportdir:
+                subj_options["report"] = os.path.join(reportdir, str(subj_id))
+            self._pending.append((subj_id, subj_options))
+
+        # Shared options have been copied to each subject
+        for key in list(options.keys()):
+            options.pop(key)
+
+        self._running = {}
+        self._progress = dict((subj_id, 0.0) for subj_id, _ in self._pending)
+        self._status = dict((subj_id, ("PENDING", None, 0, "")) for subj_id, _ in self._pending)
+        self._start_times = {}
+        self._output_data_items = []
+        self.exception = None
+        self.status = Process.RUNNING
+        self.debug("Oxasl cohort: %i subjects, max %i concurrent", len(self._pending), self._max_concurrent)
+        self._update_status()
+        self._start_next()
+
+    def cancel(self):
+        """ Cancel all running subjects and do not start any more """
+        for subj_id, _ in self._pending:
+            self._status[subj_id] = ("CANCELLED", None, 0, "")
+        self._pending = []
+        for process in list(self._running.values()):
+            process.cancel()
+
+    def output_data_items(self):
+        """ :return: list of data items output by the process """
+        return self._output_data_items
+
+    def _start_next(self):
+        while self._pending and len(self._running) < self._max_concurrent:
+            subj_id, subj_options = self._pending.pop(0)
+            process = OxaslProcess(self.ivm)
+            process.sig_finished.connect(lambda status, log, exc, subj_id=subj_id: self._subject_finished(subj_id, status, log, exc))
+            process.sig_progress.connect(lambda complete, subj_id=subj_id: self._subject_progress(subj_id, complete))
+            self._running[subj_id] = process
+            self._start_times[subj_id] = time.time()
+            self._status[subj_id] = ("RUNNING", None, 0, "")
+            self.debug("Oxasl cohort: starting subject %s", subj_id)
+            try:
+                process.execute(subj_options)
+            except Exception as exc:
+                self._subject_finished(subj_id, Process.FAILED, "", exc)
+
+        if not self._running and self.status == Process.RUNNING:
+            self._all_finished()
+
+    def _subject_finished(self, subj_id, status, log, exception):
+        process = self._running.pop(subj_id, None)
+        if process is None:
+            return
+
+        self.log("Subject %s: %s\n" % (subj_id, status_name(status)))
+        self.log(log + "\n")
+        outputs = list(process.output_data_items()) if status == Process.SUCCEEDED else []
+        self._output_data_items.extend(outputs)
+        self._progress[subj_id] = 1.0
+        self._status[subj_id] = (status_name(status), time.time() - self._start_times[subj_id],
+                                 len(outputs), str(exception) if exception is not None else "")
+        self._update_status()
+        self._emit_progress()
+        self._start_next()
+
+    def _subject_progress(self, subj_id, complete):
+        if subj_id in self._running:
+            self._progress[subj_id] = complete
+            self._emit_progress()
+
+    def _emit_progress(self):
+        if self._progress:
+            self.sig_progress.emit(sum(self._progress.values()) / len(self._progress))
+
+    def _update_status(self):
+        import pandas as pd
+        rows = [[subj_id] + list(self._status[subj_id]) for subj_id in sorted(self._status.keys(), key=str)]
+        df = pd.DataFrame(rows, columns=self.STATUS_COLUMNS)
+        self.ivm.add_extra(self._status_name, DataFrameExtra(self._status_name, df))
+
+    def _all_finished(self):
+        failed = [str(subj_id) for subj_id, status in self._status.items() if status[0] != "SUCCEEDED"]
+        if not failed:
+            self.status = Process.SUCCEEDED
+        elif all(self._status[subj_id][0] == "CANCELLED" for subj_id in self._status if str(subj_id) in failed):
+            self.status = Process.CANCELLED
+        else:
+            self.status = Process.FAILED
+            self.exception = QpException("Oxasl failed for subjects: %s" % ", ".join(sorted(failed)))
+        self.log("COMPLETE\n")
+        # Subjects may all finish during run(), so complete via the base class
+        # to make sure sig_finished is only emitted once
+        self._complete()
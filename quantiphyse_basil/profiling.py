@@ -0,0 +1,199 @@
+"""
+QP-BASIL - Per-step profiling of ASL processes
+
+Records wall time, CPU time, memory high water mark, voxels processed and
+bytes of image I/O for each step of a process so that performance can be
+compared between runs and releases.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+import json
+import re
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Keys in process I/O statistics dictionaries which count bytes of image data
+IO_KEYS = ("borrowed", "copied", "transferred", "loaded")
+
+COLUMNS = ["step", "status", "wall_time", "cpu_time", "peak_rss_mb", "voxels", "io_bytes"]
+
+def io_bytes(io_stats):
+    """
+    :return: Total bytes of image data in I/O statistics dictionary
+    """
+    if not io_stats:
+        return 0
+    return sum(io_stats.get(key, 0) for key in IO_KEYS)
+
+def cpu_time():
+    """
+    :return: CPU time used by this process and its terminated child processes in seconds
+    """
+    if resource is None:
+        return time.process_time() if hasattr(time, "process_time") else time.clock()
+    total = 0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+def peak_rss_mb():
+    """
+    :return: High water mark of resident memory of this process or any terminated
+             child process in Mb, or None if this cannot be determined. On Windows
+             this is the peak working set of this process only, and requires psutil
+    """
+    if resource is None:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        # Only the Windows memory info includes a high water mark
+        peak = getattr(psutil.Process().memory_info(), "peak_wset", None)
+        return None if peak is None else peak / 1e6
+    maxrss = max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+    # ru_maxrss is in bytes on Mac and kilobytes elsewhere
+    if sys.platform == "darwin":
+        return maxrss / 1e6
+    return maxrss / 1e3
+
+class StepProfiler(object):
+    """
+    Collects a profile record for each step of a process
+
+    Steps are timed from ``start`` to ``stop``, or to the start of the next step.
+    Note that memory usage is a high water mark for the process, so it is only
+    meaningful as the peak usage up to the end of each step.
+    """
+
+    def __init__(self, voxels=0):
+        """
+        :param voxels: Default number of voxels processed by each step
+        """
+        self.voxels = voxels
+        self.records = []
+        self._current = None
+
+    def start(self, step, voxels=None, io_stats=None):
+        """
+        Start timing a step, stopping the current one if there is one
+
+        :param step: Step description
+        :param voxels: Number of voxels processed by the step, if different from the default
+        :param io_stats: I/O statistics dictionary - bytes counted in it during
+                         the step are recorded
+        """
+        if self._current is not None:
+            self.stop()
+        self._current = {
+            "step" : step,
+            "voxels" : self.voxels if voxels is None else voxels,
+            "io_stats" : io_stats,
+            "io_start" : io_bytes(io_stats),
+            "wall_start" : time.time(),
+            "cpu_start" : cpu_time(),
+        }
+
+    def stop(self, status="SUCCEEDED", voxels=None, io_extra=0):
+        """
+        Stop timing the current step and record it
+
+        :param status: Status of the step
+        :param voxels: Number of voxels processed, if not known when the step was started
+        :param io_extra: Bytes of I/O not counted in the step's I/O statistics
+        """
+        current = self._current
+        if current is None:
+            return
+        self._current = None
+        self.records.append({
+            "step" : current["step"],
+            "status" : status,
+            "wall_time" : time.time() - current["wall_start"],
+            "cpu_time" : cpu_time() - current["cpu_start"],
+            "peak_rss_mb" : peak_rss_mb(),
+            "voxels" : int(current["voxels"] if voxels is None else voxels),
+            "io_bytes" : int(io_bytes(current["io_stats"]) - current["io_start"] + io_extra),
+        })
+
+    def add(self, records, voxels=None):
+        """
+        Add records collected elsewhere, e.g. by a worker process
+
+        :param records: Sequence of profile record dictionaries
+        :param voxels: If specified, override the number of voxels in the records
+        """
+        for record in records:
+            record = dict((key, record.get(key, None)) for key in COLUMNS)
+            if voxels is not None:
+                record["voxels"] = int(voxels)
+            self.records.append(record)
+
+    def dataframe(self):
+        """
+        :return: pandas.DataFrame with one row per step
+        """
+        import pandas as pd
+        return pd.DataFrame(self.records, columns=COLUMNS)
+
+    def save_json(self, fname, **info):
+        """
+        Write the profile to a JSON file
+
+        :param fname: File name
+        :param info: Additional information to include, e.g. the process name
+        """
+        with open(fname, "w") as jsonfile:
+            json.dump(dict(info, steps=self.records), jsonfile, indent=2)
+
+class StageMonitor(object):
+    """
+    Output stream wrapper which profiles stages of a pipeline identified from its log
+
+    Each time a line of output matches the pattern for a stage the previous
+    stage is stopped and the new one started.
+    """
+
+    def __init__(self, stream, stages, voxels=0):
+        """
+        :param stream: Stream to which output is passed on
+        :param stages: Sequence of (regular expression, stage description)
+        :param voxels: Number of voxels processed by each stage
+        """
+        self.stream = stream
+        self.stages = [(re.compile(regex), desc) for regex, desc in stages]
+        self.profiler = StepProfiler(voxels)
+        self.profiler.start("Setup")
+
+    def write(self, text):
+        for line in text.splitlines():
+            for regex, desc in self.stages:
+                if regex.match(line):
+                    self.profiler.start(desc)
+                    break
+        self.stream.write(text)
+
+    def flush(self):
+        if hasattr(self.stream, "flush"):
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        # Pass anything else on to the wrapped stream
+        if name == "stream":
+            raise AttributeError(name)
+        return getattr(self.stream, name)
+
+    def finish(self, status="SUCCEEDED"):
+        """
+        Stop profiling the last stage
+
+        :return: List of profile records
+        """
+        self.profiler.stop(status)
+        return self.profiler.records
@@ -0,0 +1,211 @@
+"""
+QP-BASIL - Fitting of the expected ASL signal structure to a mean signal
+
+The expected signal for a given data ordering has one value for each TI/PLD
+repeated over label/control images and repeats. This is linear in the
+time-dependent values, so the least squares fit is just the mean of the
+signal values for each TI/PLD.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+from __future__ import division
+
+import itertools
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .cache import data_key, FINGERPRINT_SAMPLES
+
+# Maximum number of voxels used to find the representative signal for the signal
+# preview and order autodetection. Subsampling is opt-in: by default all voxels
+# are used so the signal is exactly that of the full data. Set this to a number
+# of voxels to subsample larger data sets so a cache miss reads only part of the data
+MAX_SIGNAL_VOXELS = None
+
+# Number of representative signals which are cached
+SIGNAL_CACHE_SIZE = 8
+
+_signal_cache = OrderedDict()
+_signal_cache_lock = threading.Lock()
+
+def percentile(values, pct):
+    """
+    Percentile of a 1D array, using a partial sort
+
+    This gives the same result as ``np.percentile`` with linear interpolation
+    but only partitions the array around the required elements
+
+    :param values: 1D Numpy array. This is not modified
+    :param pct: Percentile, 0-100
+    """
+    pos = (len(values) - 1) * pct / 100.0
+    low, high = int(np.floor(pos)), int(np.ceil(pos))
+    parts = np.partition(values, [low, high])
+    return parts[low] + (parts[high] - parts[low]) * (pos - low)
+
+def mean_signal(rawdata, max_voxels=None):
+    """
+    Get a representative signal from 4D ASL data
+
+    This is the mean signal over the voxels whose range of values is in the top 1%,
+    which are expected to be those with the clearest ASL signal
+
+    :param rawdata: 4D Numpy array
+    :param max_voxels: If specified, use a regular subsample of at most this many voxels
+    :return: 1D array with one value per volume
+    """
+    nvoxels = int(np.prod(rawdata.shape[:-1]))
+    if max_voxels and nvoxels > max_voxels:
+        # Subsample with the same stride in each spatial dimension. This is a view
+        # so only the sampled voxels are read, whatever the memory layout
+        stride = int(np.ceil((float(nvoxels) / max_voxels) ** (1.0 / (rawdata.ndim - 1))))
+        rawdata = rawdata[(slice(None, None, stride),) * (rawdata.ndim - 1)]
+    voxels = rawdata.reshape((-1, rawdata.shape[-1]))
+    voxel_range = np.nanmax(voxels, axis=-1) - np.nanmin(voxels, axis=-1)
+    good_signal = percentile(voxel_range, 99)
+    good_signals = voxels[voxel_range >= good_signal]
+    return np.mean(good_signals, axis=0)
+
+def signal_source(qpd):
+    """
+    Get the arguments to ``cached_mean_signal`` for a QpData object
+
+    This accesses the QpData object so should be called on the GUI thread. The
+    key is the data object, its voxel array and a sampled fingerprint of its
+    contents, so it is cheap to calculate and does not read all of the data.
+    It changes if different data is used, the array is replaced or a sampled
+    value is modified in place. In-place modifications which change none of
+    the sampled values are not detected
+
+    :param qpd: QpData containing 4D ASL data
+    :return: Tuple of (voxel data array, key)
+    """
+    return qpd.raw(), data_key(qpd, FINGERPRINT_SAMPLES)
+
+def cached_mean_signal(rawdata, key, max_voxels=None):
+    """
+    Get the representative signal for ASL data, caching the result
+
+    A cache hit does not read the voxel data. This does not access QpData so
+    may be called from a background thread
+
+    :param rawdata: 4D Numpy array of ASL data
+    :param key: Key identifying the data and its contents, see ``signal_source``
+    :param max_voxels: Subsample data with more than this many voxels - None to use all voxels
+    :return: 1D array with one value per volume
+    """
+    key = (key, max_voxels)
+    with _signal_cache_lock:
+        signal = _signal_cache.pop(key, None)
+        if signal is not None:
+            _signal_cache[key] = signal
+            return signal
+
+    signal = mean_signal(rawdata, max_voxels)
+    signal.flags.writeable = False
+    with _signal_cache_lock:
+        _signal_cache[key] = signal
+        while len(_signal_cache) > SIGNAL_CACHE_SIZE:
+            _signal_cache.popitem(last=False)
+    return signal
+
+def tdep_index(order, num):
+    """
+    Get the index of the time-dependent value for each volume in a data ordering
+
+    :param order: Order string, e.g. 'lrt'. The first character varies fastest
+    :param num: Mapping from order character to number of items, e.g. ``{"l" : 2, "r" : 4, "t" : 6}``
+    :return: Integer array with one entry per volume
+    """
+    dims = [num[char] for char in order[::-1]]
+    nvols = int(np.prod(dims))
+    if "t" not in order:
+        return np.zeros(nvols, dtype=np.intp)
+    return np.unravel_index(np.arange(nvols), dims)[order[::-1].index("t")]
+
+def initial_tdep(signal, ntimes):
+    """
+    :return: Initial values of the time-dependent parameters, used for any which are not fitted
+    """
+    sigmin, sigmax = np.min(signal), np.max(signal)
+    sigrange = sigmax - sigmin
+    if sigrange == 0:
+        sigrange = 1
+    return sigrange * np.arange(ntimes)[::-1] + sigmin
+
+def fit_signal(signal, order, num):
+    """
+    Fit the signal expected from a data ordering to a mean signal
+
+    The fitted signal is compared with the mean signal volume by volume. If
+    the mean signal has more volumes than the ordering implies the extra volumes
+    contribute their full value to the cost.
+
+    :param signal: Mean signal, one value per volume
+    :param order: Order string
+    :param num: Mapping from order character to number of items
+    :return: Tuple of (fitted signal, cost). The cost is half the sum of squared residuals
+    """
+    signal = np.asarray(signal, dtype=np.float64)
+    ntimes = num.get("t", 1)
+    t_index = tdep_index(order, num)
+    nfit = min(len(signal), len(t_index))
+
+    counts = np.bincount(t_index[:nfit], minlength=ntimes)
+    sums = np.bincount(t_index[:nfit], weights=signal[:nfit], minlength=ntimes)
+    tdep = initial_tdep(signal, ntimes)
+    fitted = counts > 0
+    tdep[fitted] = sums[fitted] / counts[fitted]
+
+    fitted_signal = tdep[t_index]
+    residuals = signal.copy()
+    residuals[:nfit] -= fitted_signal[:nfit]
+    return fitted_signal, 0.5 * np.sum(np.square(residuals))
+
+def rank_orders(signal, order, variants):
+    """
+    Score every permutation of a data ordering against a mean signal
+
+    All candidate orderings are fitted together: the TI index of each volume for
+    each candidate is offset so that a single ``bincount`` gives the fitted values
+    for all of them, and a second gives the costs.
+
+    :param signal: Mean signal, one value per volume
+    :param order: Order string whose permutations are tried
+    :param variants: Sequence of mappings from order character to number of items,
+                     e.g. with different numbers of repeats or phases. Every
+                     permutation is tried with each of these
+    :return: List of (cost, order string, number of items mapping) sorted by
+             increasing cost. Where costs are equal, the candidate from the earlier
+             variant and permutation is ranked first
+    """
+    signal = np.asarray(signal, dtype=np.float64)
+    candidates = []
+    for num in variants:
+        for trial in itertools.permutations(order):
+            trial = "".join(trial)
+            if (trial, num) not in candidates:
+                candidates.append((trial, num))
+
+    maxt = max(num.get("t", 1) for _, num in candidates)
+    bins, cands, values, tail_cost = [], [], [], []
+    for cand_idx, (trial, num) in enumerate(candidates):
+        t_index = tdep_index(trial, num)
+        nfit = min(len(signal), len(t_index))
+        bins.append(t_index[:nfit] + cand_idx * maxt)
+        cands.append(np.full(nfit, cand_idx, dtype=np.intp))
+        values.append(signal[:nfit])
+        tail_cost.append(np.sum(np.square(signal[nfit:])))
+    bins, cands, values = np.concatenate(bins), np.concatenate(cands), np.concatenate(values)
+
+    nbins = len(candidates) * maxt
+    counts = np.bincount(bins, minlength=nbins)
+    sums = np.bincount(bins, weights=values, minlength=nbins)
+    tdep = sums / np.maximum(counts, 1)
+    residuals = values - tdep[bins]
+    costs = 0.5 * (np.bincount(cands, weights=np.square(residuals), minlength=len(candidates)) + tail_cost)
+
+    ranking = sorted(range(len(candidates)), key=lambda idx: (costs[idx], idx))
+    return [(float(costs[idx]), candidates[idx][0], dict(candidates[idx][1])) for idx in ranking]
@@ -5,18 +5,53 @@ Copyright (c) 2013-2018 University of Oxford
 """
 import sys
 import os
+import gc
+import glob
+import time
+import shutil
+import threading
+import tempfile
 import unittest 
 
+import six
 import numpy as np
 
-from quantiphyse.data import NumpyData
+try:
+    from PySide import QtCore
+except ImportError:
+    from PySide2 import QtCore
+
+from quantiphyse.data import NumpyData, DataGrid, ImageVolumeManagement, load
 from quantiphyse.processes import Process
-from quantiphyse.test import WidgetTest, ProcessTest
+from quantiphyse.utils import QpException
+from quantiphyse.gui.widgets import QpWidget
+from quantiphyse.test import WidgetTest, ProcessTest, create_test_data
 
-from .widgets import AslPreprocWidget
-from .aslimage_widget import LabelType, DataOrdering, ORDER_LABELS
+from .widgets import AslPreprocWidget, AslCalibWidget
+from . import process as basil_process
+from .process import AslPreprocProcess, AslCalibProcess, BasilProcess, OxaslProcess, OxaslCohortProcess, memo_basil_steps, MemoStep, MEMO_ATTR, _workspace_basil_steps, qp_oxasl
+from .process import partition_mask, merge_partitions, cropped_grid, validate_asl_metadata
+from .preproc import PreprocPlan, apply_ops
+from .calibration import m0_factors
+from .transfer import SharedImage, SharedImageData, SharedDir, mapped_data, nifti_descriptors
+from .cache import ResampleCache, ResultCache, Checkpoint, data_key, FINGERPRINT_SAMPLES
+from .sigfit import percentile, mean_signal, signal_source, cached_mean_signal, tdep_index, fit_signal, rank_orders
+from .aslimage_widget import LabelType, DataOrdering, ORDER_LABELS, autodetect_order
+from .background import BackgroundExecutor
+from .profiling import StepProfiler, StageMonitor, COLUMNS
 from .oxasl_widgets import OxaslWidget
 
+def _qt_app():
+    """
+    Make sure there is a Qt application, which is not the case when unit tests
+    are run outside Quantiphyse
+    """
+    global _APP
+    if QtCore.QCoreApplication.instance() is None:
+        _APP = QtCore.QCoreApplication(sys.argv)
+
+_APP = None
+
 def _struc_widget(aslimage_widget, cls):
     for view in aslimage_widget.views:
         if isinstance(view, cls):
@@ -77,6 +112,28 @@ class AslPreprocWidgetTest(WidgetTest):
         self.assertEqual(len(self.ivm.data), 1)
         self.assertTrue("data_4d" in self.ivm.data)
 
+    def testPwiButton(self):
+        """
+        Check a PWI can only be generated for label-control data with consistent metadata
+        """
+        self.ivm.add(np.random.rand(*(list(self.grid.shape) + [3])), grid=self.grid, name="data_odd")
+        self.w.aslimage_widget.set_data_name("data_odd")
+        self.processEvents()
+        label_type_widget = _struc_widget(self.w.aslimage_widget, LabelType)
+        label_type_widget.combo.setCurrentIndex(0)
+        self.processEvents()
+        self.assertFalse(label_type_widget.pwi_btn.isEnabled())
+
+        self.ivm.add(self.data_4d, grid=self.grid, name="data_4d")
+        self.w.aslimage_widget.set_data_name("data_4d")
+        self.processEvents()
+        label_type_widget.combo.setCurrentIndex(0)
+        self.processEvents()
+        self.assertTrue(label_type_widget.pwi_btn.isEnabled())
+        label_type_widget.combo.setCurrentIndex(2)
+        self.processEvents()
+        self.assertFalse(label_type_widget.pwi_btn.isEnabled())
+
     def testDiff(self):
         """
         Check a single-ti data set with tag-control differencing
@@ -168,6 +225,58 @@ class AslPreprocWidgetTest(WidgetTest):
         meandata_test = np.mean(diffdata_test, axis=-1)
         self.assertTrue(np.allclose(meandata_test, meandata.raw()))
 
+    def testCoalescedUpdates(self):
+        """
+        Check a burst of metadata changes is applied in a single update
+        """
+        self.ivm.add(self.data_4d, grid=self.grid, name="data_4d")
+        aslimage_widget = self.w.aslimage_widget
+        aslimage_widget.set_data_name("data_4d")
+        self.processEvents()
+        changes = []
+        aslimage_widget.sig_changed.connect(lambda: changes.append(dict(aslimage_widget.md)))
+        requested, avoided = aslimage_widget.updates_requested, aslimage_widget.updates_avoided
+
+        label_type_widget = _struc_widget(aslimage_widget, LabelType)
+        for idx in (1, 0, 1):
+            label_type_widget.combo.setCurrentIndex(idx)
+        self.assertEqual(len(changes), 0)
+        self.processEvents()
+        self.assertFalse(self.error)
+
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0]["iaf"], "ct")
+        self.assertEqual(self.ivm.data["data_4d"].metadata["AslData"]["iaf"], "ct")
+        self.assertEqual(aslimage_widget.updates_requested - requested, 3)
+        self.assertEqual(aslimage_widget.updates_avoided - avoided, 2)
+
+    def testAutodetectRepeats(self):
+        """
+        Check autodetection replaces an explicit number of repeats which does not fit the data
+        """
+        num = {"l" : 2, "r" : 3, "t" : 4}
+        signal = np.array([4.0, 1.0, 3.0, 2.0])[tdep_index("lrt", num)]
+        scale = np.random.uniform(1, 2, size=list(self.grid.shape))
+        qpd = NumpyData(scale[..., np.newaxis] * signal, grid=self.grid, name="data_rpts")
+        qpd.metadata["AslData"] = {"iaf" : "tc", "ibf" : "rpt", "plds" : [1.0, 1.5, 2.0, 2.5], "nrpts" : 1}
+        self.ivm.add(qpd)
+        aslimage_widget = self.w.aslimage_widget
+        aslimage_widget.set_data_name("data_rpts")
+        self.processEvents()
+
+        ordering = _struc_widget(aslimage_widget, DataOrdering)
+        ranked = autodetect_order(dict(ordering.md), ordering.data, signal_source(ordering.data))
+        _cost, best_order, best_md = ranked[0]
+        self.assertEqual(best_order, "lrt")
+        self.assertFalse("nrpts" in best_md)
+
+        ordering._autodetect_done(ranked)
+        aslimage_widget.flush_updates()
+        self.assertFalse(self.error)
+        self.assertFalse("nrpts" in aslimage_widget.md)
+        self.assertEqual(aslimage_widget.md["ibf"], "tis")
+        self.assertFalse("nrpts" in self.ivm.data["data_rpts"].metadata["AslData"])
+
     def testReorder(self):
         """
         Check a single-ti data set with reordering to 'all tags' then 'all controls'
@@ -208,6 +317,930 @@ class AslPreprocWidgetTest(WidgetTest):
             reordered_test[..., v+int(shape[3]/2)] = self.data_4d[..., 2*v+1]
         self.assertTrue(np.allclose(reordered_test, reordered_data.raw()))
 
+class AslCalibWidgetTest(WidgetTest):
+    """ Tests for the calibration widget """
+
+    def widget_class(self):
+        return AslCalibWidget
+
+    def _select(self, combo, name):
+        combo.setCurrentIndex(combo.findText(name))
+
+    def testLiveUpdate(self):
+        """
+        Check a burst of parameter changes results in one background calibration
+        which gives the same output as running the process
+        """
+        self.ivm.add(self.data_3d, grid=self.grid, name="perf")
+        self.ivm.add(np.abs(self.data_3d) + 1, grid=self.grid, name="calib")
+        self.ivm.add(np.ones(self.grid.shape, dtype=np.int32), grid=self.grid, name="mask", roi=True)
+        self.processEvents()
+        self._select(self.w.data, "perf")
+        self._select(self.w.calib_img, "calib")
+        self._select(self.w.roi, "mask")
+        self.w.live_update.setChecked(True)
+        for alpha in (0.9, 0.8, 0.7):
+            self.w.alpha.spin.setValue(alpha)
+        self.assertFalse(self.w._executor.is_running("calibrate"))
+        self.assertTrue(self.w._update_timer.isActive())
+
+        start = time.time()
+        while (self.w._update_timer.isActive() or self.w._executor.is_running("calibrate")) and time.time() - start < 10:
+            self.processEvents()
+            time.sleep(0.01)
+        self.assertFalse(self.error)
+        self.assertTrue("perf_calib" in self.ivm.data)
+        live = np.array(self.ivm.data["perf_calib"].raw())
+        AslCalibProcess(self.ivm).run(self.w.get_options())
+        self.assertTrue(np.allclose(live, self.ivm.data["perf_calib"].raw()))
+
+class AslPreprocProcessTest(ProcessTest):
+    """ Tests for the preprocessing process """
+
+    def _run(self, output_name, **kwargs):
+        options = {
+            "data" : "data_4d",
+            "iaf" : "tc",
+            "ibf" : "tis",
+            "tis" : [1.5],
+            "output-name" : output_name,
+        }
+        options.update(kwargs)
+        AslPreprocProcess(self.ivm).run(options)
+        return self.ivm.data[output_name]
+
+    def testStream(self):
+        """
+        Check preprocessing one slice at a time gives the same output as processing all the data
+        """
+        self.ivm.add(self.data_4d, grid=self.grid, name="data_4d")
+        for ops in ({"diff" : True}, {"diff" : True, "mean" : True}, {"pwi" : True}, {"reorder" : "rtl"}):
+            full = self._run("full", stream=False, **ops)
+            streamed = self._run("streamed", stream=True, **dict(ops, **{"chunk-size" : 1e-6}))
+            self.assertEqual(full.raw().shape, streamed.raw().shape)
+            self.assertTrue(np.allclose(full.raw(), streamed.raw()))
+            self.assertEqual(full.metadata.get("AslData", None), streamed.metadata.get("AslData", None))
+
+    def testInconsistentMetadata(self):
+        """
+        Check metadata which is inconsistent with the data is rejected
+        """
+        self.ivm.add(self.data_4d, grid=self.grid, name="data_4d")
+        with self.assertRaises(ValueError):
+            self._run("bad", diff=True, rpts=[self.data_4d.shape[3] + 1])
+        self.assertFalse("bad" in self.ivm.data)
+
+    def testFused(self):
+        """
+        Check the fused preprocessing plan matches applying the oxasl operations one at a time
+        """
+        from oxasl import AslImage
+        metadata = {"iaf" : "tc", "ibf" : "tis", "tis" : [1.5, 2.0]}
+        data = self.data_4d[..., :(self.data_4d.shape[3] // 4) * 4]
+        # Non-finite values must only affect the output volumes which use them
+        nonfinite = np.array(data, dtype=np.float32)
+        nonfinite[0, 0, 0, 1] = np.nan
+        nonfinite[1, 1, 1, 2] = np.inf
+        for data in (data, nonfinite):
+            for ops in ([("diff", None)], [("diff", None), ("mean", None)], [("pwi", None)], [("mean", None)],
+                        [("reorder", "rtl")], [("diff", None), ("reorder", "rt"), ("mean", None)]):
+                plan = PreprocPlan(metadata, data.shape[3], ops, name="data")
+                stepwise = apply_ops(AslImage(data, name="data", **metadata), ops)
+                expected = np.asarray(stepwise.data)
+                fused = plan.apply(data)
+                self.assertEqual(fused.shape, expected.shape)
+                self.assertEqual(fused.dtype, expected.dtype)
+                self.assertTrue(np.allclose(fused, expected, equal_nan=True))
+                self.assertEqual(np.count_nonzero(np.isfinite(fused)), np.count_nonzero(np.isfinite(expected)))
+                self.assertEqual(plan.name, stepwise.name)
+
+class AslCalibProcessTest(ProcessTest):
+    """ Tests for the calibration process """
+
+    def _oxasl_calib(self, calib_data, perf_data, multiplier=1.0, alpha=1.0, var=False, **options):
+        from fsl.data.image import Image
+        from oxasl import Workspace, calib
+        wsp = Workspace(log=six.StringIO(), **options)
+        wsp.calib = Image(calib_data, xform=self.grid.affine)
+        return calib.calibrate(wsp, Image(perf_data, xform=self.grid.affine),
+                               multiplier=multiplier, alpha=alpha, var=var).data
+
+    def testRescale(self):
+        """
+        Check re-running with changed parameters gives the same output as a full calibration
+        """
+        calib_data = np.abs(self.data_3d) + 1
+        self.ivm.add(self.data_3d, grid=self.grid, name="perf")
+        self.ivm.add(calib_data, grid=self.grid, name="calib")
+        for gain, pct, tr, t1, alpha in ((1.0, 0.9, 3.2, None, 0.85), (1.0, 0.9, 3.2, None, 0.98),
+                                         (2.0, 0.8, 6.0, None, 0.98), (2.0, 0.8, 2.0, 1.3, 0.98)):
+            AslCalibProcess(self.ivm).run({
+                "data" : "perf", "calib-data" : "calib", "method" : "voxelwise", "edgecorr" : False,
+                "gain" : gain, "pct" : pct, "tr" : tr, "t1" : t1, "alpha" : alpha, "multiplier" : 6000,
+            })
+            expected = self._oxasl_calib(calib_data, self.data_3d, multiplier=6000, alpha=alpha,
+                                         calib_method="voxelwise", calib_gain=gain, pct=pct, tr=tr, t1=t1)
+            self.assertTrue(np.allclose(self.ivm.data["perf_calib"].raw(), expected))
+
+    def testM0Reused(self):
+        """
+        Check changing parameters which only scale M0 re-uses the M0 estimate
+        """
+        self.ivm.add(self.data_3d, grid=self.grid, name="perf")
+        self.ivm.add(np.abs(self.data_3d) + 1, grid=self.grid, name="calib")
+        options = {"data" : "perf", "calib-data" : "calib", "method" : "voxelwise", "edgecorr" : False, "gain" : 3.0}
+        AslCalibProcess(self.ivm).run(dict(options, alpha=0.85))
+        process = AslCalibProcess(self.ivm)
+        process.run(dict(options, alpha=0.98))
+        self.assertTrue("Using previously calculated M0" in process.get_log())
+        process = AslCalibProcess(self.ivm)
+        process.run(dict(options, alpha=0.98, gain=4.0, tr=2.0, t1=1.3, pct=0.8))
+        self.assertTrue("Using previously calculated M0" in process.get_log())
+        process = AslCalibProcess(self.ivm)
+        process.run(dict(options, alpha=0.98, edgecorr=True))
+        self.assertFalse("Using previously calculated M0" in process.get_log())
+
+    def testM0Factors(self):
+        """
+        Check the factors which only scale M0 are separated from the options for the M0 estimate
+        """
+        import math
+        options = {"calib_method" : "voxelwise", "calib_gain" : 2.0, "tr" : 3.0, "t1" : 1.3, "pct" : 0.8, "calib_edgecorr" : True}
+        base_options, factor = m0_factors(options)
+        self.assertEqual(base_options, {"calib_method" : "voxelwise", "pct" : 1.0, "calib_edgecorr" : True})
+        self.assertAlmostEqual(factor, 2.0 / (1 - math.exp(-3.0 / 1.3)) / 0.8)
+
+        options = {"calib_method" : "refregion", "calib_gain" : 2.0, "tr" : 3.0, "t1r" : 4.3, "pcr" : 1.15, "te" : 10}
+        base_options, factor = m0_factors(options)
+        self.assertEqual(base_options, {"calib_method" : "refregion", "tr" : float("inf"), "pcr" : 1.0, "te" : 10})
+        self.assertAlmostEqual(factor, 2.0 / (1 - math.exp(-3.0 / 4.3)) / 1.15)
+
+        options = {"calib_method" : "wholebrain", "calib_gain" : 2.0}
+        self.assertEqual(m0_factors(options), (options, 1.0))
+
+    def testMultiple(self):
+        """
+        Check calibrating multiple data sets together gives the same output as calibrating them separately
+        """
+        options = {"calib-data" : "calib", "method" : "voxelwise", "edgecorr" : False, "alpha" : 0.85, "multiplier" : 6000}
+        self.ivm.add(np.abs(self.data_3d) + 1, grid=self.grid, name="calib")
+        self.ivm.add(self.data_3d, grid=self.grid, name="perf")
+        self.ivm.add(self.data_3d * 2, grid=self.grid, name="perf_std")
+        self.ivm.add(self.data_3d * 3, grid=self.grid, name="acbv")
+        AslCalibProcess(self.ivm).run(dict(options, data={"perf" : {}, "perf_std" : {}, "acbv" : {"multiplier" : 100}},
+                                           **{"output-suffix" : "_multi"}))
+        for name, multiplier in (("perf", 6000), ("perf_std", 6000), ("acbv", 100)):
+            AslCalibProcess(self.ivm).run(dict(options, data=name, multiplier=multiplier))
+            self.assertTrue(np.allclose(self.ivm.data[name + "_multi"].raw(), self.ivm.data[name + "_calib"].raw()))
+
+    def testVariance(self):
+        """
+        Check variance data is calibrated in the same way as by oxasl, alongside the mean
+        """
+        calib_data = np.abs(self.data_3d) + 1
+        perf_var = np.square(self.data_3d)
+        self.ivm.add(calib_data, grid=self.grid, name="calib")
+        self.ivm.add(self.data_3d, grid=self.grid, name="perf")
+        self.ivm.add(perf_var, grid=self.grid, name="perf_var")
+        AslCalibProcess(self.ivm).run({
+            "data" : {"perf" : {}, "perf_var" : {"var" : True}}, "calib-data" : "calib",
+            "method" : "voxelwise", "edgecorr" : False, "alpha" : 0.85, "multiplier" : 6000,
+        })
+        for name, data, var in (("perf", self.data_3d, False), ("perf_var", perf_var, True)):
+            expected = self._oxasl_calib(calib_data, data, multiplier=6000, alpha=0.85, var=var, calib_method="voxelwise")
+            self.assertTrue(np.allclose(self.ivm.data[name + "_calib"].raw(), expected))
+
+class _CountingStep(object):
+    """ Model fitting step which records how many times it was run """
+
+    def __init__(self, options, desc):
+        self.options = dict(options)
+        self.desc = desc
+        self.runs = 0
+
+    def run(self, prev_output, log=sys.stdout, fsllog=None, **kwargs):
+        self.runs += 1
+        log.write("Running %s\n" % self.desc)
+        if fsllog is not None:
+            fsllog.write("fabber %s\n" % self.desc)
+        value = self.options["value"] + (prev_output["value"] if prev_output else 0)
+        return {"value" : value, "extra" : self.options.get("extra", None)}
+
+class CacheTest(unittest.TestCase):
+    """ Tests for caching of data and process output """
+
+    def setUp(self):
+        create_test_data(self)
+        self.tempdir = tempfile.mkdtemp("qp_test_cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def _output_dir(self, nbytes, cache=None):
+        """
+        :return: Output directory containing a single file of the given size
+        """
+        if cache is not None:
+            dirname = cache.workdir()
+        else:
+            dirname = tempfile.mkdtemp(dir=self.tempdir)
+        with open(os.path.join(dirname, "output.dat"), "wb") as output_file:
+            output_file.write(b"0" * nbytes)
+        return dirname
+
+    def testResampleCache(self):
+        """
+        Check resampled data is reused until the source data is modified in place
+        """
+        cache = ResampleCache()
+        qpd = NumpyData(np.array(self.data_3d), grid=self.grid, name="data_3d")
+        grid = DataGrid([3, 3, 3], np.identity(4))
+        data, hit = cache.resample(qpd, grid)
+        self.assertFalse(hit)
+        self.assertTrue(np.allclose(data, qpd.resample(grid).raw()))
+        self.assertTrue(cache.resample(qpd, grid)[1])
+
+        qpd.raw()[1, 1, 1] += 1
+        data, hit = cache.resample(qpd, grid)
+        self.assertFalse(hit)
+        self.assertTrue(np.allclose(data, qpd.resample(grid).raw()))
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    def testResampleCacheEviction(self):
+        """
+        Check the least recently used data is removed when the cache is full
+        """
+        grid = DataGrid([3, 3, 3], np.identity(4))
+        items = [NumpyData(self.data_3d + idx, grid=self.grid, name="data_%i" % idx) for idx in range(3)]
+        nbytes = items[0].resample(grid).raw().nbytes
+        cache = ResampleCache(max_bytes=2 * nbytes)
+        cache.resample(items[0], grid)
+        cache.resample(items[1], grid)
+        self.assertTrue(cache.resample(items[0], grid)[1])
+        cache.resample(items[2], grid)
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertTrue(cache.resample(items[0], grid)[1])
+        self.assertFalse(cache.resample(items[1], grid)[1])
+
+    def testDataKey(self):
+        """
+        Check a sampled data key only changes when a sampled value is modified
+        """
+        qpd = NumpyData(np.zeros((64, 64, 8, 4), dtype=np.float32), grid=DataGrid([64, 64, 8], np.identity(4)), name="data")
+        full, sampled = data_key(qpd), data_key(qpd, FINGERPRINT_SAMPLES)
+        self.assertEqual(data_key(qpd, FINGERPRINT_SAMPLES), sampled)
+
+        qpd.raw().flat[1] = 1
+        self.assertNotEqual(data_key(qpd), full)
+        self.assertEqual(data_key(qpd, FINGERPRINT_SAMPLES), sampled)
+
+        qpd.raw().flat[0] = 1
+        self.assertNotEqual(data_key(qpd, FINGERPRINT_SAMPLES), sampled)
+
+    def _memo_steps(self, memo, values, extra=None, fsllog=None):
+        """
+        Run memoised steps as oxasl.basil.basil_fit would
+
+        :return: Tuple of (output of final step, original steps, log output)
+        """
+        from oxasl import AslImage, Workspace
+        steps = [_CountingStep({"value" : value, "extra" : extra}, "Step %i" % idx) for idx, value in enumerate(values)]
+        asldata = AslImage(self.data_4d, name="asldata", iaf="tc", ibf="rpt", plds=[1.5])
+        log = six.StringIO()
+        output = None
+        wsp = Workspace(savedir=os.path.join(self.tempdir, "wsp"), log=log)
+        for step in memo_basil_steps(lambda *args, **kwargs: steps, memo, "fitkey")(wsp, asldata):
+            output = step.run(output, log=log, fsllog=fsllog)
+        return output, steps, log.getvalue()
+
+    def testMemoSteps(self):
+        """
+        Check model fitting steps are reused, and re-run if a step they depend on changes
+        """
+        memo = ResultCache(os.path.join(self.tempdir, "memo"))
+        output, steps, _ = self._memo_steps(memo, [1, 2])
+        self.assertEqual(output["value"], 3)
+        self.assertEqual([step.runs for step in steps], [1, 1])
+
+        output, steps, log = self._memo_steps(memo, [1, 2])
+        self.assertEqual(output["value"], 3)
+        self.assertEqual([step.runs for step in steps], [0, 0])
+        self.assertTrue("reusing previous output" in log)
+
+        output, steps, _ = self._memo_steps(memo, [5, 2])
+        self.assertEqual(output["value"], 7)
+        self.assertEqual([step.runs for step in steps], [1, 1])
+
+    def testMemoStepsLog(self):
+        """
+        Check log output from model fitting steps is written again when they are reused
+        """
+        memo = ResultCache(os.path.join(self.tempdir, "memo"))
+        fsllog = six.StringIO()
+        _, _, log = self._memo_steps(memo, [1, 2], fsllog=fsllog)
+        fsllog_text = fsllog.getvalue()
+        self.assertTrue("fabber Step 1" in fsllog_text)
+
+        fsllog = six.StringIO()
+        _, steps, reused_log = self._memo_steps(memo, [1, 2], fsllog=fsllog)
+        self.assertEqual([step.runs for step in steps], [0, 0])
+        self.assertEqual(reused_log.replace("(reusing previous output) ", ""), log)
+        self.assertEqual(fsllog.getvalue(), fsllog_text)
+
+    def testMemoStepsWorkspace(self):
+        """
+        Check steps are only memoised for runs whose workspace requests it
+        """
+        from oxasl import AslImage, Workspace
+        steps = [_CountingStep({"value" : 1}, "Step 1")]
+        basil_steps = _workspace_basil_steps(lambda *args, **kwargs: steps)
+        asldata = AslImage(self.data_4d, name="asldata", iaf="tc", ibf="rpt", plds=[1.5])
+        wsp = Workspace(savedir=os.path.join(self.tempdir, "wsp"), log=six.StringIO())
+        self.assertEqual(basil_steps(wsp, asldata), steps)
+
+        wsp.set_item(MEMO_ATTR, (ResultCache(os.path.join(self.tempdir, "memo")), "fitkey"), save=False)
+        memo_steps = basil_steps(wsp, asldata)
+        self.assertEqual(len(memo_steps), 1)
+        self.assertTrue(isinstance(memo_steps[0], MemoStep))
+
+    def testMemoStepsSaveFailure(self):
+        """
+        Check a failure to save step output is reported in the log
+        """
+        memo = ResultCache(os.path.join(self.tempdir, "memo"))
+        output, _, log = self._memo_steps(memo, [1], extra=object())
+        self.assertEqual(output["value"], 1)
+        self.assertTrue("WARNING" in log)
+        self.assertEqual(memo.entries(), [])
+
+    def testResultCacheHitMiss(self):
+        """
+        Check output is stored by key and copied into the cache by default
+        """
+        cache = ResultCache(os.path.join(self.tempdir, "cache"), max_bytes=1000)
+        self.assertTrue(cache.get("key") is None)
+        srcdir = self._output_dir(100)
+        path = cache.put("key", srcdir)
+        self.assertEqual(cache.get("key"), path)
+        self.assertTrue(os.path.isfile(os.path.join(path, "output.dat")))
+        self.assertTrue(os.path.isdir(srcdir))
+        self.assertTrue(cache.get("otherkey") is None)
+
+    def testResultCacheMove(self):
+        """
+        Check output can be moved into the cache from one of its working directories
+        """
+        cache = ResultCache(os.path.join(self.tempdir, "cache"), max_bytes=1000)
+        srcdir = self._output_dir(100, cache)
+        self.assertEqual(cache.entries(), [])
+        path = cache.put("key", srcdir, move=True)
+        self.assertEqual(cache.get("key"), path)
+        self.assertFalse(os.path.isdir(srcdir))
+        self.assertEqual([key for key, _, _ in cache.entries()], ["key"])
+
+    def testResultCacheEviction(self):
+        """
+        Check the least recently used output is removed when the cache is full
+        """
+        cache = ResultCache(os.path.join(self.tempdir, "cache"), max_bytes=250)
+        for idx, key in enumerate(("key1", "key2")):
+            cache.put(key, self._output_dir(100))
+            os.utime(cache.path(key), (idx, idx))
+        # Use key1 so key2 is the least recently used
+        self.assertTrue(cache.get("key1") is not None)
+        cache.put("key3", self._output_dir(100))
+        self.assertTrue(cache.get("key1") is not None)
+        self.assertTrue(cache.get("key2") is None)
+        self.assertTrue(cache.get("key3") is not None)
+        self.assertTrue(cache.put("toobig", self._output_dir(300)) is None)
+
+    def testResultCachePinned(self):
+        """
+        Check output in use by another cache object on the same directory is not evicted
+        """
+        cache = ResultCache(os.path.join(self.tempdir, "cache"), max_bytes=150)
+        cache.put("key1", self._output_dir(100))
+        path = cache.pin("key1")
+        self.assertTrue(path is not None)
+        os.utime(path, (0, 0))
+
+        # Another cache object on the same directory must not evict the pinned entry
+        other = ResultCache(os.path.join(self.tempdir, "cache"), max_bytes=150)
+        other.put("key2", self._output_dir(100))
+        self.assertTrue(os.path.isdir(path))
+
+        cache.unpin("key1")
+        self.assertFalse(os.path.isdir(path))
+        self.assertTrue(cache.get("key2") is not None)
+
+    def testCheckpoint(self):
+        """
+        Check a checkpoint can be saved, replaced, loaded by a new object and cleared
+        """
+        checkpoint = Checkpoint("key", self.tempdir)
+        self.assertTrue(checkpoint.load() is None)
+
+        mvn = np.random.normal(size=(5, 5, 5, 6))
+        checkpoint.save(1, mvn=mvn)
+        checkpoint.save(2, mvn=mvn * 2)
+        step, arrays = Checkpoint("key", self.tempdir).load()
+        self.assertEqual(step, 2)
+        self.assertEqual(list(arrays.keys()), ["mvn"])
+        self.assertTrue(np.array_equal(arrays["mvn"], mvn * 2))
+        self.assertTrue(Checkpoint("other", self.tempdir).load() is None)
+
+        checkpoint.clear()
+        self.assertFalse(os.path.exists(checkpoint.dirname))
+        self.assertTrue(checkpoint.load() is None)
+
+    def testCheckpointCorrupt(self):
+        """
+        Check a corrupt checkpoint file is ignored
+        """
+        checkpoint = Checkpoint("key", self.tempdir)
+        checkpoint.save(1, mvn=np.zeros((2, 2)))
+        with open(checkpoint.fname, "wb") as corrupt:
+            corrupt.write(b"not a checkpoint")
+        self.assertTrue(checkpoint.load() is None)
+
+    def testCheckpointExpiry(self):
+        """
+        Check only checkpoints which have not been saved recently are expired
+        """
+        old, recent = Checkpoint("old", self.tempdir), Checkpoint("recent", self.tempdir)
+        old.save(1, mvn=np.zeros((2, 2)))
+        recent.save(1, mvn=np.zeros((2, 2)))
+        old_time = time.time() - 3600
+        os.utime(old.dirname, (old_time, old_time))
+        self.assertEqual(Checkpoint.expire(self.tempdir, 60), 1)
+        self.assertTrue(old.load() is None)
+        self.assertEqual(recent.load()[0], 1)
+        self.assertEqual(Checkpoint.expire(os.path.join(self.tempdir, "missing"), 60), 0)
+
+class BasilProcessTest(ProcessTest):
+    """ Tests for the Basil process """
+
+    def _run_basil(self, timeout=600, **kwargs):
+        """
+        Run Basil on the 4D test data, waiting for Fabber to finish
+
+        :return: Process status
+        """
+        options = {
+            "data" : "data_4d",
+            "iaf" : "tc",
+            "ibf" : "rpt",
+            "tis" : [1.5],
+            "taus" : [1.4],
+            "casl" : True,
+            "inferart" : True,
+            "checkpoint" : False,
+        }
+        options.update(kwargs)
+        status = []
+        process = BasilProcess(self.ivm)
+        process.sig_finished.connect(lambda stat, log, exc: status.append(stat))
+        process.run(options)
+        start = time.time()
+        while not status and time.time() - start < timeout:
+            QtCore.QCoreApplication.processEvents()
+            time.sleep(0.01)
+        self.assertTrue(status, "Basil did not finish")
+        return status[0]
+
+    def testPartitionCrop(self):
+        """
+        Check partitions cover the mask and output from data cropped to their bounding
+        boxes merges back into the full volume
+        """
+        mask = np.random.rand(*self.grid.shape) > 0.5
+        partitions = partition_mask(mask, 3)
+        self.assertEqual(len(partitions), 3)
+        self.assertTrue(np.all(sum(part for part, _ in partitions) == mask))
+
+        outputs = []
+        for part, box in partitions:
+            self.assertEqual(np.count_nonzero(part[box]), np.count_nonzero(part))
+            grid = cropped_grid(self.grid, box)
+            self.assertEqual(list(grid.shape), [axis.stop - axis.start for axis in box])
+            self.assertTrue(np.allclose(grid.grid_to_world([0, 0, 0]), self.grid.grid_to_world([axis.start for axis in box])))
+            data = self.data_4d[box] * (part[box] > 0)[..., np.newaxis]
+            outputs.append({"output" : NumpyData(data, grid=grid, name="output")})
+
+        merged = merge_partitions(outputs, [part for part, _ in partitions], [box for _, box in partitions], self.grid)
+        self.assertTrue(np.allclose(merged["output"].raw(), self.data_4d * mask[..., np.newaxis]))
+
+    @unittest.skipIf("--test-fast" in sys.argv, "Slow test")
+    def testPartitions(self):
+        """
+        Check a two-step fit run in partitions matches the same fit without partitions,
+        i.e. each partition's MVN is carried forward to the next step
+        """
+        self.ivm.add(self.data_4d, grid=self.grid, name="data_4d")
+        self.assertEqual(self._run_basil(), Process.SUCCEEDED)
+        expected = {}
+        for name in ("perfusion", "aCBV"):
+            expected[name] = np.array(self.ivm.data[name].raw())
+
+        self.assertEqual(self._run_basil(partitions=2), Process.SUCCEEDED)
+        for name, data in expected.items():
+            self.assertTrue(np.allclose(self.ivm.data[name].raw(), data))
+        self.assertFalse("finalMVN" in self.ivm.data)
+
+class SignalFitTest(unittest.TestCase):
+    """ Tests for fitting the expected signal structure to ASL data """
+
+    def setUp(self):
+        create_test_data(self)
+
+    def testPercentile(self):
+        """
+        Check the partial sort percentile matches Numpy
+        """
+        values = np.random.normal(size=1001)
+        for pct in (0, 1, 50, 99, 100):
+            self.assertAlmostEqual(percentile(values, pct), np.percentile(values, pct))
+
+    def testFitSignal(self):
+        """
+        Check the closed form fit recovers a signal with the expected structure
+        """
+        num = {"l" : 2, "r" : 3, "t" : 4}
+        tdep = np.array([4.0, 1.0, 3.0, 2.0])
+        signal = tdep[tdep_index("lrt", num)]
+        fitted, cost = fit_signal(signal, "lrt", num)
+        self.assertTrue(np.allclose(fitted, signal))
+        self.assertAlmostEqual(cost, 0)
+
+        # The fitted values are the mean of the signal for each TI
+        noisy = signal + np.random.normal(scale=0.1, size=signal.shape)
+        fitted, cost = fit_signal(noisy, "lrt", num)
+        t_index = tdep_index("lrt", num)
+        for tidx in range(4):
+            self.assertAlmostEqual(fitted[t_index == tidx][0], np.mean(noisy[t_index == tidx]))
+        self.assertAlmostEqual(cost, 0.5 * np.sum(np.square(noisy - fitted)))
+
+    def testRankOrders(self):
+        """
+        Check the ordering used to generate a signal is ranked first, with the same cost as fit_signal
+        """
+        num = {"l" : 2, "r" : 3, "t" : 4}
+        signal = np.array([4.0, 1.0, 3.0, 2.0])[tdep_index("rtl", num)]
+        ranking = rank_orders(signal, "lrt", [num])
+        self.assertEqual(len(ranking), 6)
+        self.assertEqual(ranking[0][1], "rtl")
+        for cost, order, trial_num in ranking:
+            self.assertAlmostEqual(cost, fit_signal(signal, order, trial_num)[1])
+
+    def testMeanSignal(self):
+        """
+        Check all voxels are used unless subsampling is requested, and the result is
+        cached until the data changes
+        """
+        qpd = NumpyData(np.array(self.data_4d), grid=self.grid, name="data_4d")
+        signal = cached_mean_signal(*signal_source(qpd))
+        self.assertTrue(np.allclose(signal, mean_signal(self.data_4d)))
+        self.assertTrue(cached_mean_signal(*signal_source(qpd)) is signal)
+
+        subsampled = cached_mean_signal(*signal_source(qpd), max_voxels=8)
+        self.assertTrue(np.allclose(subsampled, mean_signal(self.data_4d, max_voxels=8)))
+
+        qpd.raw()[...] = qpd.raw()[..., ::-1]
+        signal = cached_mean_signal(*signal_source(qpd))
+        self.assertTrue(np.allclose(signal, mean_signal(self.data_4d)[::-1]))
+
+class MetadataValidationTest(unittest.TestCase):
+    """ Tests for validating ASL metadata from the number of volumes """
+
+    def _check(self, md, nvols):
+        """
+        Check validation agrees with creating an AslImage with the given number of volumes
+        """
+        from oxasl import AslImage
+        try:
+            aslimage = AslImage(np.zeros((1, 1, 1, nvols)), name="asldata", **md)
+        except ValueError:
+            aslimage = None
+
+        if aslimage is None:
+            with self.assertRaises(ValueError):
+                validate_asl_metadata(md, nvols)
+        else:
+            structure = validate_asl_metadata(md, nvols)
+            self.assertEqual(structure["iaf"], aslimage.iaf)
+            self.assertEqual(structure["order"], aslimage.order)
+            self.assertEqual(structure["ntc"], aslimage.ntc)
+            self.assertEqual(structure["ntes"], aslimage.ntes)
+            self.assertEqual(structure["ntis"], aslimage.ntis)
+            self.assertEqual(list(structure["rpts"]), list(aslimage.rpts))
+        return aslimage is not None
+
+    def testLabelControl(self):
+        """
+        Check label-control pair metadata
+        """
+        md = {"iaf" : "tc", "ibf" : "rpt", "plds" : [1.0, 1.5]}
+        self.assertTrue(self._check(md, 8))
+        self.assertFalse(self._check(md, 6))
+        self.assertFalse(self._check(dict(md, nrpts=3), 8))
+        self.assertTrue(self._check(dict(md, plds="1.0,1.5", iaf="ct"), 8))
+        self.assertTrue(self._check({"iaf" : "tc", "ibf" : "rpt", "ntis" : 2}, 8))
+        self.assertTrue(self._check({"iaf" : "tc", "ibf" : "rpt", "nplds" : 2}, 8))
+        self.assertFalse(self._check({"iaf" : "tc", "ibf" : "rpt"}, 8))
+        self.assertFalse(self._check(dict(md, tis=[1.0, 1.5]), 8))
+
+    def testMultiphase(self):
+        """
+        Check multiphase metadata, including phases given as a string
+        """
+        md = {"iaf" : "mp", "ibf" : "rpt", "plds" : [1.5]}
+        self.assertFalse(self._check(md, 8))
+        self.assertTrue(self._check(dict(md, nphases=4), 8))
+        self.assertFalse(self._check(dict(md, nphases=3), 8))
+        self.assertTrue(self._check(dict(md, phases=[0, 90, 180, 270]), 8))
+        self.assertTrue(self._check(dict(md, phases=[0, 90, 180, 270], nphases=4), 8))
+        self.assertTrue(self._check(dict(md, phases="0,90,180,270"), 8))
+        self.assertFalse(self._check(dict(md, phases="0,90,180,270"), 10))
+        # oxasl compares the number of phases with the length of the string
+        self.assertFalse(self._check(dict(md, phases="0,90,180,270", nphases=4), 8))
+
+    def testVesselEncoded(self):
+        """
+        Check vessel encoded metadata
+        """
+        md = {"iaf" : "ve", "ibf" : "rpt", "plds" : [1.5], "nenc" : 8}
+        self.assertTrue(self._check(md, 16))
+        self.assertFalse(self._check(md, 12))
+        self.assertTrue(self._check(dict(md, iaf="vediff"), 8))
+        self.assertFalse(self._check(dict(md, iaf="vediff", nenc=7), 14))
+        self.assertFalse(self._check({"iaf" : "ve", "ibf" : "rpt", "plds" : [1.5]}, 16))
+
+    def testVariableRepeats(self):
+        """
+        Check metadata with a different number of repeats at each PLD
+        """
+        md = {"iaf" : "tc", "ibf" : "tis", "plds" : [1.0, 1.5, 2.0], "rpts" : [1, 2, 3]}
+        self.assertTrue(self._check(md, 12))
+        self.assertFalse(self._check(md, 10))
+        self.assertTrue(self._check(dict(md, rpts="1,2,3"), 12))
+        self.assertFalse(self._check(dict(md, rpts=[1, 2]), 12))
+
+    def testMultiTe(self):
+        """
+        Check the number of TEs is included in the number of volumes expected
+        """
+        md = {"iaf" : "diff", "ibf" : "rpt", "plds" : [1.0, 1.5], "tes" : "0.01,0.02"}
+        self.assertTrue(self._check(md, 8))
+        self.assertFalse(self._check(md, 6))
+        self.assertTrue(self._check(dict(md, nrpts=2), 8))
+        self.assertFalse(self._check(dict(md, nrpts=4), 8))
+
+class BackgroundExecutorTest(unittest.TestCase):
+    """ Tests for running GUI computations in the background """
+
+    def setUp(self):
+        _qt_app()
+        create_test_data(self)
+        self.pool = QtCore.QThreadPool()
+        self.executor = BackgroundExecutor(pool=self.pool)
+
+    def tearDown(self):
+        self.pool.waitForDone()
+
+    def _wait(self, timeout=10):
+        """
+        Process events until all submitted jobs have been completed
+        """
+        start = time.time()
+        while self.executor._jobs and time.time() - start < timeout:
+            QtCore.QCoreApplication.processEvents()
+            time.sleep(0.01)
+        self.assertFalse(self.executor._jobs, "Background jobs did not finish")
+
+    def testResult(self):
+        """
+        Check the result of a job is passed to the callback
+        """
+        results = []
+        self.executor.submit("job", np.sum, (self.data_3d,), callback=results.append)
+        self.assertTrue(self.executor.is_running("job"))
+        self._wait()
+        self.assertEqual(len(results), 1)
+        self.assertAlmostEqual(results[0], np.sum(self.data_3d))
+        self.assertFalse(self.executor.is_running("job"))
+
+    def testError(self):
+        """
+        Check an exception raised by a job is passed to the errback
+        """
+        results, errors = [], []
+        self.executor.submit("job", lambda: 1 / 0, callback=results.append, errback=errors.append)
+        self._wait()
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(isinstance(errors[0], ZeroDivisionError))
+
+    def testSuperseded(self):
+        """
+        Check only the result of the latest job with a key is delivered
+        """
+        started, release = threading.Event(), threading.Event()
+        def _slow(value):
+            started.set()
+            release.wait(10)
+            return value
+
+        results, other_results = [], []
+        self.executor.submit("job", _slow, ("first",), callback=results.append)
+        started.wait(10)
+        self.executor.submit("job", lambda: "second", callback=results.append)
+        self.executor.submit("other", lambda: "other", callback=other_results.append)
+        release.set()
+        self._wait()
+        self.assertEqual(results, ["second"])
+        self.assertEqual(other_results, ["other"])
+
+    def testCancel(self):
+        """
+        Check the result of a cancelled job is discarded
+        """
+        started, release = threading.Event(), threading.Event()
+        def _slow():
+            started.set()
+            release.wait(10)
+            return "done"
+
+        results = []
+        self.executor.submit("job", _slow, callback=results.append)
+        started.wait(10)
+        self.executor.cancel("job")
+        self.assertFalse(self.executor.is_running("job"))
+        release.set()
+        self._wait()
+        self.assertEqual(results, [])
+
+class ProfilingTest(unittest.TestCase):
+    """ Tests for profiling process steps """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp("qp_test_profile")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def testStepProfiler(self):
+        """
+        Check a record is made for each step, including the I/O counted during it
+        """
+        io_stats = {"copied" : 100}
+        profiler = StepProfiler(voxels=1000)
+        profiler.start("Step 1", io_stats=io_stats)
+        io_stats["copied"] += 50
+        io_stats["loaded"] = 25
+        profiler.start("Step 2", voxels=10)
+        time.sleep(0.01)
+        profiler.stop("FAILED", io_extra=5)
+        profiler.stop()
+
+        self.assertEqual([record["step"] for record in profiler.records], ["Step 1", "Step 2"])
+        self.assertEqual([record["status"] for record in profiler.records], ["SUCCEEDED", "FAILED"])
+        self.assertEqual([record["voxels"] for record in profiler.records], [1000, 10])
+        self.assertEqual([record["io_bytes"] for record in profiler.records], [75, 5])
+        self.assertTrue(profiler.records[1]["wall_time"] >= 0.01)
+        for record in profiler.records:
+            self.assertEqual(sorted(record.keys()), sorted(COLUMNS))
+            self.assertTrue(record["cpu_time"] >= 0)
+
+    def testStepProfilerOutput(self):
+        """
+        Check records from elsewhere can be added and the profile saved as JSON and a data frame
+        """
+        import json
+        profiler = StepProfiler()
+        profiler.start("Setup")
+        profiler.stop()
+        profiler.add([{"step" : "Worker", "status" : "SUCCEEDED", "wall_time" : 1.5, "voxels" : 3, "extra" : 1}], voxels=20)
+        self.assertEqual(profiler.records[1]["voxels"], 20)
+        self.assertTrue(profiler.records[1]["io_bytes"] is None)
+        self.assertFalse("extra" in profiler.records[1])
+
+        fname = os.path.join(self.tempdir, "profile.json")
+        profiler.save_json(fname, process="Test")
+        with open(fname) as jsonfile:
+            saved = json.load(jsonfile)
+        self.assertEqual(saved["process"], "Test")
+        self.assertEqual([record["step"] for record in saved["steps"]], ["Setup", "Worker"])
+
+        frame = profiler.dataframe()
+        self.assertEqual(list(frame.columns), COLUMNS)
+        self.assertEqual(list(frame["step"]), ["Setup", "Worker"])
+
+    def testStageMonitor(self):
+        """
+        Check pipeline stages are identified from log output, which is passed on unchanged
+        """
+        stream = six.StringIO()
+        monitor = StageMonitor(stream, [("Pre-processing", "Preprocessing"), (".*fit on full", "Fitting")], voxels=5)
+        monitor.write("Starting\nPre-processing data\n")
+        monitor.write("Still preprocessing\n")
+        monitor.write(" - Doing fit on full ASL data\n")
+        records = monitor.finish()
+        self.assertEqual(stream.getvalue(), "Starting\nPre-processing data\nStill preprocessing\n - Doing fit on full ASL data\n")
+        self.assertEqual([record["step"] for record in records], ["Setup", "Preprocessing", "Fitting"])
+        self.assertEqual([record["voxels"] for record in records], [5, 5, 5])
+
+class TransferTest(unittest.TestCase):
+    """ Tests for transfer of image data in memory mapped files """
+
+    def setUp(self):
+        create_test_data(self)
+        self.tempdir = tempfile.mkdtemp("qp_test_transfer")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def testSharedImage(self):
+        """
+        Check image data round trips through a memory mapped file without being modified
+        """
+        shared = SharedImage.from_array(self.data_4d, self.grid.affine, "data_4d", self.tempdir, metadata={"iaf" : "tc"})
+        self.assertEqual(shared.nbytes, self.data_4d.nbytes)
+        qpd = SharedImageData(shared)
+        self.assertEqual(qpd.name, "data_4d")
+        self.assertEqual(qpd.nvols, self.data_4d.shape[3])
+        self.assertTrue(np.allclose(qpd.raw(), self.data_4d))
+
+        # Data is copy-on-write
+        qpd.raw()[0, 0, 0, 0] += 1
+        self.assertTrue(np.allclose(shared.array(), self.data_4d))
+        self.assertTrue(np.allclose(mapped_data(qpd), qpd.raw()))
+
+    def testMappedNifti(self):
+        """
+        Check data loaded from an uncompressed NIFTI file is mapped unless it has been modified in memory
+        """
+        import nibabel as nib
+        fname = os.path.join(self.tempdir, "data_4d.nii")
+        nib.save(nib.Nifti1Image(np.array(self.data_4d, dtype=np.float32), self.grid.affine), fname)
+        qpd = load(fname)
+        mapped = mapped_data(qpd)
+        self.assertTrue(isinstance(mapped, np.memmap))
+        self.assertTrue(np.allclose(mapped, self.data_4d))
+
+        qpd.raw()[0, 0, 0, 0] += 1
+        data = mapped_data(qpd)
+        self.assertFalse(isinstance(data, np.memmap))
+        self.assertEqual(data[0, 0, 0, 0], qpd.raw()[0, 0, 0, 0])
+
+    def testSharedDirReleased(self):
+        """
+        Check a directory of mapped output is removed when the data using it is deleted
+        """
+        dirname = tempfile.mkdtemp("qp_test_transfer")
+        owner = SharedDir(dirname)
+        shared = SharedImage.from_array(self.data_4d, self.grid.affine, "data_4d", dirname)
+        ivm = ImageVolumeManagement()
+        ivm.add(SharedImageData(shared, owner=owner))
+        del owner
+        gc.collect()
+        self.assertTrue(os.path.isdir(dirname))
+        self.assertTrue(np.allclose(ivm.data["data_4d"].raw(), self.data_4d))
+
+        ivm.add(NumpyData(self.data_4d, grid=self.grid, name="data_4d"))
+        gc.collect()
+        self.assertFalse(os.path.isdir(dirname))
+
+class ManifestTest(unittest.TestCase):
+    """ Tests for the plugin manifest """
+
+    def testLazyClasses(self):
+        """
+        Check manifest entries stand in for the classes they name, and process
+        names are available without importing the process module
+        """
+        from . import QP_MANIFEST, _LazyClass
+        for key, base in (("widgets", QpWidget), ("processes", Process), ("widget-tests", unittest.TestCase),
+                          ("process-tests", unittest.TestCase), ("unit-tests", unittest.TestCase)):
+            for entry in QP_MANIFEST[key]:
+                self.assertTrue(isinstance(entry, _LazyClass))
+                cls = entry.resolve()
+                self.assertEqual(cls.__name__, entry.__name__)
+                self.assertTrue(issubclass(cls, base))
+                self.assertTrue(issubclass(cls, entry))
+                self.assertTrue(issubclass(entry, base))
+                if key == "processes":
+                    self.assertTrue("PROCESS_NAME" in vars(entry))
+                    self.assertEqual(entry.PROCESS_NAME, cls.PROCESS_NAME)
+
+    def testLoadTests(self):
+        """
+        Check test cases can be loaded from the manifest as Quantiphyse does
+        """
+        from . import QP_MANIFEST
+        for entry in QP_MANIFEST["unit-tests"]:
+            self.assertTrue(unittest.defaultTestLoader.loadTestsFromTestCase(entry).countTestCases() > 0)
+
 class MultiphaseProcessTest(ProcessTest):
 
     @unittest.skipIf("--test-fast" in sys.argv, "Slow test")
@@ -235,8 +1268,188 @@ class MultiphaseProcessTest(ProcessTest):
         self.assertTrue("mean_offset" in self.ivm.data)
         self.assertTrue("mean_phase" in self.ivm.data)
 
+class _FakeOxaslProcess(OxaslProcess):
+    """ oxasl process which writes the mean of the input data as output instead of running oxasl """
+
+    def __init__(self, ivm, **kwargs):
+        OxaslProcess.__init__(self, ivm, **kwargs)
+        self.worker_args = None
+
+    def start_bg(self, args, n_workers=1):
+        from fsl.data.image import Image
+        self.worker_args = args
+        _, _, asldata, options, output_paths, _, scratch_dir = args
+        outdir = os.path.join(options["savedir"], "output", "native")
+        os.makedirs(outdir)
+        Image(np.mean(asldata.array(), axis=-1), xform=asldata.affine).save(os.path.join(outdir, "perfusion.nii"))
+        self._worker_output = [{"images" : nifti_descriptors(options["savedir"], output_paths, scratch_dir), "profile" : []}]
+        self.status = Process.SUCCEEDED
+        self._complete()
+
 class OxaslProcessTest(ProcessTest):
 
+    def testMissingImage(self):
+        """
+        Check a missing input image is reported without leaving temporary directories behind
+        """
+        self.ivm.add(self.data_4d, grid=self.grid, name="data_4d")
+        pattern = os.path.join(tempfile.gettempdir(), "*qp_oxasl*")
+        existing = set(glob.glob(pattern))
+        with self.assertRaises(KeyError):
+            OxaslProcess(self.ivm).run({
+                "data" : "data_4d", "iaf" : "tc", "ibf" : "rpt", "plds" : [1.5], "struc" : "missing",
+            })
+        self.assertEqual(set(glob.glob(pattern)), existing)
+
+    def testWorkerTransfer(self):
+        """
+        Check the oxasl worker reads input from memory mapped files and returns descriptors
+        for uncompressed output, without changing the output type setting of the caller
+        """
+        from fsl.data.image import Image
+        import oxasl.oxford_asl
+        tempdir = tempfile.mkdtemp("qp_test_worker")
+        runs = []
+        def _oxasl(wsp):
+            runs.append((os.environ.get("FSLOUTPUTTYPE", None), np.array(wsp.asldata.data), np.array(wsp.mask.data)))
+            outdir = os.path.join(wsp.savedir, "output", "native")
+            os.makedirs(outdir)
+            Image(np.mean(wsp.asldata.data, axis=-1), xform=wsp.asldata.voxToWorldMat).save(os.path.join(outdir, "perfusion"))
+
+        original_oxasl, original_type = oxasl.oxford_asl.oxasl, os.environ.get("FSLOUTPUTTYPE", None)
+        oxasl.oxford_asl.oxasl = _oxasl
+        os.environ["FSLOUTPUTTYPE"] = "NIFTI_GZ"
+        try:
+            mask = np.ones(self.grid.shape, dtype=np.int32)
+            asldata = SharedImage.from_array(self.data_4d, self.grid.affine, "asldata", tempdir,
+                                             metadata={"iaf" : "diff", "ibf" : "rpt", "plds" : [1.5]})
+            options = {"savedir" : os.path.join(tempdir, "output"), "mask" : SharedImage.from_array(mask, self.grid.affine, "mask", tempdir)}
+            worker_id, success, output = qp_oxasl(0, six.moves.queue.Queue(), None, None, asldata, options, output_paths=["output"])
+            self.assertEqual(worker_id, 0)
+            self.assertTrue(success)
+            self.assertEqual(os.environ["FSLOUTPUTTYPE"], "NIFTI_GZ")
+
+            self.assertEqual(len(runs), 1)
+            output_type, data, mask_data = runs[0]
+            self.assertEqual(output_type, "NIFTI")
+            self.assertTrue(np.allclose(data, self.data_4d))
+            self.assertTrue(np.all(mask_data == mask))
+
+            shared = output["images"]["output/native/perfusion"]
+            self.assertTrue(shared.fname.endswith(".nii"))
+            self.assertTrue(np.allclose(shared.array(), np.mean(self.data_4d, axis=-1)))
+        finally:
+            oxasl.oxford_asl.oxasl = original_oxasl
+            if original_type is None:
+                del os.environ["FSLOUTPUTTYPE"]
+            else:
+                os.environ["FSLOUTPUTTYPE"] = original_type
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+    def _load_index(self, lazy):
+        """
+        Load an index of output NIFTI files into the IVM using an oxasl process
+
+        :return: Tuple of (process, dictionary of expected data by name)
+        """
+        import nibabel as nib
+        outdir = tempfile.mkdtemp("qp_test_output")
+        expected = {"perfusion" : self.data_3d, "asldata" : self.data_4d, "mask" : (self.data_3d > 0).astype(np.int32)}
+        index = []
+        for name, data in expected.items():
+            fname = os.path.join(outdir, name + (".nii" if name != "mask" else ".nii.gz"))
+            nib.save(nib.Nifti1Image(data, self.grid.affine), fname)
+            index.append((fname, name, name == "mask"))
+
+        process = OxaslProcess(self.ivm)
+        process._tempdir = outdir
+        process._scratchdir = tempfile.mkdtemp("qp_test_scratch")
+        process._output_prefix = "out_"
+        process._lazy_load = lazy
+        process._load_threads = 2
+        process.io_stats = {}
+        process._load_index(index)
+        if not lazy:
+            shutil.rmtree(outdir)
+            shutil.rmtree(process._scratchdir)
+        return process, expected
+
+    def testLoadIndexLazy(self):
+        """
+        Check lazily loaded output is only read when it is first used, and the
+        output and scratch directories are kept until the data is deleted
+        """
+        process, expected = self._load_index(lazy=True)
+        self.assertEqual(sorted(process.output_data_items()), sorted("out_" + name for name in expected))
+        outdir, scratchdir = process._tempdir, process._scratchdir
+        # Compressed output is decompressed outside the output directory
+        self.assertEqual(glob.glob(os.path.join(outdir, "*.dat")), [])
+        self.assertEqual(len(glob.glob(os.path.join(scratchdir, "*.dat"))), 1)
+        for name, data in expected.items():
+            qpd = self.ivm.data["out_" + name]
+            self.assertTrue(isinstance(qpd, SharedImageData))
+            self.assertTrue(qpd._rawdata is None)
+            self.assertEqual(qpd.roi, name == "mask")
+            self.assertTrue(np.allclose(qpd.raw(), data))
+
+        process._shared_dir = None
+        for name in expected:
+            self.ivm.delete("out_" + name)
+        gc.collect()
+        self.assertFalse(os.path.isdir(outdir))
+        self.assertFalse(os.path.isdir(scratchdir))
+
+    def testLoadIndexParallel(self):
+        """
+        Check output loaded in parallel is read into memory and matches the files
+        """
+        process, expected = self._load_index(lazy=False)
+        self.assertEqual(sorted(process.output_data_items()), sorted("out_" + name for name in expected))
+        for name, data in expected.items():
+            qpd = self.ivm.data["out_" + name]
+            self.assertTrue(isinstance(qpd, NumpyData))
+            self.assertEqual(qpd.roi, name == "mask")
+            self.assertTrue(np.allclose(qpd.raw(), data))
+        self.assertEqual(process.io_stats["loaded"], sum(self.ivm.data["out_" + name].raw().nbytes for name in expected))
+
+    def testCachedOutput(self):
+        """
+        Check a run with the same inputs and options loads cached output without
+        transferring any data to a worker
+        """
+        tempdir = tempfile.mkdtemp("qp_test_cache")
+        try:
+            self.ivm.add(self.data_4d, grid=self.grid, name="data_4d")
+            options = {
+                "data" : "data_4d", "iaf" : "diff", "ibf" : "rpt", "plds" : [1.5], "cache" : True,
+                "cache-dir" : os.path.join(tempdir, "cache"), "stage-cache-dir" : os.path.join(tempdir, "stages"),
+                "lazy-load" : False,
+            }
+            process = _FakeOxaslProcess(self.ivm)
+            process.run(dict(options))
+            self.assertTrue(process.worker_args is not None)
+            self.assertTrue(process.io_stats["transferred"] > 0)
+            expected = np.mean(self.data_4d, axis=-1)
+            self.assertTrue(np.allclose(self.ivm.data["perfusion_native"].raw(), expected))
+
+            self.ivm.delete("perfusion_native")
+            process = _FakeOxaslProcess(self.ivm)
+            finished = []
+            process.sig_finished.connect(lambda status, log, exc: finished.append(status))
+            process.execute(dict(options))
+            self.assertEqual(finished, [Process.SUCCEEDED])
+            self.assertEqual(process.status, Process.SUCCEEDED)
+            self.assertTrue(process.worker_args is None)
+            self.assertFalse(process.io_stats.get("transferred", 0))
+            self.assertTrue("Loading cached output" in process.get_log())
+            self.assertTrue(np.allclose(self.ivm.data["perfusion_native"].raw(), expected))
+
+            process = _FakeOxaslProcess(self.ivm)
+            process.run(dict(options, plds=[1.8]))
+            self.assertTrue(process.worker_args is not None)
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
     @unittest.skipIf("--test-fast" in sys.argv, "Slow test")
     def testFslCourse(self):
         """
@@ -265,6 +1478,70 @@ class OxaslProcessTest(ProcessTest):
         self.assertTrue("perfusion_native" in self.ivm.data)
         self.assertTrue("arrival_native" in self.ivm.data)
 
+class OxaslCohortProcessTest(ProcessTest):
+
+    def setUp(self):
+        ProcessTest.setUp(self)
+        self._process_class = basil_process.OxaslProcess
+        basil_process.OxaslProcess = _FakeOxaslProcess
+
+    def tearDown(self):
+        basil_process.OxaslProcess = self._process_class
+        ProcessTest.tearDown(self)
+
+    def _run_cohort(self, subjects, **kwargs):
+        options = {
+            "iaf" : "diff", "ibf" : "rpt", "plds" : [1.5], "lazy-load" : False, "subjects" : subjects,
+        }
+        options.update(kwargs)
+        process = OxaslCohortProcess(self.ivm)
+        finished = []
+        process.sig_finished.connect(lambda status, log, exc: finished.append(status))
+        process.execute(options)
+        self.assertEqual(finished, [process.status])
+        return process
+
+    def testSubjects(self):
+        """
+        Check each subject is run with its own data and its output is loaded with the subject prefix
+        """
+        self.ivm.add(self.data_4d, grid=self.grid, name="data_a")
+        self.ivm.add(self.data_4d * 2, grid=self.grid, name="data_b")
+        process = self._run_cohort({"a" : {"data" : "data_a"}, "b" : {"data" : "data_b"}}, **{"max-concurrent" : 1})
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        self.assertEqual(sorted(process.output_data_items()), ["a_perfusion_native", "b_perfusion_native"])
+        expected = np.mean(self.data_4d, axis=-1)
+        self.assertTrue(np.allclose(self.ivm.data["a_perfusion_native"].raw(), expected))
+        self.assertTrue(np.allclose(self.ivm.data["b_perfusion_native"].raw(), expected * 2))
+
+        status = self.ivm.extras["oxasl_cohort_status"].df
+        self.assertEqual(list(status["subject"]), ["a", "b"])
+        self.assertEqual(list(status["status"]), ["SUCCEEDED", "SUCCEEDED"])
+        self.assertEqual(list(status["outputs"]), [1, 1])
+
+    def testSubjectFailed(self):
+        """
+        Check a failed subject is reported in the status table without stopping the other subjects
+        """
+        self.ivm.add(self.data_4d, grid=self.grid, name="data_a")
+        process = self._run_cohort([{"id" : "a", "data" : "data_a"}, {"id" : "b", "data" : "missing"}],
+                                   **{"status-name" : "cohort"})
+        self.assertEqual(process.status, Process.FAILED)
+        self.assertTrue("b" in str(process.exception))
+        self.assertEqual(process.output_data_items(), ["a_perfusion_native"])
+
+        status = self.ivm.extras["cohort"].df
+        self.assertEqual(list(status["status"]), ["SUCCEEDED", "FAILED"])
+        self.assertTrue(status["error"][1])
+
+    def testNoSubjects(self):
+        """
+        Check running without any subjects fails
+        """
+        process = self._run_cohort([])
+        self.assertEqual(process.status, Process.FAILED)
+        self.assertTrue(isinstance(process.exception, QpException))
+
 class OxaslWidgetTest(WidgetTest):
 
     def widget_class(self):
@@ -370,5 +1647,37 @@ class OxaslWidgetTest(WidgetTest):
         options = self.w._options()
         self._options_match(options, self._options(data="data_4d", inferart=True))
 
+    def testOptionalTabs(self):
+        """
+        Check optional tabs are only created when first enabled and are reused when re-enabled
+        """
+        qpdata = NumpyData(self.data_4d, grid=self.grid, name="data_4d")
+        qpdata.metadata["AslData"] = self._md()
+        self.ivm.add(qpdata, name="data_4d")
+        self.w.asldata.set_data_name("data_4d")
+        self.processEvents()
+        self.assertFalse(self.error)
+        self.assertEqual(self.w._optional_tabs, {})
+        num_tabs = self.w.tabs.count()
+
+        self.w.preproc.optbox.option("use_enable").value = True
+        self.processEvents()
+        self.assertEqual(list(self.w._optional_tabs.keys()), ["enable"])
+        enable = self.w._optional_tabs["enable"]
+        self.assertEqual(self.w.tabs.count(), num_tabs + 1)
+        self.assertEqual(self.w.tabs.indexOf(enable), self.w.tabs.indexOf(self.w.preproc) + 1)
+        self.assertTrue(enable in self.w._enabled_tabs())
+
+        self.w.preproc.optbox.option("use_enable").value = False
+        self.processEvents()
+        self.assertEqual(self.w.tabs.count(), num_tabs)
+        self.assertFalse(enable in self.w._enabled_tabs())
+
+        self.w.preproc.optbox.option("use_enable").value = True
+        self.processEvents()
+        self.assertTrue(self.w._optional_tabs["enable"] is enable)
+        self.assertTrue(self.w.tabs.indexOf(enable) >= 0)
+        self.assertFalse("veasl" in self.w._optional_tabs)
+
 if __name__ == '__main__':
     unittest.main()
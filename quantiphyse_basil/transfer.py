@@ -0,0 +1,302 @@
+"""
+QP-BASIL - Transfer of image data to and from worker processes
+
+Pickling large 4D image arrays to send them to a worker process copies them
+several times and makes start-up time scale with the size of the data. Instead
+the arrays are placed in memory-mapped files and only a small picklable
+descriptor (``SharedImage``) is sent. The receiving process maps the file and
+only pages in the data it actually uses.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+import os
+import re
+import shutil
+import tempfile
+import threading
+import weakref
+import atexit
+
+import numpy as np
+
+from quantiphyse.data import DataGrid, QpData
+
+class SharedImage(object):
+    """
+    Picklable descriptor for image data held in a memory-mapped file
+    """
+
+    def __init__(self, fname, shape, dtype, affine, name, offset=0, order="C", metadata=None, roi=False):
+        """
+        :param fname: File containing the raw voxel data
+        :param shape: Shape of the data array
+        :param dtype: Numpy data type of the data
+        :param affine: Voxel->world transformation matrix
+        :param name: Name of the image
+        :param offset: Offset of the start of the data in the file, in bytes
+        :param order: 'C' or 'F' ordering of the data in the file
+        :param metadata: Optional ``AslData`` metadata dictionary
+        :param roi: True if image is an ROI
+        """
+        self.fname = fname
+        self.shape = tuple(int(dim) for dim in shape)
+        self.dtype = np.dtype(dtype).str
+        self.affine = np.array(affine)
+        self.name = name
+        self.offset = int(offset)
+        self.order = order
+        self.metadata = dict(metadata) if metadata else {}
+        self.roi = roi
+
+    @classmethod
+    def from_array(cls, arr, affine, name, dirname, **kwargs):
+        """
+        Write an array to a memory-mapped file and return a descriptor for it
+
+        :param arr: Numpy array
+        :param affine: Voxel->world transformation matrix
+        :param name: Name of the image
+        :param dirname: Directory in which to create the file
+        """
+        safe_name = re.sub(r"[^\w]", "_", name)
+        fd, fname = tempfile.mkstemp(prefix=safe_name + "_", suffix=".dat", dir=dirname)
+        os.close(fd)
+        arr = np.asarray(arr)
+        if arr.size > 0:
+            mmap = np.memmap(fname, dtype=arr.dtype, mode="w+", shape=arr.shape)
+            mmap[...] = arr
+            mmap.flush()
+            del mmap
+        return cls(fname, arr.shape, arr.dtype, affine, name, **kwargs)
+
+    @classmethod
+    def from_qpdata(cls, qpd, dirname, io_stats=None):
+        """
+        Get a descriptor for the data in a QpData object
+
+        :param qpd: QpData object
+        :param dirname: Directory in which to create the memory-mapped file
+        :param io_stats: Optional dictionary in which bytes written are counted
+        """
+        raw = qpd.raw()
+        if io_stats is not None:
+            io_stats["transferred"] = io_stats.get("transferred", 0) + raw.nbytes
+        return cls.from_array(raw, qpd.grid.affine, qpd.name, dirname,
+                              metadata=qpd.metadata.get("AslData", None), roi=qpd.roi)
+
+    @classmethod
+    def map_nifti(cls, fname, name=None):
+        """
+        Get a descriptor which maps the data in a NIFTI file directly
+
+        This is only possible for uncompressed NIFTI files with no data scaling
+
+        :param fname: NIFTI file name
+        :param name: Image name. If not given, the file name without extension is used
+        :return: ``SharedImage`` or None if the file cannot be mapped directly
+        """
+        import nibabel as nib
+        if not fname.endswith(".nii"):
+            return None
+        if name is None:
+            name = os.path.basename(fname).split(".", 1)[0]
+        nii = nib.load(fname)
+        header = nii.header
+        slope, inter = header.get_slope_inter()
+        if slope not in (None, 1) or inter not in (None, 0):
+            return None
+        return cls(fname, nii.shape, header.get_data_dtype(), header.get_best_affine(), name,
+                   offset=header.get_data_offset(), order="F")
+
+    @classmethod
+    def from_nifti(cls, fname, name=None, dirname=None):
+        """
+        Get a descriptor for the data in a NIFTI file
+
+        Uncompressed NIFTI files with no data scaling are mapped directly. Otherwise
+        the data is read and written to a memory-mapped file in ``dirname``.
+
+        :param fname: NIFTI file name
+        :param name: Image name. If not given, the file name without extension is used
+        :param dirname: Directory for any memory-mapped file that needs to be created.
+                        If not specified, the directory containing the NIFTI file is used
+        """
+        shared = cls.map_nifti(fname, name)
+        if shared is None:
+            import nibabel as nib
+            if name is None:
+                name = os.path.basename(fname).split(".", 1)[0]
+            if dirname is None:
+                dirname = os.path.dirname(fname)
+            nii = nib.load(fname)
+            shared = cls.from_array(np.asanyarray(nii.dataobj), nii.header.get_best_affine(), name, dirname)
+        return shared
+
+    @property
+    def nbytes(self):
+        """ Size of the image data in bytes """
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+    def array(self, mode="c"):
+        """
+        Get the image data
+
+        :param mode: Memory map mode. The default is copy-on-write, so the array is
+                     writeable but changes are not written back to the file
+        :return: Numpy memmap array
+        """
+        if self.nbytes == 0:
+            return np.zeros(self.shape, dtype=self.dtype)
+        return np.memmap(self.fname, dtype=self.dtype, mode=mode, offset=self.offset,
+                         shape=self.shape, order=self.order)
+
+    def to_fslimage(self):
+        """
+        :return: fsl.data.image.Image on the memory-mapped data
+        """
+        from fsl.data.image import Image
+        return Image(self.array(), name=self.name, xform=self.affine)
+
+    def to_aslimage(self, metadata=None):
+        """
+        :param metadata: ``AslData`` metadata - if not given the stored metadata is used
+        :return: oxasl.AslImage on the memory-mapped data
+        """
+        from oxasl import AslImage
+        if metadata is None:
+            metadata = self.metadata
+        return AslImage(self.array(), name=self.name, xform=self.affine, **metadata)
+
+_shared_dirs = {}
+_shared_dirs_lock = threading.Lock()
+
+def _release_dir(key):
+    with _shared_dirs_lock:
+        entry = _shared_dirs.pop(key, None)
+    if entry is not None:
+        entry[1]()
+
+@atexit.register
+def _release_all_dirs():
+    for key in list(_shared_dirs.keys()):
+        _release_dir(key)
+
+class SharedDir(object):
+    """
+    Directory containing files which are memory mapped by ``SharedImageData`` objects
+
+    Each ``SharedImageData`` created with this object as its owner keeps a reference
+    to it, so the directory is released when all of them have been deleted, e.g.
+    when the data is removed from, or replaced in, the IVM. Directories which are
+    still in use when the session ends are released then.
+    """
+
+    def __init__(self, path, release=None):
+        """
+        :param path: Directory path
+        :param release: Function called with no arguments to release the directory.
+                        By default the directory is deleted
+        """
+        self.path = path
+        if release is None:
+            release = lambda: shutil.rmtree(path, ignore_errors=True)
+        key = id(self)
+        with _shared_dirs_lock:
+            _shared_dirs[key] = (weakref.ref(self, lambda _ref: _release_dir(key)), release)
+
+class SharedImageData(QpData):
+    """
+    QpData object backed by a ``SharedImage`` descriptor
+
+    Only the header information in the descriptor is used when the object is
+    created. The voxel data is memory mapped when it is first accessed, so
+    only the parts which are actually used are read.
+    """
+
+    def __init__(self, shared, name=None, roi=False, owner=None):
+        """
+        :param shared: ``SharedImage`` descriptor
+        :param name: Data name - if not specified the descriptor name is used
+        :param roi: True if data is an ROI
+        :param owner: Optional ``SharedDir`` containing the mapped file, which is
+                      kept until this object is deleted
+        """
+        self.shared = shared
+        self.owner = owner
+        self._rawdata = None
+        nvols = shared.shape[3] if len(shared.shape) > 3 else 1
+        if name is None:
+            name = shared.name
+        QpData.__init__(self, name, DataGrid(shared.shape[:3], shared.affine), nvols, roi=roi)
+
+    def raw(self):
+        if self._rawdata is None:
+            self._rawdata = self.shared.array()
+        return self._rawdata
+
+def mapped_data(qpd):
+    """
+    Get the voxel data for QpData, memory mapped from a file where possible
+
+    This works for ``SharedImageData`` and for data loaded from an uncompressed
+    NIFTI file whose header matches the data grid, provided the data has not
+    already been read into memory, where it may have been modified. Otherwise
+    the data is obtained from ``raw()`` in the normal way.
+
+    :param qpd: QpData object
+    :return: Numpy array or memmap
+    """
+    if isinstance(qpd, SharedImageData):
+        return qpd.raw()
+
+    fname = getattr(qpd, "fname", None)
+    loaded = getattr(qpd, "rawdata", None) is not None
+    if fname and fname.endswith(".nii") and os.path.isfile(fname) and not loaded:
+        try:
+            shared = SharedImage.map_nifti(fname, name=qpd.name)
+            shape = tuple(qpd.grid.shape) + ((qpd.nvols,) if qpd.nvols > 1 else ())
+            if shared is not None and shared.shape == shape and np.allclose(shared.affine, qpd.grid.affine):
+                return shared.array()
+        except Exception:
+            # Fall back to loading the data normally
+            pass
+    return qpd.raw()
+
+def data_nbytes(qpd):
+    """
+    Get the size of the voxel data in QpData without loading it where possible
+
+    :param qpd: QpData object
+    :return: Size in bytes
+    """
+    if isinstance(qpd, SharedImageData):
+        return qpd.shared.nbytes
+
+    header = getattr(qpd, "nifti_header", None)
+    if getattr(qpd, "rawdata", None) is None and header is not None:
+        return int(np.prod(qpd.grid.shape)) * qpd.nvols * header.get_data_dtype().itemsize
+    return qpd.raw().nbytes
+
+def nifti_descriptors(rootdir, paths, dirname=None):
+    """
+    Get descriptors for NIFTI images in a directory tree
+
+    :param rootdir: Root directory to search
+    :param paths: Sequence of paths relative to ``rootdir`` (without file extension) to
+                  include. Each path may be an individual image or a subdirectory
+    :param dirname: Directory for memory-mapped files created for images which cannot
+                    be mapped directly - see ``SharedImage.from_nifti``
+    :return: Mapping from relative path (without extension and using '/' as the separator)
+             to ``SharedImage``
+    """
+    paths = [path.strip("/") for path in paths]
+    ret = {}
+    for dirpath, _, fnames in os.walk(rootdir):
+        for fname in fnames:
+            if not fname.endswith((".nii", ".nii.gz")):
+                continue
+            fpath = os.path.join(dirpath, fname)
+            relpath = os.path.relpath(fpath, rootdir).replace(os.sep, "/").split(".", 1)[0]
+            if any(relpath == path or relpath.startswith(path + "/") for path in paths):
+                ret[relpath] = SharedImage.from_nifti(fpath, dirname=dirname)
+    return ret
@@ -15,7 +15,7 @@ from quantiphyse.gui.widgets import QpWidget, RoiCombo, OverlayCombo, Citation,
 from quantiphyse.utils import QpException
 
 from .aslimage_widget import AslImageWidget
-from .process import AslPreprocProcess, BasilProcess, AslCalibProcess, AslMultiphaseProcess
+from .background import BackgroundExecutor
 
 from ._version import __version__, __license__
 
@@ -29,13 +29,16 @@ DEFAULT_MULTIPHASE_METADATA = {
     "casl" : True
 }
 
+# Delay in ms after a calibration parameter changes before the output is updated
+CALIB_UPDATE_DELAY = 300
+
 class AslPreprocWidget(QpWidget):
     """
     Widget which lets you do basic preprocessing on ASL data
     """
     def __init__(self, **kwargs):
         QpWidget.__init__(self, name="ASL Preprocess", icon="asl.png", group="ASL", desc="Basic preprocessing on ASL data", version=__version__, license=__license__, **kwargs)
-        self.process = AslPreprocProcess(self.ivm)
+        self.process = None
         self.output_name_edited = False
 
     def init_ui(self):
@@ -98,7 +101,7 @@ class AslPreprocWidget(QpWidget):
         self.output_name_edited = False
         self._guess_output_name()
         # Label-control differencing only if data contains LC or CL pairs
-        pairs = self.aslimage_widget.aslimage is not None and self.aslimage_widget.aslimage.iaf in ("tc", "ct")
+        pairs = self.aslimage_widget.structure.get("iaf", None) in ("tc", "ct")
         self.sub_cb.setEnabled(pairs)
         if not pairs: self.sub_cb.setChecked(False)
 
@@ -117,6 +120,9 @@ class AslPreprocWidget(QpWidget):
         return "AslPreproc", self.get_options()
 
     def get_process(self):
+        if self.process is None:
+            from .process import AslPreprocProcess
+            self.process = AslPreprocProcess(self.ivm)
         return self.process
 
     def get_options(self):
@@ -130,7 +136,7 @@ class AslPreprocWidget(QpWidget):
         return options
 
     def run(self):
-        self.process.run(self.get_options())
+        self.get_process().run(self.get_options())
          
 FAB_CITE_TITLE = "Variational Bayesian inference for a non-linear forward model"
 FAB_CITE_AUTHOR = "Chappell MA, Groves AR, Whitcher B, Woolrich MW."
@@ -148,6 +154,7 @@ class AslBasilWidget(QpWidget):
         self.setLayout(vbox)
 
         try:
+            from .process import BasilProcess
             self.process = BasilProcess(self.ivm)
         except QpException as e:
             self.process = None
@@ -311,8 +318,45 @@ class AslCalibWidget(QpWidget):
 
         runbox = RunBox(self.get_process, self.get_options, title="Run calibration", save_option=True)
         vbox.addWidget(runbox)
+
+        # Calibration parameters can be changed interactively. Updates are
+        # delayed so a burst of changes only results in one calibration, which
+        # is run in the background. The M0 estimate is cached by the process so
+        # changing these parameters only rescales the data
+        self.live_update = QtGui.QCheckBox("Update output when calibration parameters change")
+        vbox.addWidget(self.live_update)
+        self._executor = BackgroundExecutor(self)
+        self._update_timer = QtCore.QTimer(self)
+        self._update_timer.setSingleShot(True)
+        self._update_timer.setInterval(CALIB_UPDATE_DELAY)
+        self._update_timer.timeout.connect(self._update_output)
+        for param in (self.gain, self.alpha, self.tr, self.t1t, self.pct, self.ref_pc):
+            param.spin.valueChanged.connect(self._params_changed)
         vbox.addStretch(1)
-        
+
+    def _params_changed(self):
+        if self.live_update.isChecked():
+            # Restarts the timer if an update is already pending
+            self._update_timer.start()
+
+    def _update_output(self):
+        from .calibration import calibrate_data
+        options = self.get_options()
+        if options["data"] not in self.ivm.data or options["calib-data"] not in self.ivm.data:
+            return
+        process = self.get_process()
+        try:
+            inputs = process.get_inputs(options)
+        except QpException as exc:
+            self.debug("Calibration update failed: %s", exc)
+            return
+        self._executor.submit("calibrate", calibrate_data, kwargs=inputs["calibrate"],
+                              callback=lambda output: process.set_output(inputs, output),
+                              errback=self._update_failed)
+
+    def _update_failed(self, exc):
+        self.debug("Calibration update failed: %s", exc)
+
     def _ref_tiss_changed(self):
         ref_type = self.ref_type.combo.currentText()
         if ref_type != "Custom":
@@ -329,6 +373,7 @@ class AslCalibWidget(QpWidget):
         return "AslCalib", self.get_options()
     
     def get_process(self):
+        from .process import AslCalibProcess
         return AslCalibProcess(self.ivm)
 
     def get_options(self):
@@ -378,6 +423,7 @@ class AslMultiphaseWidget(QpWidget):
         self.setLayout(vbox)
 
         try:
+            from .process import BasilProcess
             self.process = BasilProcess(self.ivm)
         except QpException as e:
             self.process = None
@@ -451,6 +497,7 @@ class AslMultiphaseWidget(QpWidget):
         return "AslMultiphase", self.get_options()
 
     def get_process(self):
+        from .process import AslMultiphaseProcess
         return AslMultiphaseProcess(self.ivm)
 
     def _infer(self, options, param, selected):